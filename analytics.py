@@ -0,0 +1,88 @@
+import os
+import logging
+from datetime import date, timedelta
+from jobs import every
+from db import (
+	refresh_materialized_view, get_analytics_refreshes, get_order_series, get_order_status_totals,
+	get_delivery_series, get_courier_stats, get_activity_series
+)
+
+# Панель /admin/analytics читает только агрегаты (строка на день/час), поэтому
+# её стоимость зависит от числа столбцов графика, а не от размера orders и logs
+ANALYTICS_REFRESH_INTERVAL = float(os.getenv('ANALYTICS_REFRESH_INTERVAL', 600))
+# Окно analytics_hourly_activity в schema.sql
+ACTIVITY_DAYS = 90
+
+VIEWS = ['analytics_daily_orders', 'analytics_courier_daily', 'analytics_hourly_activity']
+PERIODS = {'7': 7, '30': 30, '90': 90, '365': 365}
+BUCKETS = ('day', 'week', 'month')
+
+logger = logging.getLogger(__name__)
+
+def refresh_all():
+	for name in VIEWS:
+		duration = refresh_materialized_view(name)
+		logger.info('refreshed %s in %.1fs', name, duration)
+
+every('analytics-refresh', ANALYTICS_REFRESH_INTERVAL, refresh_all, exclusive=True)
+
+def chart(rows, value_index=1, label_format='%d.%m'):
+	# Столбцы графика: подпись, значение и высота в процентах от максимума
+	values = [float(row[value_index] or 0) for row in rows]
+	top = max(values, default=0) or 1
+	return [
+		{'label': row[0].strftime(label_format), 'value': row[value_index] or 0, 'height': round(100 * value / top, 1)}
+		for row, value in zip(rows, values)
+	]
+
+def bucket_start(day, bucket):
+	# Как date_trunc в PostgreSQL: неделя с понедельника
+	if bucket == 'week':
+		return day - timedelta(days=day.weekday())
+	if bucket == 'month':
+		return day.replace(day=1)
+	return day
+
+def next_bucket(day, bucket):
+	if bucket == 'week':
+		return day + timedelta(days=7)
+	if bucket == 'month':
+		return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+	return day + timedelta(days=1)
+
+def dashboard(period='30', bucket='day'):
+	days = PERIODS.get(period, 30)
+	if bucket not in BUCKETS:
+		bucket = 'day'
+	today = date.today()
+	# Начало периода — на границе столбца, иначе первый столбец неполный
+	since = bucket_start(today - timedelta(days=days - 1), bucket)
+	orders = get_order_series(since, bucket)
+	deliveries = get_delivery_series(since, bucket)
+	# Журнал хранится в часовых агрегатах за ACTIVITY_DAYS дней: график активности
+	# не длиннее этого окна и начинается с первого полного столбца в нём;
+	# короткий период — по часам
+	activity_bucket = 'hour' if days <= 7 and bucket == 'day' else bucket
+	activity_first = today - timedelta(days=ACTIVITY_DAYS - 1)
+	activity_since = since
+	if activity_since < activity_first:
+		activity_since = bucket_start(activity_first, bucket)
+		if activity_since < activity_first:
+			activity_since = next_bucket(activity_since, bucket)
+	activity = get_activity_series(activity_since, activity_bucket)
+	return {
+		'period': str(days),
+		'bucket': bucket,
+		'periods': list(PERIODS),
+		'buckets': BUCKETS,
+		'orders': chart(orders, 1),
+		'revenue': chart(orders, 2),
+		'deliveries': chart(deliveries, 1),
+		'delivery_minutes': chart(deliveries, 2),
+		'late_percent': chart(deliveries, 3),
+		'activity': chart(activity, 1, '%d.%m %H:00' if activity_bucket == 'hour' else '%d.%m'),
+		'activity_since': activity_since if activity_since > since else None,
+		'statuses': get_order_status_totals(since),
+		'couriers': get_courier_stats(since),
+		'refreshes': get_analytics_refreshes(),
+	}
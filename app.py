@@ -1,41 +1,112 @@
-from flask import Flask, request, render_template, redirect, url_for, session, flash, send_file
+from flask import Flask, Response, request, render_template, redirect, url_for, session, flash, jsonify
 import hashlib
 import os
-from datetime import datetime
-from werkzeug.utils import secure_filename
-import subprocess
+import psycopg2
+from datetime import datetime, timedelta
 from db import (
-	get_db_connection, get_user_by_email, create_user, get_user_by_credentials,
-	get_user_info, get_all_products, get_products_by_seller, add_product,
-	update_product, delete_product, get_product_seller, get_product_quantity,
-	add_to_cart, get_cart_items, remove_from_cart, clear_cart,
-	get_cart_for_checkout, get_user_orders, get_all_orders, get_seller_orders,
-	update_order_status, assign_order_to_courier, get_active_courier_orders,
+	get_user_by_email, create_user, get_user_by_credentials,
+	get_user_info, search_products, add_product,
+	update_product, delete_product, get_product_seller,
+	get_cart_items, remove_from_cart, clear_cart,
+	get_user_orders, get_all_orders, get_seller_orders, get_seller_order_stats,
+	pay_order, assign_order_to_courier, get_active_courier_orders,
 	get_available_orders, update_delivery_status, check_courier_assignment,
-	cancel_delivery, log_action, get_logs, load_db_dump, get_all_users,
-	delete_user
+	cancel_delivery, get_logs, get_all_users,
+	delete_user, get_sellers, create_order, claim_next_orders, gather, pool_stats, init_app as init_db
 )
+from audit import log_action, audit_log
+from cache import cache_stats
+from images import schedule as schedule_image_derivatives
+from storage import store_upload, release as release_uploads, cache_forever
+from backup import stream_dump, dump_filename, backup_status, FORMATS as BACKUP_FORMATS, available_compressions
+from jobs import start_jobs
+from sessions import DatabaseSessionInterface, forget as forget_sessions
+from events import event_hub, stream as stream_events
+from reservations import hold as hold_stock
+from log_retention import partitions_status as log_partitions
+from catalogue import import_catalogue, export_catalogue, detect_format, CatalogueImportError, FORMATS as CATALOGUE_FORMATS
+from analytics import dashboard as analytics_dashboard
+from profiler import init_app as init_profiler
+from instrumentation import init_app as init_query_metrics, top_queries, endpoint_stats, slow_queries, reset_stats, SLOW_QUERY_MS
+from responses import conditional, init_app as init_responses
 
 app = Flask(__name__)
+# Сжатие ответов и сжатая статика; after_request регистрируется первым,
+# чтобы выполняться последним — уже после фиксации транзакции запроса
+init_responses(app)
+init_db(app)
+# Фоновые задачи запускаются в обслуживающем процессе (после fork у gunicorn)
+app.before_request(start_jobs)
 
 ########### МЕТРИКИ ###########
-
-
-
-
-
-
-
+# Время функций db.py и отдельных запросов, число запросов на HTTP-запрос,
+# журнал медленных запросов с планами — /admin/queries и /metrics
+init_query_metrics(app)
+# Сэмплирующий профилировщик (PROFILE_SAMPLE_RATE или ?profile=1 для админа)
+# и время страниц по частям: база, шаблоны, Python — в PROFILE_DIR
+init_profiler(app)
 ########### МЕТРИКИ ###########
-app.secret_key = os.urandom(16)
+app.secret_key = os.getenv('SECRET_KEY') or os.urandom(16)
+app.session_interface = DatabaseSessionInterface()
 
 UPLOAD_FOLDER = 'static/uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+MAX_CLAIM_ORDERS = 10
+# Окна просмотра журнала в днях, 0 — вся история
+LOG_WINDOWS = {'1': 1, '7': 7, '30': 30, '90': 90, 'all': 0}
+
+@app.after_request
+def cache_uploaded_blobs(response):
+	return cache_forever(response, request)
+
+@app.template_global()
+def page_url(cursor):
+	args = request.args.to_dict()
+	args['cursor'] = cursor
+	return url_for(request.endpoint, **args)
 
 def allowed_file(filename):
 	return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def save_uploads(files):
+	image_urls = []
+	for f in files:
+		if f and allowed_file(f.filename):
+			extension = f.filename.rsplit('.', 1)[1].lower()
+			image_urls.append(store_upload(f, app.config['UPLOAD_FOLDER'], extension))
+	# Миниатюры и WebP/AVIF строятся в фоне после фиксации транзакции
+	schedule_image_derivatives(image_urls)
+	return image_urls
+
+def catalogue_transfer(seller_id, back):
+	# GET — выгрузка каталога (seller_id=None — всего), POST — импорт файла.
+	# Форма со страницы получает flash и возврат на неё, остальные клиенты — JSON
+	if request.method == 'GET':
+		fmt = request.args.get('format', 'csv')
+		if fmt not in CATALOGUE_FORMATS:
+			return jsonify(error=f'unsupported format: {fmt}'), 400
+		log_action(session['user_id'], f"Exported catalogue as {fmt}")
+		return Response(export_catalogue(fmt, seller_id), mimetype=CATALOGUE_FORMATS[fmt],
+				headers={'Content-Disposition': f'attachment; filename=products.{fmt}'})
+	upload = request.files.get('file')
+	try:
+		if not upload:
+			raise CatalogueImportError([(0, 'file is required')])
+		fmt = detect_format(upload.filename, request.form.get('format'))
+		added, updated, previous_urls = import_catalogue(upload.stream, fmt, app.config['UPLOAD_FOLDER'], seller_id)
+	except CatalogueImportError as e:
+		if request.form.get('redirect'):
+			flash('Import failed: ' + '; '.join(f'line {line}: {error}' for line, error in e.errors[:5]))
+			return redirect(url_for(back))
+		return jsonify(errors=[{'line': line, 'error': error} for line, error in e.errors]), 400
+	release_uploads(previous_urls)
+	log_action(session['user_id'], f"Imported catalogue: {added} added, {updated} updated")
+	if request.form.get('redirect'):
+		flash(f'Imported: {added} added, {updated} updated')
+		return redirect(url_for(back))
+	return jsonify(added=added, updated=updated)
+
 def login_required(role=None):
 	def decorator(f):
 		def wrapper(*args, **kwargs):
@@ -52,21 +123,24 @@ def login_required(role=None):
 
 @app.route('/', methods=['GET', 'POST'])
 @login_required()
+@conditional('catalogue', 'users')
 def index():
 	search = request.args.get('search', '')
-	products = get_all_products(search)
 	if request.method == 'POST' and session['role'] == 'customer':
 		product_id = request.form.get('product_id')
 		quantity = int(request.form.get('quantity', 1))
-		available = get_product_quantity(product_id)
-		if quantity > available:
+		# Товар резервируется сразу, отдельная проверка остатка не нужна
+		reserved, available = hold_stock(session['user_id'], product_id, max(quantity, 1))
+		if not reserved:
 			flash(f'Only {available} items available')
 		else:
-			add_to_cart(session['user_id'], product_id, quantity)
 			log_action(session['user_id'], f"Added {quantity} of product {product_id} to cart")
 			flash('Product added to cart')
-	name, role = get_user_info(session['user_id'])
-	return render_template('index.html', products=products, name=name, role=role, search=search)
+	page, (name, role) = gather(
+		lambda: search_products(search, cursor=request.args.get('cursor')),
+		lambda: get_user_info(session['user_id']),
+	)
+	return render_template('index.html', products=page.items, page=page, name=name, role=role, search=search)
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -107,6 +181,16 @@ def logout():
 	flash('Logged out')
 	return redirect(url_for('login'))
 
+@app.route('/events')
+@login_required()
+def events():
+	# Изменения статусов заказов вместо перезагрузки страниц (см. static/js/events.js)
+	subscription = event_hub.subscribe(session['user_id'], session['role'], request.headers.get('Last-Event-ID'))
+	if subscription is None:
+		return Response('Too many event streams', 503, {'Retry-After': '60'})
+	return Response(stream_events(subscription), mimetype='text/event-stream',
+			headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/customer', methods=['GET', 'POST'])
 @login_required('customer')
 def customer_profile():
@@ -118,32 +202,23 @@ def customer_profile():
 			log_action(session['user_id'], f"Removed product {product_id} from cart")
 			flash('Item removed from cart')
 		elif action == 'checkout':
-			cart_items = get_cart_for_checkout(session['user_id'])
-			if not cart_items:
-				flash('Cart is empty')
-			else:
-				cart_array = [[item[0], item[1]] for item in cart_items]
-				conn = get_db_connection()
-				cur = conn.cursor()
-				try:
-					cur.execute("CALL create_order_with_items(%s, %s, %s)", 
-							(session['user_id'], request.form.get('delivery_address'), cart_array))
-					conn.commit()
-					flash('Order placed successfully')
-				except psycopg2.Error as e:
-					conn.rollback()
-					flash(f'Error placing order: {str(e)}')
-				finally:
-					cur.close()
-					conn.close()
+			try:
+				create_order(session['user_id'], request.form.get('delivery_address'))
+				flash('Order placed successfully')
+			except psycopg2.Error as e:
+				flash(f'Error placing order: {e.diag.message_primary or e}')
 		elif action == 'pay':
 			order_id = request.form.get('order_id')
-			update_order_status(order_id, 'paid')
-			log_action(session['user_id'], f"Order {order_id} paid")
-			flash('Order paid')
-	cart_items = get_cart_items(session['user_id'])
+			if pay_order(order_id, session['user_id']):
+				log_action(session['user_id'], f"Order {order_id} paid")
+				flash('Order paid')
+			else:
+				flash('Order is already paid')
 	status_filter = request.args.get('status', '')
-	orders = get_user_orders(session['user_id'], status_filter)
+	cart_items, orders = gather(
+		lambda: get_cart_items(session['user_id']),
+		lambda: get_user_orders(session['user_id'], status_filter),
+	)
 	return render_template('customer_profile.html', cart_items=cart_items, orders=orders, status_filter=status_filter)
 
 @app.route('/admin')
@@ -154,8 +229,32 @@ def admin_panel():
 @app.route('/admin/backup', methods=['GET'])
 @login_required('admin')
 def admin_backup():
-	load_db_dump()
-	return send_file('backup.dump', as_attachment=True)
+	fmt = request.args.get('format', 'custom')
+	compression = request.args.get('compression') or None
+	if fmt not in BACKUP_FORMATS or (compression and compression not in available_compressions()):
+		flash('Unsupported backup format')
+		return redirect(url_for('admin_panel'))
+	log_action(session['user_id'], f"Admin downloaded {fmt} backup")
+	return Response(stream_dump(fmt, compression), mimetype='application/octet-stream',
+			headers={'Content-Disposition': f'attachment; filename={dump_filename(fmt, compression)}'})
+
+@app.route('/admin/backup/status')
+@login_required('admin')
+def admin_backup_status():
+	return jsonify(backup_status())
+
+@app.route('/admin/queries', methods=['GET', 'POST'])
+@login_required('admin')
+def admin_queries():
+	if request.method == 'POST':
+		reset_stats()
+		return redirect(url_for('admin_queries'))
+	order = request.args.get('order', 'total')
+	if order not in ('total', 'calls', 'mean', 'max', 'rows'):
+		order = 'total'
+	return render_template('admin_queries.html', queries=top_queries(order), endpoints=endpoint_stats(),
+			slow=slow_queries(), order=order, slow_query_ms=SLOW_QUERY_MS, pid=os.getpid(),
+			audit=audit_log.stats(), pool=pool_stats(), caches=cache_stats())
 
 @app.route('/admin/users', methods=['GET', 'POST'])
 @login_required('admin')
@@ -175,7 +274,7 @@ def admin_users():
 				flash('User added successfully')
 		elif action == 'delete':
 			user_id = request.form.get('user_id')
-			delete_user(user_id)
+			forget_sessions(delete_user(user_id))
 			log_action(session['user_id'], f"Admin deleted user with ID {user_id}")
 			flash('User deleted successfully')
 	users = get_all_users()
@@ -193,14 +292,7 @@ def admin_products():
 			price = float(request.form.get('price'))
 			quantity = int(request.form.get('quantity'))
 			seller_id = int(request.form.get('seller_id'))  # Получаем seller_id из формы
-			files = request.files.getlist('images')
-			image_urls = []
-			for f in files:
-				if f and allowed_file(f.filename):
-					filename = secure_filename(f.filename)
-					file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-					f.save(file_path)
-					image_urls.append(file_path)
+			image_urls = save_uploads(request.files.getlist('images'))
 			add_product(name, description, price, quantity, image_urls, seller_id)  # Передаём seller_id
 			flash('Product added')
 		elif action == 'edit':
@@ -210,42 +302,50 @@ def admin_products():
 			price = float(request.form.get('price'))
 			quantity = int(request.form.get('quantity'))
 			image_urls = request.form.getlist('existing_images')
-			files = request.files.getlist('images')
-			for f in files:
-				if f and allowed_file(f.filename):
-					filename = secure_filename(f.filename)
-					file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-					f.save(file_path)
-					image_urls.append(file_path)
-			update_product(product_id, name, description, price, quantity, image_urls)
+			image_urls += save_uploads(request.files.getlist('images'))
+			release_uploads(update_product(product_id, name, description, price, quantity, image_urls))
 			flash('Product updated')
 		elif action == 'delete':
 			product_id = request.form.get('product_id')
-			delete_product(product_id)
+			release_uploads(delete_product(product_id))
 			flash('Product deleted')
-	products = get_all_products(search)
-	# Получаем список продавцов
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("SELECT id, name FROM users WHERE role = 'seller'")
-	sellers = cur.fetchall()
-	cur.close()
-	conn.close()
-	return render_template('admin_products.html', products=products, search=search, sellers=sellers)
+	page, sellers = gather(
+		lambda: search_products(search, cursor=request.args.get('cursor')),
+		get_sellers,
+	)
+	return render_template('admin_products.html', products=page.items, page=page, search=search, sellers=sellers)
+
+@app.route('/admin/catalogue', methods=['GET', 'POST'])
+@login_required('admin')
+def admin_catalogue():
+	return catalogue_transfer(None, 'admin_products')
 
 @app.route('/admin/orders')
 @login_required('admin')
+@conditional('orders', 'users')
 def admin_orders():
 	status_filter = request.args.get('status', '')
-	orders = get_all_orders(status_filter)
-	return render_template('admin_orders.html', orders=orders, status_filter=status_filter)
+	page = get_all_orders(status_filter, cursor=request.args.get('cursor'))
+	return render_template('admin_orders.html', orders=page.items, page=page, status_filter=status_filter)
+
+@app.route('/admin/analytics')
+@login_required('admin')
+def admin_analytics():
+	data = analytics_dashboard(request.args.get('period', '30'), request.args.get('bucket', 'day'))
+	return render_template('admin_analytics.html', data=data)
 
 @app.route('/admin/logs')
 @login_required('admin')
 def admin_logs():
 	action_filter = request.args.get('action', '')
-	logs = get_logs(action_filter)
-	return render_template('admin_logs.html', logs=logs, action_filter=action_filter)
+	# Окно по времени ограничивает чтение свежими секциями журнала
+	days = request.args.get('days', '7')
+	if days not in LOG_WINDOWS:
+		days = '7'
+	since = datetime.now() - timedelta(days=LOG_WINDOWS[days]) if LOG_WINDOWS[days] else None
+	page = get_logs(action_filter, since, cursor=request.args.get('cursor'))
+	return render_template('admin_logs.html', logs=page.items, page=page, action_filter=action_filter,
+			days=days, windows=LOG_WINDOWS, partitions=log_partitions())
 
 @app.route('/seller', methods=['GET', 'POST'])
 @login_required('seller')
@@ -258,14 +358,7 @@ def seller_profile():
 			description = request.form.get('description')
 			price = float(request.form.get('price'))
 			quantity = int(request.form.get('quantity'))
-			files = request.files.getlist('images')
-			image_urls = []
-			for f in files:
-				if f and allowed_file(f.filename):
-					filename = secure_filename(f.filename)
-					file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-					f.save(file_path)
-					image_urls.append(file_path)
+			image_urls = save_uploads(request.files.getlist('images'))
 			add_product(name, description, price, quantity, image_urls, session['user_id'])
 			flash('Product added')
 		elif action == 'edit' and get_product_seller(request.form.get('product_id')) == session['user_id']:
@@ -275,28 +368,31 @@ def seller_profile():
 			price = float(request.form.get('price'))
 			quantity = int(request.form.get('quantity'))
 			image_urls = request.form.getlist('existing_images')
-			files = request.files.getlist('images')
-			for f in files:
-				if f and allowed_file(f.filename):
-					filename = secure_filename(f.filename)
-					file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-					f.save(file_path)
-					image_urls.append(file_path)
-			update_product(product_id, name, description, price, quantity, image_urls)
+			image_urls += save_uploads(request.files.getlist('images'))
+			release_uploads(update_product(product_id, name, description, price, quantity, image_urls))
 			flash('Product updated')
 		elif action == 'delete' and get_product_seller(request.form.get('product_id')) == session['user_id']:
 			product_id = request.form.get('product_id')
-			delete_product(product_id)
+			release_uploads(delete_product(product_id))
 			flash('Product deleted')
-	products = get_products_by_seller(session['user_id'], search)
-	return render_template('seller_profile.html', products=products, search=search)
+	page = search_products(search, seller_id=session['user_id'], cursor=request.args.get('cursor'))
+	return render_template('seller_profile.html', products=page.items, page=page, search=search)
+
+@app.route('/seller/catalogue', methods=['GET', 'POST'])
+@login_required('seller')
+def seller_catalogue():
+	return catalogue_transfer(session['user_id'], 'seller_profile')
 
 @app.route('/seller/orders')
 @login_required('seller')
+@conditional('seller_orders')
 def seller_orders():
 	status_filter = request.args.get('status', '')
-	orders = get_seller_orders(session['user_id'], status_filter)
-	return render_template('seller_orders.html', orders=orders, status_filter=status_filter)
+	page, stats = gather(
+		lambda: get_seller_orders(session['user_id'], status_filter, cursor=request.args.get('cursor')),
+		lambda: get_seller_order_stats(session['user_id']),
+	)
+	return render_template('seller_orders.html', orders=page.items, page=page, status_filter=status_filter, stats=stats)
 
 @app.route('/courier', methods=['GET', 'POST'])
 @login_required('courier')
@@ -306,8 +402,14 @@ def courier_orders():
 		if action == 'assign':
 			order_id = request.form.get('order_id')
 			estimated_delivery = request.form.get('estimated_delivery')
-			assign_order_to_courier(order_id, session['user_id'], estimated_delivery)
-			flash('Order assigned')
+			if assign_order_to_courier(order_id, session['user_id'], estimated_delivery):
+				flash('Order assigned')
+			else:
+				flash('Order was already taken')
+		elif action == 'claim_next':
+			count = min(max(int(request.form.get('count', 1)), 1), MAX_CLAIM_ORDERS)
+			claimed = claim_next_orders(session['user_id'], request.form.get('estimated_delivery'), count)
+			flash(f'Orders assigned: {len(claimed)}' if claimed else 'No orders available')
 		elif action == 'update_status' and check_courier_assignment(request.form.get('order_id'), session['user_id']):
 			order_id = request.form.get('order_id')
 			new_status = request.form.get('new_status')
@@ -318,8 +420,10 @@ def courier_orders():
 			reason = request.form.get('reason', 'No reason provided')
 			cancel_delivery(order_id, session['user_id'], reason)
 			flash('Delivery cancelled')
-	active_orders = get_active_courier_orders(session['user_id'])
-	available_orders = get_available_orders()
+	active_orders, available_orders = gather(
+		lambda: get_active_courier_orders(session['user_id']),
+		get_available_orders,
+	)
 	return render_template('courier_orders.html', active_orders=active_orders, available_orders=available_orders)
 
 if __name__ == '__main__':
@@ -0,0 +1,142 @@
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+import psycopg2
+from datetime import datetime
+from prometheus_client import Counter
+from db import insert_logs
+
+AUDIT_QUEUE_SIZE = int(os.getenv('AUDIT_QUEUE_SIZE', 10000))
+AUDIT_BATCH_SIZE = int(os.getenv('AUDIT_BATCH_SIZE', 500))
+AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', 1.0))
+AUDIT_ENQUEUE_TIMEOUT = float(os.getenv('AUDIT_ENQUEUE_TIMEOUT', 0.05))
+AUDIT_RETRIES = int(os.getenv('AUDIT_RETRIES', 3))
+
+logger = logging.getLogger(__name__)
+
+AUDIT_EVENTS = Counter('audit_events_total', 'События журнала аудита по исходу', ['result'])
+
+_STOP = object()
+
+class AuditLog:
+	# Запросы только кладут событие в ограниченную очередь, а фоновый поток
+	# пишет их в logs пачками: по AUDIT_BATCH_SIZE штук или раз в AUDIT_FLUSH_INTERVAL.
+	def __init__(self, maxsize, batch_size, flush_interval, enqueue_timeout, retries):
+		self.maxsize = maxsize
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.enqueue_timeout = enqueue_timeout
+		self.retries = retries
+		self._lock = threading.Lock()
+		self._pid = None
+		self._thread = None
+		self.queue = None
+		self.enqueued = 0
+		self.flushed = 0
+		self.dropped = 0
+		self.failed = 0
+		self.batches = 0
+
+	def _ensure_writer(self):
+		# Поток записи не переживает fork(), поэтому в каждом процессе свой
+		if self._pid == os.getpid():
+			return
+		with self._lock:
+			if self._pid != os.getpid():
+				self.queue = queue.Queue(self.maxsize)
+				self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+				self._thread.start()
+				self._pid = os.getpid()
+
+	def log(self, user_id, action):
+		self._ensure_writer()
+		try:
+			# Если писатель не успевает, запрос ждёт не дольше enqueue_timeout
+			self.queue.put((user_id, action, datetime.now()), timeout=self.enqueue_timeout)
+		except queue.Full:
+			self._count('dropped', 1)
+			return False
+		self._count('enqueued', 1)
+		return True
+
+	def _count(self, result, events):
+		with self._lock:
+			setattr(self, result, getattr(self, result) + events)
+		AUDIT_EVENTS.labels(result).inc(events)
+
+	def _collect(self):
+		batch = []
+		try:
+			item = self.queue.get(timeout=self.flush_interval)
+		except queue.Empty:
+			return batch, False
+		deadline = time.monotonic() + self.flush_interval
+		while item is not _STOP:
+			batch.append(item)
+			remaining = deadline - time.monotonic()
+			if len(batch) >= self.batch_size or remaining <= 0:
+				return batch, False
+			try:
+				item = self.queue.get(timeout=remaining)
+			except queue.Empty:
+				return batch, False
+		return batch, True
+
+	def _flush(self, batch):
+		for attempt in range(self.retries):
+			try:
+				insert_logs(batch)
+			except (psycopg2.OperationalError, psycopg2.InterfaceError):
+				logger.exception('audit log flush failed (attempt %s)', attempt + 1)
+				time.sleep(min(2 ** attempt, 5))
+				continue
+			except psycopg2.Error:
+				# Ошибка в данных (например, пользователь уже удалён): повтор не
+				# поможет, пачка делится пополам, пока не останутся только плохие строки
+				if len(batch) == 1:
+					logger.warning('audit event rejected: %r', batch[0], exc_info=True)
+					self._count('failed', 1)
+					return
+				middle = len(batch) // 2
+				self._flush(batch[:middle])
+				self._flush(batch[middle:])
+				return
+			self._count('flushed', len(batch))
+			with self._lock:
+				self.batches += 1
+			return
+		self._count('failed', len(batch))
+
+	def _run(self):
+		stopping = False
+		while not stopping:
+			batch, stopping = self._collect()
+			if batch:
+				self._flush(batch)
+
+	def close(self, timeout=10):
+		if self._pid != os.getpid() or not self._thread.is_alive():
+			return
+		self.queue.put(_STOP)
+		self._thread.join(timeout)
+		self._pid = None
+
+	def stats(self):
+		with self._lock:
+			return {
+				'queued': self.queue.qsize() if self._pid == os.getpid() else 0,
+				'enqueued': self.enqueued,
+				'flushed': self.flushed,
+				'dropped': self.dropped,
+				'failed': self.failed,
+				'batches': self.batches,
+			}
+
+audit_log = AuditLog(AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_INTERVAL, AUDIT_ENQUEUE_TIMEOUT, AUDIT_RETRIES)
+atexit.register(audit_log.close)
+
+def log_action(user_id, action):
+	return audit_log.log(user_id, action)
@@ -0,0 +1,144 @@
+import os
+import time
+import uuid
+import zlib
+import shutil
+import logging
+import threading
+import subprocess
+from collections import deque
+from datetime import datetime
+from jobs import every, job_stats
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+BACKUP_INTERVAL = float(os.getenv('BACKUP_INTERVAL', 0))
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', 7))
+BACKUP_JOBS = int(os.getenv('BACKUP_JOBS', 4))
+BACKUP_CHUNK_SIZE = 256 * 1024
+
+# Формат pg_dump и расширение файла. custom и directory восстанавливаются
+# параллельно через pg_restore -j; directory нельзя отдать потоком, только на диск.
+FORMATS = {'plain': ('p', 'sql'), 'custom': ('c', 'dump'), 'tar': ('t', 'tar')}
+COMPRESSIONS = {'gzip': 'gz', 'zstd': 'zst'}
+
+logger = logging.getLogger(__name__)
+
+_streams = {}
+_streams_lock = threading.Lock()
+
+class BackupError(Exception):
+	pass
+
+def _pg_env():
+	env = dict(os.environ)
+	for var, name in [('PGDATABASE', 'DB_NAME'), ('PGUSER', 'DB_USER'), ('PGPASSWORD', 'DB_PASSWORD'),
+			('PGHOST', 'DB_HOST'), ('PGPORT', 'DB_PORT')]:
+		if os.getenv(name):
+			env[var] = os.getenv(name)
+	return env
+
+def available_compressions():
+	return [name for name in COMPRESSIONS if name != 'zstd' or zstandard is not None]
+
+def _compressor(compression):
+	if compression == 'gzip':
+		return zlib.compressobj(6, zlib.DEFLATED, 31)
+	if compression == 'zstd' and zstandard is not None:
+		return zstandard.ZstdCompressor(level=3).compressobj()
+	if compression:
+		raise BackupError(f'unsupported compression: {compression}')
+	return None
+
+def dump_filename(fmt, compression=None):
+	name = f"backup-{datetime.now():%Y%m%d-%H%M%S}.{FORMATS[fmt][1]}"
+	return f'{name}.{COMPRESSIONS[compression]}' if compression else name
+
+def stream_dump(fmt='custom', compression=None):
+	# Вывод pg_dump идёт прямо в ответ кусками: память постоянна, временных файлов нет
+	if fmt not in FORMATS:
+		raise BackupError(f'unsupported format: {fmt}')
+	compressor = _compressor(compression)
+	args = ['pg_dump', '-F', FORMATS[fmt][0]]
+	if compressor is not None and fmt == 'custom':
+		# Не сжимаем дважды
+		args += ['-Z', '0']
+	proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=_pg_env())
+	stderr = deque(maxlen=50)
+	drain = threading.Thread(target=lambda: stderr.extend(proc.stderr), daemon=True)
+	drain.start()
+	status = {'id': uuid.uuid4().hex, 'format': fmt, 'compression': compression, 'started': time.time(),
+			'bytes': 0, 'sent': 0, 'state': 'running', 'error': None}
+	with _streams_lock:
+		_streams[status['id']] = status
+	try:
+		for chunk in iter(lambda: proc.stdout.read1(BACKUP_CHUNK_SIZE), b''):
+			status['bytes'] += len(chunk)
+			if compressor is not None:
+				chunk = compressor.compress(chunk)
+			if chunk:
+				status['sent'] += len(chunk)
+				yield chunk
+		if compressor is not None:
+			tail = compressor.flush()
+			status['sent'] += len(tail)
+			yield tail
+		if proc.wait() != 0:
+			drain.join(1)
+			raise BackupError(b''.join(stderr).decode(errors='replace').strip() or 'pg_dump failed')
+		status['state'] = 'done'
+	except BaseException as e:
+		# В том числе GeneratorExit, если клиент оборвал загрузку
+		status['state'] = 'failed'
+		status['error'] = str(e) or type(e).__name__
+		raise
+	finally:
+		if proc.poll() is None:
+			proc.kill()
+			proc.wait()
+		status['finished'] = time.time()
+
+def scheduled_backup():
+	# Формат directory с параллельным pg_dump -j, каталог появляется атомарно после завершения
+	backups = list_backups()
+	if backups and time.time() - backups[0]['created'] < BACKUP_INTERVAL / 2:
+		# Другой воркер уже сделал копию в этом интервале
+		return None
+	os.makedirs(BACKUP_DIR, exist_ok=True)
+	name = f"backup-{datetime.now():%Y%m%d-%H%M%S}"
+	partial = os.path.join(BACKUP_DIR, f'.{name}.partial')
+	result = subprocess.run(['pg_dump', '-F', 'd', '-j', str(BACKUP_JOBS), '-f', partial],
+			capture_output=True, env=_pg_env())
+	if result.returncode != 0:
+		shutil.rmtree(partial, ignore_errors=True)
+		raise BackupError(result.stderr.decode(errors='replace').strip())
+	os.rename(partial, os.path.join(BACKUP_DIR, name))
+	for stale in list_backups()[BACKUP_KEEP:]:
+		shutil.rmtree(os.path.join(BACKUP_DIR, stale['name']), ignore_errors=True)
+	return name
+
+def list_backups():
+	if not os.path.isdir(BACKUP_DIR):
+		return []
+	backups = []
+	for name in sorted(os.listdir(BACKUP_DIR), reverse=True):
+		path = os.path.join(BACKUP_DIR, name)
+		if name.startswith('backup-') and os.path.isdir(path):
+			size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+			backups.append({'name': name, 'bytes': size, 'created': os.path.getmtime(path)})
+	return backups
+
+if BACKUP_INTERVAL > 0:
+	every('backup', BACKUP_INTERVAL, scheduled_backup, exclusive=True)
+
+def backup_status():
+	with _streams_lock:
+		# Завершённые загрузки старше часа не показываем
+		for stream_id in [i for i, s in _streams.items() if s.get('finished', time.time()) < time.time() - 3600]:
+			del _streams[stream_id]
+		streams = [dict(status) for status in _streams.values()]
+	return {'streams': streams, 'backups': list_backups(), 'schedule': job_stats().get('backup')}
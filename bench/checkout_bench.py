@@ -0,0 +1,125 @@
+# Параллельное оформление заказов на одни и те же «горячие» товары: каждый
+# заказ резервирует позиции в корзине (reserve_cart_item) и оформляет их.
+# Нужна база со схемой из schema.sql (DB_* из .env); тестовые данные
+# создаются с префиксом bench-checkout и удаляются после замера:
+#   python bench/checkout_bench.py --workers 32 --duration 30 --products 5
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from datetime import timedelta
+
+import psycopg2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import get_db_connection
+
+PREFIX = 'bench-checkout'
+HOLD = timedelta(minutes=5)
+
+def setup(cur, workers, products, stock):
+	cur.execute("INSERT INTO users (name, email, password, role) VALUES (%s, %s, '-', 'seller') RETURNING id",
+			(PREFIX, f'{PREFIX}-seller@example.com'))
+	seller_id = cur.fetchone()[0]
+	cur.execute("""
+		INSERT INTO products (name, description, price, quantity, image_urls, seller_id)
+		SELECT %s || ' ' || i, '', 10, %s, '{}', %s FROM generate_series(1, %s) AS i
+		RETURNING id
+	""", (PREFIX, stock, seller_id, products))
+	product_ids = [row[0] for row in cur.fetchall()]
+	cur.execute("""
+		INSERT INTO users (name, email, password, role)
+		SELECT %s, %s || '-' || i || '@example.com', '-', 'customer' FROM generate_series(1, %s) AS i
+		RETURNING id
+	""", (PREFIX, PREFIX, workers))
+	customer_ids = [row[0] for row in cur.fetchall()]
+	return product_ids, customer_ids
+
+def cleanup(cur):
+	cur.execute("SELECT id FROM users WHERE email LIKE %s", (f'{PREFIX}-%',))
+	user_ids = [row[0] for row in cur.fetchall()]
+	cur.execute("DELETE FROM order_items WHERE order_id IN (SELECT id FROM orders WHERE user_id = ANY(%s))", (user_ids,))
+	cur.execute("DELETE FROM orders WHERE user_id = ANY(%s)", (user_ids,))
+	cur.execute("""
+		WITH removed AS (DELETE FROM cart WHERE user_id = ANY(%s) RETURNING product_id, quantity, reserved_until)
+		UPDATE products p SET reserved = p.reserved - r.quantity
+		FROM removed r WHERE p.id = r.product_id AND r.reserved_until IS NOT NULL
+	""", (user_ids,))
+	cur.execute("DELETE FROM logs WHERE user_id = ANY(%s)", (user_ids,))
+	cur.execute("DELETE FROM products WHERE seller_id = ANY(%s)", (user_ids,))
+	# Триггер на products пишет в logs при удалении товаров
+	cur.execute("DELETE FROM logs WHERE user_id = ANY(%s)", (user_ids,))
+	cur.execute("DELETE FROM users WHERE id = ANY(%s)", (user_ids,))
+
+def worker(customer_id, product_ids, items_per_order, deadline, result):
+	conn = get_db_connection()
+	cur = conn.cursor()
+	while time.monotonic() < deadline:
+		# Случайный порядок позиций — худший случай для взаимоблокировок
+		cart = random.sample(product_ids, items_per_order)
+		start = time.perf_counter()
+		try:
+			for product_id in cart:
+				cur.execute("SELECT reserved FROM reserve_cart_item(%s, %s, 1, %s)", (customer_id, product_id, HOLD))
+				reserved = cur.fetchone()[0]
+				conn.commit()
+				if not reserved:
+					result['unavailable'] += 1
+			cur.execute("CALL create_order_with_items(%s, %s)", (customer_id, 'bench'))
+			conn.commit()
+			result['latencies'].append((time.perf_counter() - start) * 1000)
+		except psycopg2.Error as e:
+			conn.rollback()
+			key = 'deadlocks' if e.pgcode == '40P01' else 'errors'
+			result[key] += 1
+	conn.close()
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--workers', type=int, default=32)
+	parser.add_argument('--duration', type=float, default=30)
+	parser.add_argument('--products', type=int, default=5)
+	parser.add_argument('--items', type=int, default=3, help='позиций в одном заказе')
+	parser.add_argument('--stock', type=int, default=10 ** 9)
+	args = parser.parse_args()
+	conn = get_db_connection()
+	cur = conn.cursor()
+	product_ids, customer_ids = setup(cur, args.workers, args.products, args.stock)
+	conn.commit()
+	results = [{'latencies': [], 'deadlocks': 0, 'errors': 0, 'unavailable': 0} for _ in customer_ids]
+	deadline = time.monotonic() + args.duration
+	threads = [
+		threading.Thread(target=worker, args=(customer_id, product_ids, min(args.items, args.products), deadline, result))
+		for customer_id, result in zip(customer_ids, results)
+	]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	latencies = sorted(latency for result in results for latency in result['latencies'])
+	report = {
+		'workers': args.workers,
+		'hot_products': args.products,
+		'items_per_order': min(args.items, args.products),
+		'duration_s': args.duration,
+		'orders': len(latencies),
+		'orders_per_s': round(len(latencies) / args.duration, 1),
+		'deadlocks': sum(result['deadlocks'] for result in results),
+		'errors': sum(result['errors'] for result in results),
+		'unavailable': sum(result['unavailable'] for result in results),
+	}
+	if latencies:
+		report['median_ms'] = round(statistics.median(latencies), 3)
+		report['p95_ms'] = round(latencies[int(len(latencies) * 0.95) - 1], 3)
+		report['p99_ms'] = round(latencies[int(len(latencies) * 0.99) - 1], 3)
+	cleanup(cur)
+	conn.commit()
+	conn.close()
+	print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+	main()
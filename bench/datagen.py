@@ -0,0 +1,173 @@
+# Синтетические данные для замеров: пользователи всех ролей, товары с картинками,
+# корзины, заказы с позициями, доставки и журнал. Объём задаётся --scale
+# (1 — около 2 млн строк, 10 — десятки миллионов). Генерация идёт целиком
+# на стороне сервера через generate_series, с фиксированным --seed.
+# База должна быть отдельной (DB_* из .env), --reset очищает её таблицы:
+#   python bench/datagen.py --scale 1 --reset
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import get_db_connection
+
+# Пароль всех сгенерированных пользователей; почта — bench-<роль>-<номер>@example.com
+PASSWORD = 'bench'
+
+WORDS = ['молоко', 'хлеб', 'сыр', 'кофе', 'чай', 'пицца', 'суши', 'бургер', 'салат', 'сок',
+	'шоколад', 'печенье', 'яблоко', 'банан', 'курица', 'рыба', 'рис', 'паста', 'соус', 'вода']
+
+TABLES = ['delivery', 'order_items', 'orders', 'cart', 'logs', 'sessions', 'seller_orders', 'seller_order_stats', 'products', 'users']
+
+def sizes(scale):
+	return {
+		'customers': int(10000 * scale),
+		'sellers': max(int(200 * scale), 1),
+		'couriers': max(int(500 * scale), 1),
+		'admins': 5,
+		'products': int(50000 * scale),
+		'carts': int(2000 * scale),
+		'orders': int(200000 * scale),
+		'logs': int(1000000 * scale),
+	}
+
+STEPS = [
+	('users', """
+		INSERT INTO users (name, email, password, role)
+		SELECT 'Bench ' || r.role || ' ' || i, 'bench-' || r.role || '-' || i || '@example.com', %(password)s, r.role
+		FROM (VALUES ('customer', %(customers)s), ('seller', %(sellers)s), ('courier', %(couriers)s), ('admin', %(admins)s)) AS r(role, n),
+			generate_series(1, r.n) AS i
+	"""),
+	('ids', """
+		CREATE TEMP TABLE bench_users AS
+			SELECT role, row_number() OVER (PARTITION BY role ORDER BY id) AS n, id FROM users;
+		CREATE INDEX ON bench_users (role, n);
+		ANALYZE bench_users
+	"""),
+	('products', """
+		INSERT INTO products (name, description, price, quantity, image_urls, seller_id)
+		SELECT words.w[1 + g.i %% 20] || ' ' || words.w[1 + (g.i / 20) %% 20] || ' ' || g.i,
+			'Свежий продукт: ' || words.w[1 + (g.i * 7) %% 20] || ', ' || words.w[1 + (g.i * 13) %% 20],
+			round((10 + random() * 990)::numeric, 2),
+			1000000,
+			ARRAY(SELECT '/static/uploads/bench-' || g.i || '-' || k || '.jpg' FROM generate_series(1, 1 + g.i %% 4) AS k),
+			u.id
+		FROM (SELECT i, 1 + floor(random() * %(sellers)s)::int AS seller FROM generate_series(1, %(products)s) AS i) AS g
+		JOIN bench_users u ON u.role = 'seller' AND u.n = g.seller
+		CROSS JOIN (SELECT %(words)s::text[] AS w) AS words
+	"""),
+	('product_ids', """
+		CREATE TEMP TABLE bench_products AS
+			SELECT row_number() OVER (ORDER BY id) AS n, id, price FROM products;
+		CREATE INDEX ON bench_products (n);
+		ANALYZE bench_products
+	"""),
+	('cart', """
+		INSERT INTO cart (user_id, product_id, quantity)
+		SELECT u.id, p.id, 1 + k %% 3
+		FROM bench_users u
+		CROSS JOIN LATERAL generate_series(1, 1 + u.n %% 3) AS k
+		JOIN bench_products p ON p.n = 1 + (u.n * 31 + k) %% %(products)s
+		WHERE u.role = 'customer' AND u.n <= %(carts)s
+	"""),
+	('orders', """
+		INSERT INTO orders (user_id, total_price, delivery_address, status, created_at)
+		SELECT u.id, 0, 'ул. Тестовая, ' || g.i,
+			(ARRAY['pending', 'paid', 'paid', 'in_delivery', 'completed', 'completed', 'completed', 'completed', 'completed', 'completed'])[1 + g.i %% 10],
+			now() - random() * interval '365 days'
+		FROM (SELECT i, 1 + floor(random() * %(customers)s)::int AS customer FROM generate_series(1, %(orders)s) AS i) AS g
+		JOIN bench_users u ON u.role = 'customer' AND u.n = g.customer
+	"""),
+	('order_items', """
+		INSERT INTO order_items (order_id, product_id, quantity, price)
+		SELECT o.id, p.id, 1 + k %% 3, p.price
+		FROM orders o
+		CROSS JOIN LATERAL generate_series(1, 1 + o.id %% 5) AS k
+		JOIN bench_products p ON p.n = 1 + (o.id * 7919 + k) %% %(products)s
+	"""),
+	('order_totals', """
+		UPDATE orders o SET total_price = t.total
+		FROM (SELECT order_id, sum(quantity * price) AS total FROM order_items GROUP BY order_id) AS t
+		WHERE o.id = t.order_id
+	"""),
+	('delivery', """
+		INSERT INTO delivery (order_id, courier_id, status, estimated_delivery, delivered_at)
+		SELECT o.id, u.id,
+			CASE WHEN o.status = 'completed' THEN 'delivered' ELSE 'assigned' END,
+			o.created_at + interval '2 hours',
+			CASE WHEN o.status = 'completed' THEN o.created_at + interval '90 minutes' END
+		FROM (SELECT id, status, created_at, 1 + floor(random() * %(couriers)s)::int AS courier
+			FROM orders WHERE status IN ('in_delivery', 'completed')) AS o
+		JOIN bench_users u ON u.role = 'courier' AND u.n = o.courier
+	"""),
+	# Секции журнала за год истории, иначе строки лягут в logs_default
+	('log_partitions', """
+		SELECT create_logs_partition(month::date)
+		FROM generate_series(date_trunc('month', now() - interval '365 days'), date_trunc('month', now()), interval '1 month') AS month
+	"""),
+	('logs', """
+		INSERT INTO logs (user_id, action, timestamp)
+		SELECT u.id,
+			(ARRAY['User logged in', 'Added product to cart', 'Removed product from cart', 'Order paid', 'User logged out'])[1 + g.i %% 5] || ' #' || g.i,
+			now() - random() * interval '365 days'
+		FROM (SELECT i, 1 + floor(random() * %(customers)s)::int AS customer FROM generate_series(1, %(logs)s) AS i) AS g
+		JOIN bench_users u ON u.role = 'customer' AND u.n = g.customer
+	"""),
+	# Триггеры отключены, производные таблицы собираются целиком
+	('seller_rollups', """
+		TRUNCATE seller_orders, seller_order_stats;
+		INSERT INTO seller_orders SELECT * FROM seller_orders_source;
+		INSERT INTO seller_order_stats (seller_id, status, orders, revenue)
+			SELECT seller_id, status, count(*), sum(seller_revenue) FROM seller_orders GROUP BY seller_id, status
+	"""),
+]
+
+def reset(cur):
+	cur.execute(f"TRUNCATE {', '.join(TABLES)} RESTART IDENTITY CASCADE")
+
+def generate(conn, scale, seed=0.42, log=print):
+	params = dict(sizes(scale), password=hashlib.sha256(PASSWORD.encode()).hexdigest(), words=WORDS)
+	cur = conn.cursor()
+	# Построчные триггеры (журнал, сводки) на миллионах строк стоят дороже самой
+	# вставки; replica их отключает, нужны права суперпользователя
+	cur.execute("SET session_replication_role = replica")
+	cur.execute("SELECT setseed(%s)", (seed,))
+	report = {}
+	for name, sql in STEPS:
+		start = time.monotonic()
+		cur.execute(sql, params)
+		conn.commit()
+		report[name] = round(time.monotonic() - start, 2)
+		log(f'{name}: {report[name]}s')
+	conn.autocommit = True
+	cur.execute(f"VACUUM ANALYZE {', '.join(TABLES)}")
+	conn.autocommit = False
+	return report
+
+def row_counts(cur):
+	counts = {}
+	for table in TABLES:
+		cur.execute(f"SELECT count(*) FROM {table}")
+		counts[table] = cur.fetchone()[0]
+	return counts
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--scale', type=float, default=1)
+	parser.add_argument('--seed', type=float, default=0.42)
+	parser.add_argument('--reset', action='store_true', help='очистить таблицы перед генерацией')
+	args = parser.parse_args()
+	conn = get_db_connection()
+	cur = conn.cursor()
+	if args.reset:
+		reset(cur)
+		conn.commit()
+	timings = generate(conn, args.scale, args.seed, log=lambda line: print(line, file=sys.stderr))
+	print(json.dumps({'scale': args.scale, 'seconds': timings, 'rows': row_counts(cur)}, indent=2))
+	conn.close()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,120 @@
+# Нагрузочный тест HTTP: запросов в секунду и задержки для dev-сервера (main.py)
+# и gunicorn (gunicorn.conf.py). Нужна рабочая база и существующий пользователь:
+#   python bench/http_load.py --server both --email c@example.com --password secret \
+#       --paths / /customer --concurrency 32 --duration 30
+import argparse
+import http.client
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# main.py всегда слушает 0.0.0.0:5723, поэтому для --server dev/both --url должен указывать на этот порт
+SERVERS = {
+	'dev': ['python3', 'main.py'],
+	'gunicorn': ['gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'],
+}
+
+def wait_for_port(host, port, timeout=30):
+	deadline = time.monotonic() + timeout
+	while time.monotonic() < deadline:
+		try:
+			socket.create_connection((host, port), 1).close()
+			return
+		except OSError:
+			time.sleep(0.2)
+	raise SystemExit(f'server on {host}:{port} did not start')
+
+def login(host, port, email, password):
+	conn = http.client.HTTPConnection(host, port, timeout=10)
+	body = urllib.parse.urlencode({'email': email, 'password': password})
+	conn.request('POST', '/login', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+	response = conn.getresponse()
+	response.read()
+	cookie = response.getheader('Set-Cookie', '')
+	if response.status != 302 or not cookie:
+		raise SystemExit('login failed, check --email/--password')
+	return cookie.split(';', 1)[0]
+
+def client(host, port, paths, cookie, deadline, result):
+	# Постоянное соединение (keep-alive), как у браузера
+	conn = http.client.HTTPConnection(host, port, timeout=30)
+	i = 0
+	while time.monotonic() < deadline:
+		path = paths[i % len(paths)]
+		i += 1
+		start = time.perf_counter()
+		try:
+			conn.request('GET', path, headers={'Cookie': cookie})
+			response = conn.getresponse()
+			response.read()
+		except (OSError, http.client.HTTPException):
+			result['errors'] += 1
+			conn.close()
+			conn = http.client.HTTPConnection(host, port, timeout=30)
+			continue
+		if response.status >= 400:
+			result['errors'] += 1
+		result['latencies'].append((time.perf_counter() - start) * 1000)
+	conn.close()
+
+def run_load(host, port, args):
+	cookie = login(host, port, args.email, args.password)
+	results = [{'latencies': [], 'errors': 0} for _ in range(args.concurrency)]
+	deadline = time.monotonic() + args.duration
+	threads = [threading.Thread(target=client, args=(host, port, args.paths, cookie, deadline, result)) for result in results]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	latencies = sorted(latency for result in results for latency in result['latencies'])
+	report = {'requests': len(latencies), 'errors': sum(result['errors'] for result in results),
+			'rps': round(len(latencies) / args.duration, 1)}
+	if latencies:
+		report.update({
+			'median_ms': round(statistics.median(latencies), 2),
+			'p95_ms': round(latencies[int(len(latencies) * 0.95) - 1], 2),
+			'p99_ms': round(latencies[int(len(latencies) * 0.99) - 1], 2),
+		})
+	return report
+
+def run_server(name, host, port, args):
+	proc = subprocess.Popen(SERVERS[name], cwd=ROOT, env=dict(os.environ, WEB_BIND=f'{host}:{port}'),
+			stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+	try:
+		wait_for_port(host, port)
+		run_load(host, port, argparse.Namespace(**dict(vars(args), duration=min(5, args.duration))))  # прогрев
+		return run_load(host, port, args)
+	finally:
+		os.killpg(proc.pid, signal.SIGTERM)
+		proc.wait()
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--server', choices=['none', 'dev', 'gunicorn', 'both'], default='none',
+			help='запустить сервер самостоятельно; none — нагружать уже запущенный --url')
+	parser.add_argument('--url', default='http://127.0.0.1:5723')
+	parser.add_argument('--email', required=True)
+	parser.add_argument('--password', required=True)
+	parser.add_argument('--paths', nargs='+', default=['/'])
+	parser.add_argument('--concurrency', type=int, default=32)
+	parser.add_argument('--duration', type=float, default=30)
+	args = parser.parse_args()
+	url = urllib.parse.urlsplit(args.url)
+	host, port = url.hostname, url.port or 80
+	if args.server == 'none':
+		report = run_load(host, port, args)
+	else:
+		names = ['dev', 'gunicorn'] if args.server == 'both' else [args.server]
+		report = {name: run_server(name, host, port, args) for name in names}
+	print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+	main()
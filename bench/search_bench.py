@@ -0,0 +1,104 @@
+# Сравнение поиска товаров: старый ILIKE '%term%' против tsvector + pg_trgm.
+# Каталог генерируется в отдельной схеме bench_search той же базы (DB_* из .env):
+#   python bench/search_bench.py --rows 1000000 --repeat 20
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import get_db_connection, _search_tsquery
+
+WORDS = ['молоко', 'хлеб', 'сыр', 'кофе', 'чай', 'пицца', 'суши', 'бургер', 'салат', 'сок',
+	'шоколад', 'печенье', 'яблоко', 'банан', 'курица', 'рыба', 'рис', 'паста', 'соус', 'вода']
+
+SETUP = """
+DROP SCHEMA IF EXISTS bench_search CASCADE;
+CREATE SCHEMA bench_search;
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE TABLE bench_search.products (
+	id SERIAL PRIMARY KEY,
+	name TEXT NOT NULL,
+	description TEXT,
+	price DECIMAL NOT NULL,
+	quantity INTEGER NOT NULL,
+	image_urls TEXT[],
+	seller_id INTEGER,
+	search_vector tsvector GENERATED ALWAYS AS (
+		setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+		setweight(to_tsvector('simple', coalesce(description, '')), 'B')
+	) STORED
+);
+INSERT INTO bench_search.products (name, description, price, quantity, image_urls, seller_id)
+SELECT
+	(%(words)s)[1 + (random() * 19)::int] || ' ' || (%(words)s)[1 + (random() * 19)::int] || ' ' || i,
+	'Описание ' || (%(words)s)[1 + (random() * 19)::int] || ' ' || md5(i::text),
+	(random() * 1000)::numeric(10, 2),
+	(random() * 100)::int,
+	ARRAY['static/uploads/' || i || '.jpg'],
+	1 + (random() * 99)::int
+FROM generate_series(1, %(rows)s) AS i;
+CREATE INDEX ON bench_search.products(name);
+CREATE INDEX ON bench_search.products USING GIN (search_vector);
+CREATE INDEX ON bench_search.products USING GIN (name gin_trgm_ops);
+ANALYZE bench_search.products;
+"""
+
+ILIKE_QUERY = """
+	SELECT id, name, description, price, quantity, image_urls
+	FROM bench_search.products
+	WHERE name ILIKE %(like)s OR description ILIKE %(like)s
+"""
+
+SEARCH_QUERY = """
+	SELECT id, name, description, price, quantity, image_urls
+	FROM bench_search.products p
+	WHERE p.search_vector @@ to_tsquery('simple', %(tsquery)s) OR %(search)s <%% p.name
+	ORDER BY ts_rank(p.search_vector, to_tsquery('simple', %(tsquery)s))
+		+ word_similarity(%(search)s, p.name) DESC, p.id
+	LIMIT %(limit)s
+"""
+
+TERMS = ['молоко', 'шокол', 'кофе чай', 'пица', 'бургер 123']
+
+def measure(cur, query, params, repeat):
+	timings = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		cur.execute(query, params)
+		cur.fetchall()
+		timings.append((time.perf_counter() - start) * 1000)
+	timings.sort()
+	return {
+		'median_ms': round(statistics.median(timings), 3),
+		'p95_ms': round(timings[int(len(timings) * 0.95) - 1], 3),
+		'rows': cur.rowcount,
+	}
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--rows', type=int, default=1000000)
+	parser.add_argument('--repeat', type=int, default=20)
+	parser.add_argument('--limit', type=int, default=50)
+	parser.add_argument('--keep', action='store_true', help='не удалять схему bench_search после замера')
+	args = parser.parse_args()
+	conn = get_db_connection()
+	conn.autocommit = True
+	cur = conn.cursor()
+	start = time.perf_counter()
+	cur.execute(SETUP, {'words': WORDS, 'rows': args.rows})
+	report = {'rows': args.rows, 'setup_s': round(time.perf_counter() - start, 1), 'terms': {}}
+	for term in TERMS:
+		report['terms'][term] = {
+			'ilike': measure(cur, ILIKE_QUERY, {'like': f'%{term}%'}, args.repeat),
+			'search': measure(cur, SEARCH_QUERY, {'search': term, 'tsquery': _search_tsquery(term), 'limit': args.limit}, args.repeat),
+		}
+	if not args.keep:
+		cur.execute("DROP SCHEMA bench_search CASCADE")
+	conn.close()
+	print(json.dumps(report, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+	main()
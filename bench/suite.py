@@ -0,0 +1,238 @@
+# Набор замеров для сравнения коммитов: страницы Flask через тестовый клиент
+# (полный стек приложения без сети) и функции db.py напрямую, с заданной
+# параллельностью. Результат — JSON с перцентилями задержки и пропускной
+# способностью; --compare сравнивает с сохранённым прогоном.
+# --local-pg поднимает временный PostgreSQL (initdb/pg_ctl из PATH), применяет
+# schema.sql и генерирует данные bench/datagen.py:
+#   python bench/suite.py --local-pg --scale 0.5 --concurrency 8 --duration 10 --output HEAD.json
+#   python bench/suite.py --scenarios index courier --compare HEAD.json
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import datagen
+import db
+
+def free_port():
+	with socket.socket() as s:
+		s.bind(('127.0.0.1', 0))
+		return s.getsockname()[1]
+
+def start_local_postgres(directory):
+	data = os.path.join(directory, 'data')
+	port = free_port()
+	quiet = {'stdout': subprocess.DEVNULL, 'check': True}
+	subprocess.run(['initdb', '-D', data, '-A', 'trust', '-U', 'postgres', '-E', 'UTF8'], **quiet)
+	subprocess.run(['pg_ctl', '-D', data, '-l', os.path.join(directory, 'postgres.log'), '-w', 'start',
+			'-o', f"-p {port} -k {directory} -c listen_addresses=''"], **quiet)
+	subprocess.run(['createdb', '-h', directory, '-p', str(port), '-U', 'postgres', 'bench'], **quiet)
+	subprocess.run(['psql', '-q', '-v', 'ON_ERROR_STOP=1', '-h', directory, '-p', str(port), '-U', 'postgres',
+			'-d', 'bench', '-f', os.path.join(ROOT, 'schema.sql')], **quiet)
+	# db.py читает DB_* при каждом подключении, load_dotenv() их не перезаписывает
+	os.environ.update(DB_NAME='bench', DB_USER='postgres', DB_PASSWORD='', DB_HOST=directory, DB_PORT=str(port))
+	return data
+
+def stop_local_postgres(data):
+	subprocess.run(['pg_ctl', '-D', data, '-m', 'fast', 'stop'], stdout=subprocess.DEVNULL)
+
+class Context:
+	# Данные, общие для всех потоков сценария: id из сгенерированной базы
+	def __init__(self, cur, scale):
+		cur.execute("SELECT id FROM users WHERE role = 'seller' ORDER BY id LIMIT 100")
+		self.seller_ids = [row[0] for row in cur.fetchall()]
+		cur.execute("SELECT id FROM users WHERE role = 'customer' ORDER BY id LIMIT 100")
+		self.customer_ids = [row[0] for row in cur.fetchall()]
+		cur.execute("SELECT id FROM products ORDER BY id LIMIT 1000")
+		self.product_ids = [row[0] for row in cur.fetchall()]
+		self.sizes = datagen.sizes(scale)
+
+def login(client, role, n):
+	response = client.post('/login', data={'email': f'bench-{role}-{n}@example.com', 'password': datagen.PASSWORD})
+	if response.status_code != 302:
+		raise SystemExit(f'cannot log in as bench-{role}-{n}, generate data with bench/datagen.py')
+
+def get(path):
+	def run(client, ctx, rng):
+		return client.get(path).status_code
+	return run
+
+def search(client, ctx, rng):
+	return client.get('/', query_string={'search': rng.choice(datagen.WORDS)}).status_code
+
+def checkout(client, ctx, rng):
+	status = client.post('/', data={'product_id': rng.choice(ctx.product_ids), 'quantity': 1}).status_code
+	if status >= 400:
+		return status
+	return client.post('/customer', data={'action': 'checkout', 'delivery_address': 'bench'}).status_code
+
+def db_call(name, args):
+	def run(client, ctx, rng):
+		getattr(db, name)(*args(ctx, rng))
+		return 200
+	return run
+
+# имя: (роль для входа или None для функций db.py, операция)
+SCENARIOS = {
+	'index': ('customer', get('/')),
+	'index_search': ('customer', search),
+	'checkout': ('customer', checkout),
+	'customer': ('customer', get('/customer')),
+	'courier': ('courier', get('/courier')),
+	'seller_orders': ('seller', get('/seller/orders')),
+	'admin_logs': ('admin', get('/admin/logs')),
+	'db.search_products': (None, db_call('search_products', lambda ctx, rng: (rng.choice(datagen.WORDS),))),
+	'db.get_user_orders': (None, db_call('get_user_orders', lambda ctx, rng: (rng.choice(ctx.customer_ids),))),
+	'db.get_seller_orders': (None, db_call('get_seller_orders', lambda ctx, rng: (rng.choice(ctx.seller_ids),))),
+	'db.get_available_orders': (None, db_call('get_available_orders', lambda ctx, rng: ())),
+	'db.get_logs': (None, db_call('get_logs', lambda ctx, rng: ())),
+}
+
+def worker(app, role, n, operation, ctx, seed, deadline, result):
+	rng = random.Random(seed)
+	client = app.test_client()
+	if role:
+		login(client, role, n)
+	while time.monotonic() < deadline:
+		start = time.perf_counter()
+		try:
+			status = operation(client, ctx, rng)
+		except Exception:
+			status = 500
+		elapsed = (time.perf_counter() - start) * 1000
+		if status >= 400:
+			result['errors'] += 1
+		else:
+			result['latencies'].append(elapsed)
+
+def percentile(latencies, p):
+	return round(latencies[max(int(len(latencies) * p) - 1, 0)], 3)
+
+def run_scenario(app, ctx, name, concurrency, duration, seed):
+	role, operation = SCENARIOS[name]
+	# Пользователи роли берутся по кругу (администраторов всего 5)
+	population = ctx.sizes[role + 's'] if role else 1
+	results = [{'latencies': [], 'errors': 0} for _ in range(concurrency)]
+	deadline = time.monotonic() + duration
+	threads = [
+		threading.Thread(target=worker, args=(app, role, 1 + i % population, operation, ctx, seed + i, deadline, result))
+		for i, result in enumerate(results)
+	]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	latencies = sorted(latency for result in results for latency in result['latencies'])
+	report = {
+		'ops': len(latencies),
+		'errors': sum(result['errors'] for result in results),
+		'ops_per_s': round(len(latencies) / duration, 1),
+	}
+	if latencies:
+		report.update({
+			'mean_ms': round(statistics.fmean(latencies), 3),
+			'p50_ms': percentile(latencies, 0.5),
+			'p90_ms': percentile(latencies, 0.9),
+			'p95_ms': percentile(latencies, 0.95),
+			'p99_ms': percentile(latencies, 0.99),
+			'max_ms': round(latencies[-1], 3),
+		})
+	return report
+
+def git_commit():
+	try:
+		return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def compare(report, baseline, threshold):
+	# Регрессия — рост p95 или падение пропускной способности больше threshold
+	changes = {}
+	regressions = []
+	for name, current in report['scenarios'].items():
+		before = baseline['scenarios'].get(name)
+		if not before or not before.get('p95_ms') or not current.get('p95_ms'):
+			continue
+		p95 = current['p95_ms'] / before['p95_ms'] - 1
+		throughput = current['ops_per_s'] / before['ops_per_s'] - 1 if before['ops_per_s'] else 0
+		changes[name] = {'p95': f'{p95:+.1%}', 'ops_per_s': f'{throughput:+.1%}'}
+		if p95 > threshold or throughput < -threshold:
+			regressions.append(name)
+	return {'baseline_commit': baseline['meta'].get('commit'), 'changes': changes, 'regressions': regressions}
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+	parser.add_argument('--concurrency', type=int, default=8)
+	parser.add_argument('--duration', type=float, default=10)
+	parser.add_argument('--warmup', type=float, default=2)
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--local-pg', action='store_true', help='временный PostgreSQL со схемой и данными')
+	parser.add_argument('--scale', type=float, default=0.1, help='объём данных для --local-pg или --generate')
+	parser.add_argument('--generate', action='store_true', help='перегенерировать данные в базе из DB_*')
+	parser.add_argument('--output', help='сохранить JSON в файл')
+	parser.add_argument('--compare', help='JSON предыдущего прогона')
+	parser.add_argument('--threshold', type=float, default=0.1)
+	args = parser.parse_args()
+
+	tmpdir = data = None
+	if args.local_pg:
+		tmpdir = tempfile.mkdtemp(prefix='bench-pg-')
+		data = start_local_postgres(tmpdir)
+	try:
+		from app import app
+		conn = db.get_db_connection()
+		cur = conn.cursor()
+		if args.local_pg or args.generate:
+			datagen.reset(cur)
+			conn.commit()
+			datagen.generate(conn, args.scale, log=lambda line: print(line, file=sys.stderr))
+		ctx = Context(cur, args.scale)
+		cur.execute("SHOW server_version")
+		report = {
+			'meta': {
+				'commit': git_commit(),
+				'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+				'python': platform.python_version(),
+				'postgres': cur.fetchone()[0],
+				'scale': args.scale,
+				'concurrency': args.concurrency,
+				'duration_s': args.duration,
+				'rows': datagen.row_counts(cur),
+			},
+			'scenarios': {},
+		}
+		conn.close()
+		for name in args.scenarios:
+			print(f'{name}...', file=sys.stderr)
+			if args.warmup:
+				run_scenario(app, ctx, name, args.concurrency, args.warmup, args.seed)
+			report['scenarios'][name] = run_scenario(app, ctx, name, args.concurrency, args.duration, args.seed)
+	finally:
+		if data:
+			stop_local_postgres(data)
+			shutil.rmtree(tmpdir, ignore_errors=True)
+	if args.compare:
+		with open(args.compare) as f:
+			report['comparison'] = compare(report, json.load(f), args.threshold)
+	output = json.dumps(report, indent=2, ensure_ascii=False)
+	if args.output:
+		with open(args.output, 'w') as f:
+			f.write(output + '\n')
+	print(output)
+	if report.get('comparison', {}).get('regressions'):
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,207 @@
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+import socketserver
+from collections import OrderedDict
+from prometheus_client import Counter
+
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'local')
+CACHE_SOCKET = os.getenv('CACHE_SOCKET', '/tmp/food_delivery_cache.sock')
+CACHE_SOCKET_TIMEOUT = float(os.getenv('CACHE_SOCKET_TIMEOUT', 0.05))
+
+caches = {}
+
+CACHE_REQUESTS = Counter('cache_requests_total', 'Обращения к кэшу: hit, miss', ['cache', 'result'])
+CACHE_EVICTIONS = Counter('cache_evictions_total', 'Записи, вытесненные по размеру', ['cache'])
+
+class TTLCache:
+	# LRU с ограничением по времени жизни записи, живёт в памяти процесса
+	def __init__(self, name, maxsize, ttl):
+		self.name = name
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self._data = OrderedDict()
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.generation = 0
+
+	def get(self, key, default=None):
+		with self._lock:
+			item = self._data.get(key)
+			if item is None or item[1] < time.monotonic():
+				if item is not None:
+					del self._data[key]
+				self.misses += 1
+				CACHE_REQUESTS.labels(self.name, 'miss').inc()
+				return default
+			self._data.move_to_end(key)
+			self.hits += 1
+			CACHE_REQUESTS.labels(self.name, 'hit').inc()
+			return item[0]
+
+	def set(self, key, value, ttl=None, generation=None):
+		# generation защищает от записи значения, прочитанного до очистки кэша
+		with self._lock:
+			if generation is not None and generation != self.generation:
+				return
+			self._data[key] = (value, time.monotonic() + (ttl or self.ttl))
+			self._data.move_to_end(key)
+			while len(self._data) > self.maxsize:
+				self._data.popitem(last=False)
+				self.evictions += 1
+				CACHE_EVICTIONS.labels(self.name).inc()
+
+	def delete(self, key):
+		# Сброс записи тоже отменяет запись значений, прочитанных до него
+		with self._lock:
+			self._data.pop(key, None)
+			self.generation += 1
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+			self.generation += 1
+
+	def stats(self):
+		with self._lock:
+			return {
+				'backend': 'local',
+				'size': len(self._data),
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+			}
+
+class SocketCache:
+	# Клиент общего кэша (python cache.py serve): все процессы-воркеры видят
+	# одни и те же записи и одну инвалидацию. Значения должны сериализоваться в JSON.
+	# При недоступности сервера кэш работает как всегда пустой.
+	def __init__(self, name, ttl, path=CACHE_SOCKET, timeout=CACHE_SOCKET_TIMEOUT):
+		self.name = name
+		self.ttl = ttl
+		self.path = path
+		self.timeout = timeout
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.errors = 0
+		# Сброс делает процесс, изменивший запись, поэтому поколения не нужны
+		self.generation = None
+
+	def _connection(self):
+		conn = getattr(self._local, 'conn', None)
+		if conn is None or self._local.pid != os.getpid():
+			sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			sock.settimeout(self.timeout)
+			sock.connect(self.path)
+			conn = self._local.conn = sock.makefile('rwb')
+			self._local.pid = os.getpid()
+		return conn
+
+	def _request(self, **message):
+		message['key'] = f"{self.name}:{message.get('key', '')}"
+		try:
+			conn = self._connection()
+			conn.write(json.dumps(message).encode() + b'\n')
+			conn.flush()
+			line = conn.readline()
+			if not line:
+				raise OSError('cache server closed the connection')
+			return json.loads(line)
+		except (OSError, ValueError):
+			self._local.conn = None
+			with self._lock:
+				self.errors += 1
+			return None
+
+	def get(self, key, default=None):
+		reply = self._request(op='get', key=key)
+		hit = bool(reply and reply.get('hit'))
+		with self._lock:
+			if hit:
+				self.hits += 1
+			else:
+				self.misses += 1
+		CACHE_REQUESTS.labels(self.name, 'hit' if hit else 'miss').inc()
+		return reply['value'] if hit else default
+
+	def set(self, key, value, ttl=None, generation=None):
+		self._request(op='set', key=key, value=value, ttl=ttl or self.ttl)
+
+	def delete(self, key):
+		self._request(op='delete', key=key)
+
+	def clear(self):
+		self._request(op='clear')
+
+	def stats(self):
+		with self._lock:
+			return {
+				'backend': 'socket',
+				'hits': self.hits,
+				'misses': self.misses,
+				'errors': self.errors,
+			}
+
+def make_cache(name, maxsize, ttl, shared=True):
+	if shared and CACHE_BACKEND == 'socket':
+		cache = SocketCache(name, ttl)
+	else:
+		cache = TTLCache(name, maxsize, ttl)
+	caches[name] = cache
+	return cache
+
+def cache_stats():
+	return {name: cache.stats() for name, cache in caches.items()}
+
+class _CacheRequestHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		store = self.server.store
+		for line in self.rfile:
+			try:
+				message = json.loads(line)
+				op, key = message['op'], message['key']
+			except (ValueError, KeyError):
+				return
+			reply = {'ok': True}
+			if op == 'get':
+				missing = object()
+				value = store.get(key, missing)
+				reply = {'hit': value is not missing, 'value': None if value is missing else value}
+			elif op == 'set':
+				store.set(key, message.get('value'), message.get('ttl'))
+			elif op == 'delete':
+				store.delete(key)
+			elif op == 'clear':
+				# Очищаем только пространство имён кэша, приславшего запрос
+				prefix = key
+				with store._lock:
+					for stale in [k for k in store._data if k.startswith(prefix)]:
+						del store._data[stale]
+			self.wfile.write(json.dumps(reply).encode() + b'\n')
+			self.wfile.flush()
+
+class _CacheServer(socketserver.ThreadingUnixStreamServer):
+	daemon_threads = True
+
+def serve(path, maxsize, ttl):
+	if os.path.exists(path):
+		os.unlink(path)
+	with _CacheServer(path, _CacheRequestHandler) as server:
+		server.store = TTLCache('server', maxsize, ttl)
+		server.serve_forever()
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Общий кэш для воркеров через unix-сокет')
+	parser.add_argument('command', choices=['serve'])
+	parser.add_argument('--socket', default=CACHE_SOCKET)
+	parser.add_argument('--maxsize', type=int, default=int(os.getenv('CACHE_MAXSIZE', 100000)))
+	parser.add_argument('--ttl', type=float, default=300)
+	args = parser.parse_args()
+	serve(args.socket, args.maxsize, args.ttl)
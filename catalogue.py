@@ -0,0 +1,242 @@
+import io
+import os
+import csv
+import json
+import itertools
+import queue
+import logging
+import threading
+from decimal import Decimal, InvalidOperation
+import psycopg2
+from db import import_products as merge_products, copy_products
+
+# Импорт и выгрузка каталога файлом. Строки загружаются в промежуточную таблицу
+# через COPY по мере чтения файла и сливаются в products одним запросом.
+# Формат: CSV с заголовком или JSONL с полями id, name, description, price,
+# quantity, image_urls, seller_id; с id — обновить существующий товар, без id —
+# добавить новый. image_urls в CSV разделяются |, как и при выгрузке, и могут
+# ссылаться только на уже загруженные файлы из папки загрузок.
+CATALOGUE_IMPORT_MAX_ERRORS = int(os.getenv('CATALOGUE_IMPORT_MAX_ERRORS', 50))
+CATALOGUE_EXPORT_CHUNK_SIZE = 64 * 1024
+CATALOGUE_EXPORT_QUEUE = 16
+
+FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+COPY_BATCH = 1000
+# Границы INTEGER и DECIMAL в PostgreSQL: значение за ними прервало бы COPY
+INT_MAX = 2 ** 31 - 1
+NUMERIC_MAX_DIGITS = 131072
+NUMERIC_MAX_SCALE = 16383
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+class CatalogueImportError(Exception):
+	def __init__(self, errors):
+		super().__init__(f'{len(errors)} invalid rows')
+		self.errors = errors
+
+def detect_format(filename, fmt=None):
+	if not fmt and filename:
+		fmt = filename.rsplit('.', 1)[-1].lower()
+		fmt = 'jsonl' if fmt in ('json', 'ndjson') else fmt
+	if fmt not in FORMATS:
+		raise CatalogueImportError([(0, f'unsupported format: {fmt}')])
+	return fmt
+
+def _records(stream, fmt):
+	text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+	if fmt == 'csv':
+		for line, row in enumerate(csv.DictReader(text), 2):
+			urls = row.get('image_urls')
+			yield line, dict(row, image_urls=[url for url in urls.split('|') if url] if urls else None)
+		return
+	for line, raw in enumerate(text, 1):
+		if raw.strip():
+			try:
+				record = json.loads(raw)
+			except ValueError:
+				record = None
+			yield line, record if isinstance(record, dict) else None
+
+def _integer(value, field, minimum=0):
+	if value is None or value == '':
+		return None
+	if isinstance(value, bool) or not isinstance(value, (int, str)) \
+			or not str(value).strip().lstrip('-').isdecimal() or not minimum <= int(value) <= INT_MAX:
+		raise ValueError(f'{field} must be an integer from {minimum} to {INT_MAX}')
+	return int(value)
+
+def _text(value, field):
+	if value is None or value == '':
+		return None
+	if not isinstance(value, str) or '\x00' in value:
+		raise ValueError(f'{field} must be a string')
+	return value
+
+def _price(value):
+	if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+		raise ValueError('price must be a number')
+	try:
+		price = Decimal(str(value).strip())
+	except InvalidOperation:
+		raise ValueError('price must be a number')
+	if not price.is_finite() or price < 0:
+		raise ValueError('price must be a number >= 0')
+	if price.adjusted() >= NUMERIC_MAX_DIGITS or -price.as_tuple().exponent > NUMERIC_MAX_SCALE:
+		raise ValueError('price is out of range')
+	return price
+
+def _image_urls(urls, upload_folder):
+	# Адреса потом уходят в storage.release, которая удаляет файлы рядом с ними,
+	# поэтому принимаются только существующие файлы из папки загрузок
+	if not isinstance(urls, list):
+		raise ValueError('image_urls must be a list of strings')
+	for url in urls:
+		if not isinstance(url, str) or '\x00' in url:
+			raise ValueError('image_urls must be a list of strings')
+		name = os.path.basename(url)
+		if os.path.dirname(os.path.normpath(url)) != os.path.normpath(upload_folder) or url != os.path.join(upload_folder, name) \
+				or name.startswith('.') or not os.path.isfile(url):
+			raise ValueError(f'unknown image: {url}')
+	return urls
+
+def _row(record, seller_id, upload_folder):
+	if record is None:
+		raise ValueError('malformed row')
+	name = (_text(record.get('name'), 'name') or '').strip()
+	if not name:
+		raise ValueError('name is required')
+	price = _price(record.get('price'))
+	quantity = _integer(record.get('quantity'), 'quantity')
+	if quantity is None:
+		raise ValueError('quantity is required')
+	urls = record.get('image_urls')
+	# Продавец импортирует только свои товары, администратор указывает seller_id
+	owner = seller_id if seller_id is not None else _integer(record.get('seller_id'), 'seller_id', 1)
+	return [_integer(record.get('id'), 'id', 1), name, _text(record.get('description'), 'description'), price, quantity,
+			_array(_image_urls(urls, upload_folder)) if urls is not None else None, owner]
+
+def _array(values):
+	# Литерал text[] для COPY
+	return '{' + ','.join('"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"' for value in values) + '}'
+
+class _CopySource:
+	# Файл для copy_expert: строки CSV для COPY готовятся по мере чтения,
+	# ошибки собираются с номерами строк и не прерывают загрузку
+	def __init__(self, records, seller_id, upload_folder, max_errors):
+		self._records = records
+		self._seller_id = seller_id
+		self._upload_folder = upload_folder
+		self._max_errors = max_errors
+		self._buffer = ''
+		self.rows = 0
+		self.errors = []
+
+	def _fill(self):
+		# Следующая пачка строк; False — файл закончился
+		out = io.StringIO()
+		writer = csv.writer(out, lineterminator='\n')
+		count = 0
+		try:
+			records = list(itertools.islice(self._records, COPY_BATCH))
+		except (UnicodeDecodeError, csv.Error) as e:
+			# Файл дальше не читается: ошибка без номера строки, COPY завершается
+			self.errors.append((0, f'unreadable file: {e}'))
+			records = []
+		for line, record in records:
+			count += 1
+			try:
+				writer.writerow([line] + _row(record, self._seller_id, self._upload_folder))
+				self.rows += 1
+			except ValueError as e:
+				if len(self.errors) < self._max_errors:
+					self.errors.append((line, str(e)))
+		self._buffer += out.getvalue()
+		return count > 0
+
+	def read(self, size=-1):
+		while (size < 0 or len(self._buffer) < size) and self._fill():
+			pass
+		if size < 0:
+			size = len(self._buffer)
+		data, self._buffer = self._buffer[:size], self._buffer[size:]
+		return data
+
+def import_catalogue(stream, fmt, upload_folder, seller_id=None):
+	# seller_id — импорт продавца, None — администратора (seller_id из файла).
+	# Возвращает (добавлено, обновлено, изображения прежних версий товаров)
+	source = _CopySource(_records(stream, fmt), seller_id, upload_folder, CATALOGUE_IMPORT_MAX_ERRORS)
+	try:
+		errors, added, updated, previous_urls = merge_products(source, seller_id, CATALOGUE_IMPORT_MAX_ERRORS)
+	except psycopg2.DataError as e:
+		# Значение, не прошедшее проверки выше, но отвергнутое базой; транзакция откачена
+		raise CatalogueImportError(source.errors + [(0, e.diag.message_primary or str(e))])
+	if errors:
+		raise CatalogueImportError(errors)
+	return added, updated, previous_urls
+
+class _ChunkWriter:
+	# Файл для copy_expert: собирает вывод COPY в куски для ответа
+	def __init__(self, chunks, stopped):
+		self._chunks = chunks
+		self._stopped = stopped
+		self._parts = []
+		self._size = 0
+
+	def write(self, data):
+		if isinstance(data, str):
+			data = data.encode()
+		self._parts.append(data)
+		self._size += len(data)
+		if self._size >= CATALOGUE_EXPORT_CHUNK_SIZE:
+			self.flush()
+
+	def flush(self):
+		if self._parts:
+			self._put(b''.join(self._parts))
+			self._parts, self._size = [], 0
+
+	def close(self):
+		self._put(_DONE)
+
+	def _put(self, item):
+		# Клиент отключился — COPY прерывается исключением из write
+		while True:
+			if self._stopped.is_set():
+				raise OSError('export cancelled')
+			try:
+				self._chunks.put(item, timeout=1)
+				return
+			except queue.Full:
+				continue
+
+def export_catalogue(fmt, seller_id=None):
+	# COPY ... TO STDOUT идёт в отдельном потоке, ответ читает его кусками
+	# из ограниченной очереди: память постоянна при любом размере каталога
+	chunks = queue.Queue(CATALOGUE_EXPORT_QUEUE)
+	stopped = threading.Event()
+	writer = _ChunkWriter(chunks, stopped)
+
+	def run():
+		try:
+			copy_products(writer, fmt, seller_id)
+			writer.flush()
+		except Exception:
+			if not stopped.is_set():
+				logger.exception('catalogue export failed')
+		finally:
+			try:
+				writer.close()
+			except OSError:
+				pass
+
+	threading.Thread(target=run, name='catalogue-export', daemon=True).start()
+	try:
+		while True:
+			chunk = chunks.get()
+			if chunk is _DONE:
+				return
+			yield chunk
+	finally:
+		stopped.set()
@@ -1,12 +1,40 @@
 import os
+import re
+import sys
+import json
+import time
+import base64
+import threading
+import contextvars
 import psycopg2
-from datetime import datetime
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
-import subprocess
+from flask import g, has_request_context
 load_dotenv()
+from cache import make_cache
+from notifications import Listener
+from instrumentation import InstrumentedCursor, track_function, observe_acquire, observe_pool_event, observe_pool_size
 
-def load_db_dump():
-	subprocess.run( ["pg_dump", "-U", os.getenv('DB_USER'), "-d", os.getenv('DB_NAME'), "-F", "p", "-f", 'backup.dump'], check=True)
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 2))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 20))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+DB_POOL_RECYCLE = float(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PING_AFTER = float(os.getenv('DB_POOL_PING_AFTER', 30))
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 200))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 60))
+CATALOGUE_CACHE_SIZE = int(os.getenv('CATALOGUE_CACHE_SIZE', 128))
+CATALOGUE_CACHE_TTL = float(os.getenv('CATALOGUE_CACHE_TTL', 300))
+DISPATCH_LIST_SIZE = int(os.getenv('DISPATCH_LIST_SIZE', 50))
+# Потоков на процесс для параллельных чтений gather(); 1 — всегда по очереди
+DB_GATHER_WORKERS = int(os.getenv('DB_GATHER_WORKERS', 8))
 
 def get_db_connection():
 	return psycopg2.connect(
@@ -14,360 +42,1048 @@ def get_db_connection():
 		user=os.getenv('DB_USER'),
 		password=os.getenv('DB_PASSWORD'),
 		host=os.getenv('DB_HOST'),
-		port=os.getenv('DB_PORT')
+		port=os.getenv('DB_PORT'),
+		cursor_factory=InstrumentedCursor
 	)
 
+class PoolExhausted(psycopg2.pool.PoolError):
+	pass
+
+class ConnectionPool:
+	# Потокобезопасный пул: соединения выдаются из стека свободных,
+	# при исчерпании запрос ждёт не дольше timeout секунд.
+	def __init__(self, minconn, maxconn, timeout, recycle, ping_after):
+		self.minconn = minconn
+		self.maxconn = maxconn
+		self.timeout = timeout
+		self.recycle = recycle
+		self.ping_after = ping_after
+		self.pid = os.getpid()
+		self._cond = threading.Condition()
+		self._idle = []
+		self._created = {}
+		self._size = 0
+		self.checkouts = 0
+		self.wait_time = 0.0
+		self.exhausted = 0
+		self.timeouts = 0
+		self.recycled = 0
+		self.broken = 0
+		for _ in range(minconn):
+			self._size += 1
+			self._idle.append((self._open(), time.monotonic()))
+
+	def _open(self):
+		conn = get_db_connection()
+		self._created[id(conn)] = time.monotonic()
+		return conn
+
+	def _discard(self, conn):
+		self._created.pop(id(conn), None)
+		try:
+			conn.close()
+		except psycopg2.Error:
+			pass
+		with self._cond:
+			self._size -= 1
+			self._cond.notify()
+			observe_pool_size(self._size, len(self._idle))
+
+	def _healthy(self, conn, idle_since):
+		if conn.closed:
+			return False
+		if time.monotonic() - self._created.get(id(conn), 0) > self.recycle:
+			self.recycled += 1
+			observe_pool_event('recycled')
+			return False
+		if time.monotonic() - idle_since > self.ping_after:
+			try:
+				cur = conn.cursor()
+				cur.execute("SELECT 1")
+				cur.close()
+				conn.rollback()
+			except psycopg2.Error:
+				return False
+		return True
+
+	def getconn(self):
+		start = time.monotonic()
+		deadline = start + self.timeout
+		waited = False
+		while True:
+			with self._cond:
+				while not self._idle and self._size >= self.maxconn:
+					if not waited:
+						self.exhausted += 1
+						observe_pool_event('exhausted')
+						waited = True
+					remaining = deadline - time.monotonic()
+					if remaining <= 0:
+						self.timeouts += 1
+						observe_pool_event('timeout')
+						raise PoolExhausted(f'no free connection in {self.timeout}s (max {self.maxconn})')
+					self._cond.wait(remaining)
+				if self._idle:
+					conn, idle_since = self._idle.pop()
+				else:
+					conn, idle_since = None, None
+					self._size += 1
+			if conn is None:
+				try:
+					conn = self._open()
+				except Exception:
+					with self._cond:
+						self._size -= 1
+						self._cond.notify()
+					raise
+			elif not self._healthy(conn, idle_since):
+				self.broken += 1
+				observe_pool_event('broken')
+				self._discard(conn)
+				continue
+			elapsed = time.monotonic() - start
+			with self._cond:
+				self.checkouts += 1
+				self.wait_time += elapsed
+				observe_pool_size(self._size, len(self._idle))
+			observe_acquire(elapsed)
+			return conn
+
+	def putconn(self, conn, close=False):
+		if not close and not conn.closed:
+			try:
+				if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+					conn.rollback()
+			except psycopg2.Error:
+				close = True
+		if close or conn.closed:
+			self._discard(conn)
+			return
+		with self._cond:
+			self._idle.append((conn, time.monotonic()))
+			self._cond.notify()
+			observe_pool_size(self._size, len(self._idle))
+
+	def available(self):
+		# Соединений, которые можно взять без ожидания
+		with self._cond:
+			return len(self._idle) + self.maxconn - self._size
+
+	def closeall(self):
+		with self._cond:
+			idle, self._idle = self._idle, []
+		for conn, _ in idle:
+			self._discard(conn)
+
+	def stats(self):
+		with self._cond:
+			return {
+				'size': self._size,
+				'idle': len(self._idle),
+				'in_use': self._size - len(self._idle),
+				'max': self.maxconn,
+				'checkouts': self.checkouts,
+				'wait_time': self.wait_time,
+				'exhausted': self.exhausted,
+				'timeouts': self.timeouts,
+				'recycled': self.recycled,
+				'broken': self.broken,
+			}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+	global _pool
+	# После fork() соединения родителя использовать нельзя — создаём новый пул
+	if _pool is None or _pool.pid != os.getpid():
+		with _pool_lock:
+			if _pool is None or _pool.pid != os.getpid():
+				_pool = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PING_AFTER)
+	return _pool
+
+def close_pool():
+	global _pool
+	with _pool_lock:
+		if _pool is not None and _pool.pid == os.getpid():
+			_pool.closeall()
+		_pool = None
+
+def pool_stats():
+	return get_pool().stats()
+
+# Флаг потоков gather(): контекст запроса у них скопирован, но транзакция своя
+_detached = contextvars.ContextVar('db_detached', default=False)
+
+def _request_scope():
+	if has_request_context() and not _detached.get():
+		return g.get('_db_scope')
+	return None
+
+@contextmanager
+def _scoped_connection(scope, commit):
+	# Внутри запроса все функции работают в одной транзакции,
+	# фиксация происходит один раз в end_request_scope()
+	if scope['conn'] is None:
+		scope['conn'] = get_pool().getconn()
+	try:
+		yield scope['conn']
+		if commit:
+			scope['dirty'] = True
+	except BaseException:
+		_release_scope(scope, rollback=True)
+		raise
+
+def _release_scope(scope, rollback):
+	conn, scope['conn'], scope['dirty'] = scope['conn'], None, False
+	callbacks, scope['callbacks'] = scope['callbacks'], []
+	if conn is None:
+		return
+	close = False
+	if rollback:
+		try:
+			conn.rollback()
+		except psycopg2.Error:
+			close = True
+	get_pool().putconn(conn, close=close)
+	return callbacks
+
+def begin_request_scope():
+	g._db_scope = {'conn': None, 'dirty': False, 'callbacks': []}
+
+def end_request_scope(commit=True):
+	scope = g.pop('_db_scope', None)
+	if scope is None:
+		return
+	if scope['conn'] is None:
+		callbacks = scope['callbacks']
+	elif commit and scope['dirty']:
+		try:
+			scope['conn'].commit()
+		except BaseException:
+			_release_scope(scope, rollback=True)
+			raise
+		callbacks = _release_scope(scope, rollback=False)
+	else:
+		callbacks = _release_scope(scope, rollback=True)
+	if commit:
+		for callback in callbacks:
+			callback()
+
+def _in_dirty_transaction():
+	scope = _request_scope()
+	return scope is not None and scope['dirty']
+
+def after_commit(callback):
+	# Внутри запроса изменения видны другим только после фиксации в конце запроса,
+	# поэтому сброс кэшей и уведомления откладываются до неё
+	scope = _request_scope()
+	if scope is not None:
+		scope['callbacks'].append(callback)
+	else:
+		callback()
+
+def init_app(app):
+	app.before_request(begin_request_scope)
+
+	@app.after_request
+	def commit_request_scope(response):
+		end_request_scope(commit=response.status_code < 500)
+		return response
+
+	@app.teardown_request
+	def rollback_request_scope(error):
+		end_request_scope(commit=False)
+
+_gather_executor = None
+_gather_pid = None
+_gather_busy = 0
+_gather_lock = threading.Lock()
+
+def _get_gather_executor():
+	global _gather_executor, _gather_pid, _gather_busy
+	# Потоки пула не переживают fork(), поэтому в каждом процессе свой
+	if _gather_pid != os.getpid():
+		with _gather_lock:
+			if _gather_pid != os.getpid():
+				_gather_executor = ThreadPoolExecutor(DB_GATHER_WORKERS, thread_name_prefix='db-gather')
+				_gather_pid = os.getpid()
+				_gather_busy = 0
+	return _gather_executor
+
+def _reserve_gather_threads(wanted):
+	# Потоки исполнителя общие для всех запросов процесса: отдаём в них не больше
+	# свободных, иначе чтения встанут в очередь за чужими и страница будет ждать дольше,
+	# чем при последовательном выполнении
+	global _gather_busy
+	with _gather_lock:
+		count = max(0, min(wanted, DB_GATHER_WORKERS - _gather_busy))
+		_gather_busy += count
+		return count
+
+def _run_detached(call):
+	global _gather_busy
+	_detached.set(True)
+	try:
+		return call()
+	finally:
+		with _gather_lock:
+			_gather_busy -= 1
+
+def gather(*calls):
+	# Независимые чтения страницы: gather(lambda: f(x), lambda: g(y)) -> [f(x), g(y)].
+	# Первое выполняется в потоке запроса, остальные параллельно на своих
+	# соединениях из пула, так что страница ждёт самый медленный запрос, а не сумму.
+	# После изменений в транзакции запроса чтения идут по очереди в ней же,
+	# иначе они не увидят незафиксированное; без свободных соединений или потоков — тоже.
+	calls = list(calls)
+	if len(calls) < 2 or DB_GATHER_WORKERS < 2 or _in_dirty_transaction():
+		return [call() for call in calls]
+	executor = _get_gather_executor()
+	# Первое чтение идёт в потоке запроса и, если у запроса ещё нет соединения, тоже его берёт
+	scope = _request_scope()
+	available = get_pool().available() - (scope is None or scope['conn'] is None)
+	spare = _reserve_gather_threads(min(len(calls) - 1, available))
+	# Каждому потоку своя копия контекста: метрики запроса и имя функции для instrumentation
+	futures = [executor.submit(contextvars.copy_context().run, _run_detached, call) for call in calls[len(calls) - spare:]]
+	results = [call() for call in calls[:len(calls) - spare]]
+	return results + [future.result() for future in futures]
+
+@contextmanager
+def db_connection(commit=False):
+	scope = _request_scope()
+	if scope is not None:
+		with _scoped_connection(scope, commit) as conn:
+			yield conn
+		return
+	pool = get_pool()
+	conn = pool.getconn()
+	close = False
+	try:
+		yield conn
+		if commit:
+			conn.commit()
+	except BaseException as e:
+		close = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+		if not close:
+			try:
+				conn.rollback()
+			except psycopg2.Error:
+				close = True
+		raise
+	finally:
+		pool.putconn(conn, close=close)
+
+@contextmanager
+def db_cursor(commit=False):
+	# Метрики пишутся по имени вызвавшей функции: генератор <- __enter__ <- функция
+	with track_function(sys._getframe(2).f_code.co_name), db_connection(commit) as conn:
+		cur = conn.cursor()
+		try:
+			yield cur
+		finally:
+			cur.close()
+
+# Имя и роль пользователя почти не меняются, а нужны почти на каждой странице
+user_cache = make_cache('users', USER_CACHE_SIZE, USER_CACHE_TTL)
+
+listener = Listener(get_db_connection)
+
+# Первые страницы каталога (пустой поиск и популярные запросы) одинаковы для всех.
+# Кэш локальный для процесса и сбрасывается по NOTIFY catalogue_changed
+# от триггера на products, так что изменения видны всем воркерам сразу.
+catalogue_cache = make_cache('catalogue', CATALOGUE_CACHE_SIZE, CATALOGUE_CACHE_TTL, shared=False)
+listener.subscribe('catalogue_changed', lambda payload: catalogue_cache.clear())
+# Без LISTEN об изменениях не узнать — кэш не используется до переподключения
+listener.on_state_change(lambda connected: catalogue_cache.clear())
+
+Page = namedtuple('Page', ['items', 'next_cursor', 'prev_cursor'])
+
+def encode_cursor(values, backward=False):
+	payload = json.dumps([backward, values], default=str)
+	return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+	if cursor:
+		try:
+			backward, values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+			if isinstance(values, list):
+				return bool(backward), values
+		except (ValueError, TypeError):
+			pass
+	return False, None
+
+def _keyset_page(cur, query, conditions, params, keys, cursor=None, limit=None):
+	# keys: [(выражение SQL, индекс в строке результата)], порядок всегда по убыванию.
+	# Курсор хранит ключ крайней строки страницы, поэтому OFFSET не нужен
+	# и стоимость страницы не зависит от её номера.
+	backward, after = decode_cursor(cursor)
+	if after is None or len(after) != len(keys):
+		backward, after = False, None
+	limit = max(1, min(int(limit or PAGE_SIZE), MAX_PAGE_SIZE))
+	conditions = list(conditions)
+	if after is not None:
+		columns = ', '.join(expr for expr, _ in keys)
+		marks = ', '.join(f'%(cursor_{i})s' for i in range(len(keys)))
+		conditions.append(f"({columns}) {'>' if backward else '<'} ({marks})")
+		params.update({f'cursor_{i}': value for i, value in enumerate(after)})
+	if conditions:
+		query += " WHERE " + " AND ".join(conditions)
+	order = 'ASC' if backward else 'DESC'
+	query += " ORDER BY " + ", ".join(f"{expr} {order}" for expr, _ in keys) + " LIMIT %(limit)s"
+	params['limit'] = limit + 1
+	cur.execute(query, params)
+	rows = cur.fetchall()
+	has_more = len(rows) > limit
+	rows = rows[:limit]
+	if backward:
+		rows.reverse()
+	if not rows:
+		return Page(rows, None, None)
+	def key(row):
+		return [row[i] for _, i in keys]
+	next_cursor = encode_cursor(key(rows[-1])) if (backward or has_more) else None
+	prev_cursor = encode_cursor(key(rows[0]), backward=True) if (has_more if backward else after is not None) else None
+	return Page(rows, next_cursor, prev_cursor)
+
 def get_user_by_email(email):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("SELECT id FROM users WHERE email = %s", (email,))
-	result = cur.fetchone()
-	cur.close()
-	conn.close()
-	return result
+	with db_cursor() as cur:
+		cur.execute("SELECT id FROM users WHERE email = %s", (email,))
+		return cur.fetchone()
 
 def get_all_users():
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("SELECT id, name, email, role FROM users")
-	users = cur.fetchall()
-	cur.close()
-	conn.close()
-	return users
+	with db_cursor() as cur:
+		cur.execute("SELECT id, name, email, role FROM users")
+		return cur.fetchall()
+
+def get_sellers():
+	with db_cursor() as cur:
+		cur.execute("SELECT id, name FROM users WHERE role = 'seller'")
+		return cur.fetchall()
 
 def delete_user(user_id):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("DELETE FROM users WHERE id = %s", (user_id,))
-	conn.commit()
-	cur.close()
-	conn.close()
+	# Сессии удаляются каскадом; возвращаются их коды, остальные процессы
+	# сбрасывают их из кэша по session_changed
+	with db_cursor(commit=True) as cur:
+		cur.execute("SELECT session_code, pg_notify('session_changed', session_code) FROM sessions WHERE user_id = %s",
+				(user_id,))
+		session_codes = [row[0] for row in cur.fetchall()]
+		cur.execute("DELETE FROM users WHERE id = %s", (user_id,))
+	after_commit(lambda: user_cache.delete(f'user:{user_id}'))
+	return session_codes
 
 def create_user(name, email, password, role):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("INSERT INTO users (name, email, password, role) VALUES (%s, %s, %s, %s) RETURNING id", 
-			(name, email, password, role))
-	user_id = cur.fetchone()[0]
-	conn.commit()
-	cur.close()
-	conn.close()
+	with db_cursor(commit=True) as cur:
+		cur.execute("INSERT INTO users (name, email, password, role) VALUES (%s, %s, %s, %s) RETURNING id", 
+				(name, email, password, role))
+		user_id = cur.fetchone()[0]
+	after_commit(lambda: user_cache.delete(f'user:{user_id}'))
 	return user_id
 
 def get_user_by_credentials(email, password):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("SELECT id, name, role FROM users WHERE email = %s AND password = %s", (email, password))
-	result = cur.fetchone()
-	cur.close()
-	conn.close()
-	return result
+	with db_cursor() as cur:
+		cur.execute("SELECT id, name, role FROM users WHERE email = %s AND password = %s", (email, password))
+		return cur.fetchone()
 
 def get_user_info(user_id):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("SELECT name, role FROM users WHERE id = %s", (user_id,))
-	result = cur.fetchone()
-	cur.close()
-	conn.close()
-	return result if result else (None, None)
-
-def get_all_products(search=''):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	query = """
-		SELECT p.id, p.name, p.description, p.price, p.quantity, p.image_urls, u.name 
-		FROM products p 
-		LEFT JOIN users u ON p.seller_id = u.id
-		WHERE p.name ILIKE %s OR p.description ILIKE %s
-	"""
-	cur.execute(query, (f'%{search}%', f'%{search}%'))
-	result = cur.fetchall()
-	cur.close()
-	conn.close()
+	key = f'user:{user_id}'
+	result = user_cache.get(key)
+	if result is not None:
+		return tuple(result)
+	with db_cursor() as cur:
+		cur.execute("SELECT name, role FROM users WHERE id = %s", (user_id,))
+		result = cur.fetchone()
+	if not result:
+		return (None, None)
+	user_cache.set(key, list(result))
 	return result
 
-def get_products_by_seller(seller_id, search=''):
-	conn = get_db_connection()
-	cur = conn.cursor()
+def _search_tsquery(search):
+	# 'кра мол' -> 'кра:* & мол:*', только буквы и цифры, чтобы не ломать синтаксис tsquery
+	terms = re.findall(r'\w+', search.lower())
+	return ' & '.join(f'{term}:*' for term in terms)
+
+def search_products(search='', seller_id=None, cursor=None, limit=None):
 	query = """
-		SELECT id, name, description, price, quantity, image_urls 
-		FROM products 
-		WHERE seller_id = %s AND (name ILIKE %s OR description ILIKE %s)
+		SELECT p.id, p.name, p.description, p.price, p.quantity, p.image_urls, u.name, p.image_variants{score}
+		FROM products p
+		LEFT JOIN users u ON p.seller_id = u.id
 	"""
-	cur.execute(query, (seller_id, f'%{search}%', f'%{search}%'))
-	result = cur.fetchall()
-	cur.close()
-	conn.close()
-	return result
+	conditions = []
+	params = {'seller_id': seller_id, 'search': search.strip(), 'tsquery': _search_tsquery(search)}
+	if seller_id is not None:
+		conditions.append("p.seller_id = %(seller_id)s")
+	if params['tsquery']:
+		# Слова по префиксу через tsvector, опечатки в названии через pg_trgm
+		conditions.append("(p.search_vector @@ to_tsquery('simple', %(tsquery)s) OR %(search)s <%% p.name)")
+		score = """(ts_rank(p.search_vector, to_tsquery('simple', %(tsquery)s))
+			+ word_similarity(%(search)s, p.name))::float8"""
+		query = query.format(score=', ' + score)
+		keys = [(score, 8), ('p.id', 0)]
+	else:
+		query = query.format(score='')
+		keys = [('p.id', 0)]
+	cacheable = seller_id is None and cursor is None and limit is None and listener.connected \
+			and not _in_dirty_transaction()
+	if cacheable:
+		key = ' '.join(search.lower().split())
+		generation = catalogue_cache.generation
+		page = catalogue_cache.get(key)
+		if page is not None:
+			return page
+	with db_cursor() as cur:
+		page = _keyset_page(cur, query, conditions, params, keys, cursor, limit)
+	if cacheable:
+		catalogue_cache.set(key, page, generation=generation)
+	return page
 
 def add_product(name, description, price, quantity, image_urls, seller_id):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("INSERT INTO products (name, description, price, quantity, image_urls, seller_id) VALUES (%s, %s, %s, %s, %s, %s)", 
-			(name, description, price, quantity, image_urls, seller_id))
-	conn.commit()
-	cur.close()
-	conn.close()
+	with db_cursor(commit=True) as cur:
+		cur.execute("INSERT INTO products (name, description, price, quantity, image_urls, seller_id) VALUES (%s, %s, %s, %s, %s, %s)", 
+				(name, description, price, quantity, image_urls, seller_id))
+	after_commit(catalogue_cache.clear)
 
 def update_product(product_id, name, description, price, quantity, image_urls):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("UPDATE products SET name = %s, description = %s, price = %s, quantity = %s, image_urls = %s WHERE id = %s", 
-			(name, description, price, quantity, image_urls, product_id))
-	conn.commit()
-	cur.close()
-	conn.close()
+	# Возвращает изображения, которые больше не привязаны к товару
+	with db_cursor(commit=True) as cur:
+		cur.execute("""
+			UPDATE products p SET name = %s, description = %s, price = %s, quantity = %s, image_urls = %s
+			FROM products old
+			WHERE p.id = %s AND old.id = p.id
+			RETURNING old.image_urls
+		""", (name, description, price, quantity, image_urls, product_id))
+		row = cur.fetchone()
+	after_commit(catalogue_cache.clear)
+	return [url for url in (row[0] if row else None) or [] if url not in image_urls]
+
+def set_image_variants(url, variants):
+	with db_cursor(commit=True) as cur:
+		cur.execute("""
+			UPDATE products SET image_variants = image_variants || jsonb_build_object(%s, %s::jsonb)
+			WHERE image_urls @> ARRAY[%s]
+		""", (url, json.dumps(variants), url))
+	after_commit(catalogue_cache.clear)
+
+def get_image_urls_without_variants():
+	with db_cursor() as cur:
+		cur.execute("""
+			SELECT DISTINCT url
+			FROM products p, unnest(p.image_urls) AS url
+			WHERE NOT p.image_variants ? url
+		""")
+		return [row[0] for row in cur.fetchall()]
 
 def delete_product(product_id):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("DELETE FROM products WHERE id = %s", (product_id,))
-	conn.commit()
-	cur.close()
-	conn.close()
+	with db_cursor(commit=True) as cur:
+		cur.execute("DELETE FROM products WHERE id = %s RETURNING image_urls", (product_id,))
+		row = cur.fetchone()
+	after_commit(catalogue_cache.clear)
+	return (row[0] if row else None) or []
 
-def get_product_seller(product_id):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("SELECT seller_id FROM products WHERE id = %s", (product_id,))
-	result = cur.fetchone()[0]
-	cur.close()
-	conn.close()
-	return result
+def import_products(source, seller_id=None, max_errors=50):
+	# source — файл с CSV для COPY (line, id, name, description, price, quantity,
+	# image_urls, seller_id); его errors — строки, отброшенные при разборе.
+	# Возвращает (ошибки, добавлено, обновлено, прежние image_urls обновлённых товаров)
+	with db_cursor(commit=True) as cur:
+		cur.execute("""
+			CREATE TEMP TABLE product_import (
+				line INTEGER, id INTEGER, name TEXT, description TEXT, price DECIMAL,
+				quantity INTEGER, image_urls TEXT[], seller_id INTEGER
+			) ON COMMIT DROP
+		""")
+		cur.copy_expert("COPY product_import FROM STDIN WITH (FORMAT csv)", source)
+		errors = list(source.errors)
+		cur.execute("""
+			SELECT s.line, CASE
+				WHEN s.id IS NOT NULL AND count(*) OVER (PARTITION BY s.id) > 1 THEN 'duplicate id'
+				WHEN s.id IS NOT NULL AND p.id IS NULL THEN 'unknown product id'
+				WHEN s.id IS NOT NULL AND %(seller_id)s IS NOT NULL AND p.seller_id IS DISTINCT FROM %(seller_id)s
+					THEN 'product belongs to another seller'
+				WHEN s.id IS NULL AND s.seller_id IS NULL THEN 'seller_id is required'
+				WHEN s.seller_id IS NOT NULL AND u.role IS DISTINCT FROM 'seller' THEN 'unknown seller'
+			END AS error
+			FROM product_import s
+			LEFT JOIN products p ON p.id = s.id
+			LEFT JOIN users u ON u.id = s.seller_id
+			ORDER BY s.line
+		""", {'seller_id': seller_id})
+		errors += [row for row in cur.fetchall() if row[1]]
+		if errors:
+			cur.execute("DROP TABLE product_import")
+			return sorted(errors)[:max_errors], 0, 0, []
+		# Построчные триггеры журнала и сводок продавцов отключаются до конца
+		# слияния: в журнал пишется одна сводная запись, сводки обновляются ниже
+		cur.execute("SELECT set_config('app.bulk_import', 'on', true)")
+		cur.execute("""
+			WITH updated AS (
+				UPDATE products p SET name = s.name, description = s.description, price = s.price,
+					quantity = s.quantity, image_urls = COALESCE(s.image_urls, p.image_urls),
+					seller_id = COALESCE(s.seller_id, p.seller_id)
+				FROM product_import s, products old
+				WHERE s.id IS NOT NULL AND p.id = s.id AND old.id = p.id
+				RETURNING p.id, old.image_urls,
+					(old.name, old.seller_id) IS DISTINCT FROM (p.name, p.seller_id) AS renamed
+			), inserted AS (
+				INSERT INTO products (name, description, price, quantity, image_urls, seller_id)
+				SELECT name, description, price, quantity, COALESCE(image_urls, '{}'), seller_id
+				FROM product_import WHERE id IS NULL
+				ORDER BY line
+				RETURNING id
+			)
+			SELECT (SELECT count(*) FROM inserted), (SELECT count(*) FROM updated),
+				ARRAY(SELECT DISTINCT unnest(image_urls) FROM updated),
+				ARRAY(SELECT id FROM updated WHERE renamed)
+		""")
+		added, updated, previous_urls, renamed = cur.fetchone()
+		cur.execute("SELECT set_config('app.bulk_import', 'off', true)")
+		if renamed:
+			cur.execute("SELECT refresh_seller_orders(ARRAY(SELECT DISTINCT order_id FROM order_items WHERE product_id = ANY(%s)))",
+					(renamed,))
+		cur.execute("DROP TABLE product_import")
+	after_commit(catalogue_cache.clear)
+	return [], added, updated, previous_urls
 
-def get_product_quantity(product_id):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("SELECT quantity FROM products WHERE id = %s", (product_id,))
-	result = cur.fetchone()[0]
-	cur.close()
-	conn.close()
-	return result
+def copy_products(out, fmt, seller_id=None):
+	# Выгрузка каталога через COPY ... TO STDOUT в out.write, в формате импорта
+	if fmt == 'csv':
+		columns = "id, name, description, price, quantity, array_to_string(image_urls, '|') AS image_urls, seller_id"
+		options = "FORMAT csv, HEADER"
+	else:
+		columns = """json_build_object('id', id, 'name', name, 'description', description, 'price', price,
+			'quantity', quantity, 'image_urls', image_urls, 'seller_id', seller_id)"""
+		# Строка JSON без экранирования: таких разделителя и кавычки в JSON не бывает
+		options = "FORMAT csv, DELIMITER E'\\x02', QUOTE E'\\x01'"
+	where = "WHERE seller_id = %(seller_id)s" if seller_id is not None else ""
+	with db_cursor() as cur:
+		query = cur.mogrify(f"COPY (SELECT {columns} FROM products {where} ORDER BY id) TO STDOUT WITH ({options})",
+				{'seller_id': seller_id})
+		cur.copy_expert(query.decode(), out)
 
-def add_to_cart(user_id, product_id, quantity):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("INSERT INTO cart (user_id, product_id, quantity) VALUES (%s, %s, %s) ON CONFLICT (user_id, product_id) DO UPDATE SET quantity = cart.quantity + %s", 
-			(user_id, product_id, quantity, quantity))
-	conn.commit()
-	cur.close()
-	conn.close()
+def get_unreferenced_images(urls):
+	with db_cursor() as cur:
+		cur.execute("""
+			SELECT url FROM unnest(%s::text[]) AS url
+			WHERE NOT EXISTS (SELECT 1 FROM products WHERE image_urls @> ARRAY[url])
+		""", (list(urls),))
+		return [row[0] for row in cur.fetchall()]
+
+def get_product_seller(product_id):
+	with db_cursor() as cur:
+		cur.execute("SELECT seller_id FROM products WHERE id = %s", (product_id,))
+		return cur.fetchone()[0]
+
+def add_to_cart(user_id, product_id, quantity, hold_seconds):
+	# Резервирует товар на hold_seconds; возвращает (зарезервировано, доступно)
+	with db_cursor(commit=True) as cur:
+		cur.execute("SELECT * FROM reserve_cart_item(%s, %s, %s, %s)",
+				(user_id, product_id, quantity, timedelta(seconds=hold_seconds)))
+		return cur.fetchone()
 
 def get_cart_items(user_id):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("SELECT p.id, p.name, p.price, c.quantity FROM cart c JOIN products p ON c.product_id = p.id WHERE c.user_id = %s", (user_id,))
-	result = cur.fetchall()
-	cur.close()
-	conn.close()
-	return result
+	with db_cursor() as cur:
+		cur.execute("SELECT p.id, p.name, p.price, c.quantity, c.reserved_until FROM cart c JOIN products p ON c.product_id = p.id WHERE c.user_id = %s", (user_id,))
+		return cur.fetchall()
 
+# Удалённая строка корзины возвращает своё удержание, если оно ещё не снято сборщиком
 def remove_from_cart(user_id, product_id):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("DELETE FROM cart WHERE user_id = %s AND product_id = %s", (user_id, product_id))
-	conn.commit()
-	cur.close()
-	conn.close()
+	with db_cursor(commit=True) as cur:
+		cur.execute("""
+			WITH removed AS (
+				DELETE FROM cart WHERE user_id = %s AND product_id = %s
+				RETURNING product_id, quantity, reserved_until
+			)
+			UPDATE products p SET reserved = p.reserved - r.quantity
+			FROM removed r
+			WHERE p.id = r.product_id AND r.reserved_until IS NOT NULL
+		""", (user_id, product_id))
 
 def clear_cart(user_id):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("DELETE FROM cart WHERE user_id = %s", (user_id,))
-	conn.commit()
-	cur.close()
-	conn.close()
-
-def get_cart_for_checkout(user_id):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("SELECT c.product_id, c.quantity, p.price FROM cart c JOIN products p ON c.product_id = p.id WHERE c.user_id = %s", (user_id,))
-	result = cur.fetchall()
-	cur.close()
-	conn.close()
-	return result
+	with db_cursor(commit=True) as cur:
+		cur.execute("""
+			WITH removed AS (
+				DELETE FROM cart WHERE user_id = %s
+				RETURNING product_id, quantity, reserved_until
+			)
+			UPDATE products p SET reserved = p.reserved - r.quantity
+			FROM removed r
+			WHERE p.id = r.product_id AND r.reserved_until IS NOT NULL
+		""", (user_id,))
+
+def release_expired_holds(batch_size):
+	with db_cursor(commit=True) as cur:
+		cur.execute("SELECT release_expired_holds(%s)", (batch_size,))
+		return cur.fetchone()[0]
+
+def create_order(user_id, delivery_address):
+	# Позиции заказа берутся из корзины внутри процедуры
+	with db_cursor(commit=True) as cur:
+		cur.execute("CALL create_order_with_items(%s, %s)", (user_id, delivery_address))
+	after_commit(catalogue_cache.clear)
 
 def get_user_orders(user_id, status_filter=''):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	query = "SELECT id, status, total_price, delivery_address, created_at FROM orders WHERE user_id = %s"
-	params = [user_id]
-	if status_filter:
-		query += " AND status = %s"
-		params.append(status_filter)
-	query += " ORDER BY created_at DESC"
-	cur.execute(query, params)
-	result = cur.fetchall()
-	cur.close()
-	conn.close()
-	return result
+	with db_cursor() as cur:
+		query = "SELECT id, status, total_price, delivery_address, created_at FROM orders WHERE user_id = %s"
+		params = [user_id]
+		if status_filter:
+			query += " AND status = %s"
+			params.append(status_filter)
+		query += " ORDER BY created_at DESC"
+		cur.execute(query, params)
+		return cur.fetchall()
 
-def get_all_orders(status_filter=''):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	query = "SELECT o.id, o.status, o.total_price, o.created_at, u.name FROM orders o JOIN users u ON o.user_id = u.id"
-	params = []
-	if status_filter:
-		query += " WHERE o.status = %s"
-		params.append(status_filter)
-	query += " ORDER BY o.created_at DESC"
-	cur.execute(query, params)
-	result = cur.fetchall()
-	cur.close()
-	conn.close()
-	return result
+def get_all_orders(status_filter='', cursor=None, limit=None):
+	with db_cursor() as cur:
+		query = "SELECT o.id, o.status, o.total_price, o.created_at, u.name FROM orders o JOIN users u ON o.user_id = u.id"
+		conditions = []
+		params = {'status': status_filter}
+		if status_filter:
+			conditions.append("o.status = %(status)s")
+		return _keyset_page(cur, query, conditions, params, [('o.created_at', 3), ('o.id', 0)], cursor, limit)
 
-def get_seller_orders(seller_id, status_filter=''):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	query = """
-		SELECT DISTINCT o.id, o.status, o.total_price, o.delivery_address, o.created_at, u.name, 
-						array_agg(p.name) as products
-		FROM orders o 
-		JOIN order_items oi ON o.id = oi.order_id 
-		JOIN products p ON oi.product_id = p.id 
-		JOIN users u ON o.user_id = u.id 
-		WHERE p.seller_id = %s
-	"""
-	params = [seller_id]
-	if status_filter:
-		query += " AND o.status = %s"
-		params.append(status_filter)
-	query += " GROUP BY o.id, u.name ORDER BY o.created_at DESC"
-	cur.execute(query, params)
-	result = cur.fetchall()
-	cur.close()
-	conn.close()
-	return result
+def get_seller_orders(seller_id, status_filter='', cursor=None, limit=None):
+	# Читается из сводки seller_orders (триггеры в schema.sql), без соединений и GROUP BY
+	with db_cursor() as cur:
+		query = """
+			SELECT order_id, status, total_price, delivery_address, created_at, customer, products, seller_revenue
+			FROM seller_orders
+		"""
+		conditions = ["seller_id = %(seller_id)s"]
+		params = {'seller_id': seller_id, 'status': status_filter}
+		if status_filter:
+			conditions.append("status = %(status)s")
+		return _keyset_page(cur, query, conditions, params, [('created_at', 4), ('order_id', 0)], cursor, limit)
+
+def get_seller_order_stats(seller_id):
+	with db_cursor() as cur:
+		cur.execute("""
+			SELECT status, orders, revenue FROM seller_order_stats
+			WHERE seller_id = %s AND orders > 0
+			ORDER BY status
+		""", (seller_id,))
+		return cur.fetchall()
+
+def verify_seller_rollups(sample=20):
+	# Сверка сводки с исходными таблицами: расхождения строк и счётчиков
+	with db_cursor() as cur:
+		cur.execute("""
+			SELECT coalesce(s.seller_id, r.seller_id), coalesce(s.order_id, r.order_id),
+				CASE WHEN r.order_id IS NULL THEN 'missing' WHEN s.order_id IS NULL THEN 'extra' ELSE 'differs' END
+			FROM seller_orders_source s
+			FULL JOIN seller_orders r ON r.seller_id = s.seller_id AND r.order_id = s.order_id
+			WHERE r.order_id IS NULL OR s.order_id IS NULL OR (s.*) IS DISTINCT FROM (r.*)
+		""")
+		rows = cur.fetchall()
+		cur.execute("""
+			SELECT coalesce(e.seller_id, s.seller_id), coalesce(e.status, s.status),
+				coalesce(e.orders, 0), coalesce(s.orders, 0), coalesce(e.revenue, 0), coalesce(s.revenue, 0)
+			FROM (
+				SELECT seller_id, status, count(*) AS orders, sum(seller_revenue) AS revenue
+				FROM seller_orders_source GROUP BY seller_id, status
+			) e
+			FULL JOIN seller_order_stats s ON s.seller_id = e.seller_id AND s.status = e.status
+			WHERE coalesce(e.orders, 0) <> coalesce(s.orders, 0) OR coalesce(e.revenue, 0) <> coalesce(s.revenue, 0)
+		""")
+		stats = cur.fetchall()
+		return {
+			'rows': len(rows),
+			'stats': len(stats),
+			'row_sample': [{'seller_id': r[0], 'order_id': r[1], 'problem': r[2]} for r in rows[:sample]],
+			'stats_sample': [
+				{'seller_id': s[0], 'status': s[1], 'orders': [s[2], s[3]], 'revenue': [str(s[4]), str(s[5])]}
+				for s in stats[:sample]
+			],
+		}
 
-def update_order_status(order_id, status):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("UPDATE orders SET status = %s WHERE id = %s", (status, order_id))
-	conn.commit()
-	cur.close()
-	conn.close()
+def rebuild_seller_rollups():
+	# Блокировка не даёт триггерам параллельных транзакций писать в сводку во время пересборки
+	with db_cursor(commit=True) as cur:
+		cur.execute("LOCK TABLE seller_orders, seller_order_stats IN EXCLUSIVE MODE")
+		cur.execute("TRUNCATE seller_orders, seller_order_stats")
+		cur.execute("INSERT INTO seller_orders SELECT * FROM seller_orders_source")
+		rows = cur.rowcount
+		cur.execute("""
+			INSERT INTO seller_order_stats (seller_id, status, orders, revenue)
+			SELECT seller_id, status, count(*), sum(seller_revenue) FROM seller_orders GROUP BY seller_id, status
+		""")
+		return rows
+
+def pay_order(order_id, user_id):
+	# Оплатить можно только свой ожидающий заказ: повторная или устаревшая форма
+	# не вернёт взятый или доставленный заказ в очередь курьеров
+	with db_cursor(commit=True) as cur:
+		cur.execute("UPDATE orders SET status = 'paid' WHERE id = %s AND user_id = %s AND status = 'pending'",
+				(order_id, user_id))
+		return cur.rowcount == 1
+
+def claim_orders(courier_id, estimated_delivery, order_ids=None, limit=1):
+	# Очередь диспетчеризации — оплаченные заказы (status = 'paid', частичный индекс).
+	# SKIP LOCKED: курьеры не ждут друг друга и не получают один заказ дважды,
+	# строку, занятую чужой транзакцией, просто пропускают.
+	# У отменённой доставки строка остаётся, поэтому ON CONFLICT; перезаписывается
+	# только отменённая, действующая доставка другому курьеру не переходит
+	conditions = ["status = 'paid'"]
+	if order_ids is not None:
+		conditions.append("id = ANY(%(order_ids)s)")
+	with db_cursor(commit=True) as cur:
+		cur.execute(f"""
+			WITH claimed AS (
+				SELECT id FROM orders
+				WHERE {' AND '.join(conditions)}
+				ORDER BY created_at, id
+				LIMIT %(limit)s
+				FOR UPDATE SKIP LOCKED
+			), dispatched AS (
+				UPDATE orders o SET status = 'in_delivery'
+				FROM claimed c WHERE o.id = c.id
+				RETURNING o.id
+			)
+			INSERT INTO delivery (order_id, courier_id, status, estimated_delivery)
+			SELECT id, %(courier_id)s, 'assigned', %(estimated_delivery)s FROM dispatched
+			ON CONFLICT (order_id) DO UPDATE SET
+				courier_id = EXCLUDED.courier_id, status = 'assigned',
+				estimated_delivery = EXCLUDED.estimated_delivery, delivered_at = NULL, cancel_reason = NULL
+				WHERE delivery.status = 'cancelled'
+			RETURNING order_id
+		""", {'order_ids': order_ids, 'limit': limit, 'courier_id': courier_id, 'estimated_delivery': estimated_delivery})
+		return [row[0] for row in cur.fetchall()]
 
 def assign_order_to_courier(order_id, courier_id, estimated_delivery):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("INSERT INTO delivery (order_id, courier_id, status, estimated_delivery) VALUES (%s, %s, 'assigned', %s)", 
-			(order_id, courier_id, estimated_delivery))
-	cur.execute("UPDATE orders SET status = 'in_delivery' WHERE id = %s", (order_id,))
-	conn.commit()
-	cur.close()
-	conn.close()
+	# False — заказ уже взял другой курьер или его оплату отменили
+	return bool(claim_orders(courier_id, estimated_delivery, order_ids=[int(order_id)]))
+
+def claim_next_orders(courier_id, estimated_delivery, count):
+	return claim_orders(courier_id, estimated_delivery, limit=count)
 
 def get_active_courier_orders(courier_id):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("""
-		SELECT o.id, o.status, o.total_price, o.delivery_address, d.status, d.estimated_delivery 
-		FROM orders o
-		JOIN delivery d ON o.id = d.order_id
-		WHERE d.courier_id = %s AND d.status NOT IN ('delivered', 'cancelled')
-	""", (courier_id,))
-	result = cur.fetchall()
-	cur.close()
-	conn.close()
-	return result
+	with db_cursor() as cur:
+		cur.execute("""
+			SELECT o.id, o.status, o.total_price, o.delivery_address, d.status, d.estimated_delivery 
+			FROM orders o
+			JOIN delivery d ON o.id = d.order_id
+			WHERE d.courier_id = %s AND d.status NOT IN ('delivered', 'cancelled')
+		""", (courier_id,))
+		return cur.fetchall()
 
-def get_available_orders():
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("""
-		SELECT o.id, o.status, o.total_price, o.delivery_address 
-		FROM orders o 
-		WHERE o.status = 'paid' AND NOT EXISTS (SELECT 1 FROM delivery d WHERE d.order_id = o.id)
-	""")
-	result = cur.fetchall()
-	cur.close()
-	conn.close()
-	return result
+def get_available_orders(limit=None):
+	with db_cursor() as cur:
+		cur.execute("""
+			SELECT o.id, o.status, o.total_price, o.delivery_address 
+			FROM orders o 
+			WHERE o.status = 'paid'
+			ORDER BY o.created_at, o.id
+			LIMIT %s
+		""", (limit or DISPATCH_LIST_SIZE,))
+		return cur.fetchall()
 
 def update_delivery_status(order_id, courier_id, status):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	if status == 'delivered':
-		cur.execute("UPDATE delivery SET status = %s, delivered_at = %s WHERE order_id = %s AND courier_id = %s", 
-				(status, datetime.now(), order_id, courier_id))
-		cur.execute("UPDATE orders SET status = 'completed' WHERE id = %s", (order_id,))
-	else:
-		cur.execute("UPDATE delivery SET status = %s WHERE order_id = %s AND courier_id = %s", 
-				(status, order_id, courier_id))
-	conn.commit()
-	cur.close()
-	conn.close()
+	with db_cursor(commit=True) as cur:
+		if status == 'delivered':
+			cur.execute("UPDATE delivery SET status = %s, delivered_at = %s WHERE order_id = %s AND courier_id = %s", 
+					(status, datetime.now(), order_id, courier_id))
+			cur.execute("UPDATE orders SET status = 'completed' WHERE id = %s", (order_id,))
+		else:
+			cur.execute("UPDATE delivery SET status = %s WHERE order_id = %s AND courier_id = %s", 
+					(status, order_id, courier_id))
 
 def check_courier_assignment(order_id, courier_id):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("SELECT COUNT(*) FROM delivery WHERE order_id = %s AND courier_id = %s", (order_id, courier_id))
-	result = cur.fetchone()[0] > 0
-	cur.close()
-	conn.close()
-	return result
+	with db_cursor() as cur:
+		cur.execute("SELECT COUNT(*) FROM delivery WHERE order_id = %s AND courier_id = %s", (order_id, courier_id))
+		result = cur.fetchone()[0] > 0
+		return result
 
 def cancel_delivery(order_id, courier_id, reason):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("UPDATE delivery SET status = 'cancelled', cancel_reason = %s WHERE order_id = %s AND courier_id = %s", 
-			(reason, order_id, courier_id))
-	cur.execute("UPDATE orders SET status = 'paid' WHERE id = %s", (order_id,))
-	conn.commit()
-	cur.close()
-	conn.close()
-
-def log_action(user_id, action):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("INSERT INTO logs (user_id, action) VALUES (%s, %s)", (user_id, action))
-	conn.commit()
-	cur.close()
-	conn.close()
-
-def get_logs(action_filter=''):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	query = "SELECT l.id, u.name, l.action, l.timestamp FROM logs l JOIN users u ON l.user_id = u.id"
-	params = []
-	if action_filter:
-		query += " WHERE l.action ILIKE %s"
-		params.append(f'%{action_filter}%')
-	query += " ORDER BY l.timestamp DESC"
-	cur.execute(query, params)
-	result = cur.fetchall()
-	cur.close()
-	conn.close()
-	return result
+	# Заказ возвращается в очередь на своё прежнее место (по created_at)
+	with db_cursor(commit=True) as cur:
+		cur.execute("""
+			WITH cancelled AS (
+				UPDATE delivery SET status = 'cancelled', cancel_reason = %s
+				WHERE order_id = %s AND courier_id = %s AND status NOT IN ('delivered', 'cancelled')
+				RETURNING order_id
+			)
+			UPDATE orders SET status = 'paid' WHERE id IN (SELECT order_id FROM cancelled)
+		""", (reason, order_id, courier_id))
+		return cur.rowcount > 0
 
-def create_session(user_id, session_code):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute(
-		"INSERT INTO sessions (user_id, session_code, created_at) VALUES (%s, %s, %s) RETURNING id",
-		(user_id, session_code, datetime.now())
-	)
-	session_id = cur.fetchone()[0]
-	conn.commit()
-	cur.close()
-	conn.close()
-	return session_id
+def insert_logs(events):
+	# events: [(user_id, action, timestamp)], одна многострочная вставка на пачку
+	with db_cursor(commit=True) as cur:
+		psycopg2.extras.execute_values(cur, "INSERT INTO logs (user_id, action, timestamp) VALUES %s",
+				events, page_size=len(events))
+
+def get_logs(action_filter='', since=None, cursor=None, limit=None):
+	# since — начало окна: граница подставляется в запрос литералом,
+	# и планировщик читает только секции logs за это время
+	with db_cursor() as cur:
+		query = "SELECT l.id, u.name, l.action, l.timestamp FROM logs l JOIN users u ON l.user_id = u.id"
+		conditions = []
+		params = {'action': f'%{action_filter}%', 'since': since}
+		if action_filter:
+			conditions.append("l.action ILIKE %(action)s")
+		if since is not None:
+			conditions.append("l.timestamp >= %(since)s")
+		return _keyset_page(cur, query, conditions, params, [('l.timestamp', 3), ('l.id', 0)], cursor, limit)
+
+def create_logs_partitions(first_month, months):
+	with db_cursor(commit=True) as cur:
+		cur.execute("""
+			SELECT name FROM (
+				SELECT create_logs_partition((%s::date + i * interval '1 month')::date) AS name
+				FROM generate_series(0, %s) AS i
+			) created
+			WHERE name IS NOT NULL
+		""", (first_month, months - 1))
+		return [row[0] for row in cur.fetchall()]
+
+def get_logs_partitions():
+	# Секции logs_ГГГГ_ММ, включая отсоединённые, но ещё не удалённые
+	with db_cursor() as cur:
+		cur.execute("""
+			SELECT c.relname, i.inhrelid IS NOT NULL, c.reltuples::bigint, pg_total_relation_size(c.oid)
+			FROM pg_class c
+			LEFT JOIN pg_inherits i ON i.inhrelid = c.oid AND i.inhparent = 'logs'::regclass
+			WHERE c.relkind = 'r' AND c.relnamespace = 'public'::regnamespace AND c.relname ~ '^logs_[0-9]{4}_[0-9]{2}$'
+			ORDER BY c.relname
+		""")
+		return cur.fetchall()
+
+def detach_logs_partition(name):
+	with db_cursor(commit=True) as cur:
+		cur.execute(f'ALTER TABLE logs DETACH PARTITION "{name}"')
+
+def copy_logs_partition(name, out):
+	with db_cursor() as cur:
+		cur.copy_expert(f'COPY "{name}" TO STDOUT WITH (FORMAT csv, HEADER)', out)
+
+def drop_logs_partition(name):
+	with db_cursor(commit=True) as cur:
+		cur.execute(f'DROP TABLE IF EXISTS "{name}"')
+
+def refresh_materialized_view(name):
+	# CONCURRENTLY: чтение представления не блокируется на время пересчёта
+	start = time.monotonic()
+	with db_cursor(commit=True) as cur:
+		cur.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {name}")
+		duration = time.monotonic() - start
+		cur.execute("""
+			INSERT INTO analytics_refreshes (view_name, refreshed_at, duration) VALUES (%s, %s, %s)
+			ON CONFLICT (view_name) DO UPDATE SET refreshed_at = EXCLUDED.refreshed_at, duration = EXCLUDED.duration
+		""", (name, datetime.now(), duration))
+	return duration
+
+def get_analytics_refreshes():
+	with db_cursor() as cur:
+		cur.execute("SELECT view_name, refreshed_at, duration FROM analytics_refreshes ORDER BY view_name")
+		return cur.fetchall()
+
+def get_order_series(since, bucket):
+	with db_cursor() as cur:
+		cur.execute("""
+			SELECT date_trunc(%s, day)::date AS bucket, sum(orders), sum(revenue)
+			FROM analytics_daily_orders
+			WHERE day >= %s
+			GROUP BY 1 ORDER BY 1
+		""", (bucket, since))
+		return cur.fetchall()
+
+def get_order_status_totals(since):
+	with db_cursor() as cur:
+		cur.execute("""
+			SELECT status, sum(orders), sum(revenue)
+			FROM analytics_daily_orders
+			WHERE day >= %s
+			GROUP BY status ORDER BY 2 DESC
+		""", (since,))
+		return cur.fetchall()
+
+def get_delivery_series(since, bucket):
+	# Среднее время доставки (от создания заказа, в минутах) и доля опозданий
+	with db_cursor() as cur:
+		cur.execute("""
+			SELECT date_trunc(%s, day)::date AS bucket, sum(deliveries),
+				round((sum(delivery_seconds) / sum(deliveries) / 60)::numeric, 1),
+				round((100.0 * sum(late) / sum(deliveries))::numeric, 1)
+			FROM analytics_courier_daily
+			WHERE day >= %s
+			GROUP BY 1 ORDER BY 1
+		""", (bucket, since))
+		return cur.fetchall()
+
+def get_courier_stats(since, limit=20):
+	with db_cursor() as cur:
+		cur.execute("""
+			SELECT c.courier_id, u.name, sum(c.deliveries),
+				round((sum(c.delivery_seconds) / sum(c.deliveries) / 60)::numeric, 1),
+				sum(c.late),
+				round((sum(c.late_seconds) / nullif(sum(c.late), 0) / 60)::numeric, 1)
+			FROM analytics_courier_daily c
+			LEFT JOIN users u ON u.id = c.courier_id
+			WHERE c.day >= %s
+			GROUP BY c.courier_id, u.name
+			ORDER BY 3 DESC
+			LIMIT %s
+		""", (since, limit))
+		return cur.fetchall()
+
+def get_activity_series(since, bucket):
+	with db_cursor() as cur:
+		cur.execute("""
+			SELECT date_trunc(%s, hour) AS bucket, sum(actions)
+			FROM analytics_hourly_activity
+			WHERE hour >= %s
+			GROUP BY 1 ORDER BY 1
+		""", (bucket, since))
+		return cur.fetchall()
+
+def get_data_version():
+	# Последнее выданное значение data_version_seq — не меньше версии любой темы
+	with db_cursor() as cur:
+		cur.execute("SELECT last_value FROM data_version_seq")
+		return cur.fetchone()[0]
+
+def create_session(user_id, session_code, data=None):
+	with db_cursor(commit=True) as cur:
+		now = datetime.now()
+		cur.execute(
+			"INSERT INTO sessions (user_id, session_code, created_at, last_seen, data) VALUES (%s, %s, %s, %s, %s) RETURNING id",
+			(user_id, session_code, now, now, json.dumps(data or {}))
+		)
+		return cur.fetchone()[0]
 
 def get_session_by_code(session_code):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("SELECT user_id FROM sessions WHERE session_code = %s", (session_code,))
-	result = cur.fetchone()
-	cur.close()
-	conn.close()
-	return result[0] if result else None
+	with db_cursor() as cur:
+		cur.execute("SELECT user_id, data, created_at, last_seen FROM sessions WHERE session_code = %s", (session_code,))
+		return cur.fetchone()
+
+def update_session(session_code, user_id, data):
+	# Остальные процессы сбрасывают сессию из своего кэша по уведомлению
+	with db_cursor(commit=True) as cur:
+		cur.execute("UPDATE sessions SET user_id = %s, data = %s WHERE session_code = %s",
+				(user_id, json.dumps(data), session_code))
+		cur.execute("SELECT pg_notify('session_changed', %s)", (session_code,))
 
 def delete_session(session_code):
-	conn = get_db_connection()
-	cur = conn.cursor()
-	cur.execute("DELETE FROM sessions WHERE session_code = %s", (session_code,))
-	conn.commit()
-	cur.close()
-	conn.close()
+	with db_cursor(commit=True) as cur:
+		cur.execute("DELETE FROM sessions WHERE session_code = %s", (session_code,))
+		cur.execute("SELECT pg_notify('session_changed', %s)", (session_code,))
+
+def touch_sessions(last_seen):
+	# last_seen: {session_code: datetime}, одна пачка за раз
+	with db_cursor(commit=True) as cur:
+		psycopg2.extras.execute_values(cur, """
+			UPDATE sessions s SET last_seen = v.last_seen
+			FROM (VALUES %s) AS v(session_code, last_seen)
+			WHERE s.session_code = v.session_code AND s.last_seen < v.last_seen
+		""", list(last_seen.items()), template="(%s, %s::timestamp)", page_size=len(last_seen))
+
+def delete_expired_sessions(idle_timeout, max_age, batch_size):
+	# Время сессий пишется из приложения, поэтому и границы считаются здесь же
+	now = datetime.now()
+	with db_cursor(commit=True) as cur:
+		cur.execute("""
+			DELETE FROM sessions WHERE id IN (
+				SELECT id FROM sessions
+				WHERE created_at < %s OR last_seen < %s
+				LIMIT %s
+			)
+		""", (now - timedelta(seconds=max_age), now - timedelta(seconds=idle_timeout), batch_size))
+		return cur.rowcount
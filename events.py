@@ -0,0 +1,131 @@
+import os
+import json
+import queue
+import time
+import threading
+from collections import deque
+from db import listener
+
+EVENTS_BUFFER = int(os.getenv('EVENTS_BUFFER', 1000))
+# Каждый поток /events занимает поток воркера gthread на EVENTS_STREAM_TTL, поэтому
+# по умолчанию потоков событий на воркер на EVENTS_RESERVED_THREADS меньше, чем
+# WEB_THREADS (gunicorn.conf.py): оставшиеся обслуживают обычные страницы.
+# Остальные клиенты получают 503 и обновляют страницу сами. У gevent потоки
+# дешёвые, там ограничение большое
+WEB_THREADS = int(os.getenv('WEB_THREADS', 8))
+EVENTS_RESERVED_THREADS = int(os.getenv('EVENTS_RESERVED_THREADS', 2))
+EVENTS_MAX_STREAMS = int(os.getenv('EVENTS_MAX_STREAMS') or (
+	1000 if os.getenv('WEB_WORKER_CLASS') == 'gevent' else max(WEB_THREADS - EVENTS_RESERVED_THREADS, 0)))
+EVENTS_KEEPALIVE = float(os.getenv('EVENTS_KEEPALIVE', 15))
+EVENTS_STREAM_TTL = float(os.getenv('EVENTS_STREAM_TTL', 300))
+EVENTS_QUEUE_SIZE = int(os.getenv('EVENTS_QUEUE_SIZE', 100))
+
+# Поля, которые видит клиент; seller_ids и user_id нужны только для фильтрации
+FIELDS = ('order_id', 'status', 'total_price', 'delivery_status', 'estimated_delivery')
+
+RESYNC = object()
+
+class Subscription:
+	def __init__(self, user_id, role):
+		self.user_id = user_id
+		self.role = role
+		self.queue = queue.Queue(EVENTS_QUEUE_SIZE)
+
+	def wants(self, event):
+		if self.role == 'admin':
+			return True
+		if self.role == 'customer':
+			return event['user_id'] == self.user_id
+		if self.role == 'seller':
+			return self.user_id in (event['seller_ids'] or ())
+		if self.role == 'courier':
+			# Заказ вошёл в очередь или покинул её — это видно всем курьерам
+			return event['courier_id'] == self.user_id or 'paid' in (event['status'], event['previous_status'])
+		return False
+
+	def put(self, event):
+		try:
+			self.queue.put_nowait(event)
+		except queue.Full:
+			# Клиент не успевает читать — пусть перезагрузит страницу
+			self.queue = queue.Queue(1)
+			self.queue.put_nowait(RESYNC)
+
+class EventHub:
+	# Раздача order_events всем потокам /events процесса. Все воркеры получают
+	# уведомления в одном порядке (порядок фиксации транзакций), поэтому по
+	# Last-Event-ID любой воркер может дослать пропущенное из своего буфера.
+	def __init__(self, buffer_size, max_streams):
+		self.max_streams = max_streams
+		self._lock = threading.Lock()
+		self._subscribers = set()
+		self._recent = deque(maxlen=buffer_size)
+		self.published = 0
+
+	def publish(self, payload):
+		event = json.loads(payload)
+		with self._lock:
+			self._recent.append(event)
+			subscribers = list(self._subscribers)
+			self.published += 1
+		for subscription in subscribers:
+			if subscription.wants(event):
+				subscription.put(event)
+
+	def reset(self, connected):
+		# Пока LISTEN не работает, события теряются: клиентам нужно перечитать страницу,
+		# а буфер для Last-Event-ID начинается заново
+		with self._lock:
+			self._recent.clear()
+			subscribers = [] if connected else list(self._subscribers)
+		for subscription in subscribers:
+			subscription.put(RESYNC)
+
+	def subscribe(self, user_id, role, last_event_id=None):
+		listener.connected  # запускает поток LISTEN в этом процессе
+		subscription = Subscription(user_id, role)
+		with self._lock:
+			if len(self._subscribers) >= self.max_streams:
+				return None
+			if last_event_id:
+				ids = [event['id'] for event in self._recent]
+				if last_event_id in ids:
+					for event in list(self._recent)[ids.index(last_event_id) + 1:]:
+						if subscription.wants(event):
+							subscription.put(event)
+				else:
+					subscription.put(RESYNC)
+			self._subscribers.add(subscription)
+		return subscription
+
+	def unsubscribe(self, subscription):
+		with self._lock:
+			self._subscribers.discard(subscription)
+
+	def stats(self):
+		with self._lock:
+			return {'streams': len(self._subscribers), 'buffered': len(self._recent), 'published': self.published}
+
+event_hub = EventHub(EVENTS_BUFFER, EVENTS_MAX_STREAMS)
+listener.subscribe('order_events', event_hub.publish)
+listener.on_state_change(event_hub.reset)
+
+def stream(subscription):
+	# Формат text/event-stream; браузерный EventSource сам переподключается
+	# и присылает Last-Event-ID последнего полученного события
+	deadline = time.monotonic() + EVENTS_STREAM_TTL
+	try:
+		yield 'retry: 5000\n\n'
+		while time.monotonic() < deadline:
+			try:
+				event = subscription.queue.get(timeout=EVENTS_KEEPALIVE)
+			except queue.Empty:
+				yield ': keepalive\n\n'
+				continue
+			if event is RESYNC:
+				yield 'event: resync\ndata: {}\n\n'
+				return
+			data = {field: event[field] for field in FIELDS}
+			yield f"id: {event['id']}\nevent: order\ndata: {json.dumps(data)}\n\n"
+	finally:
+		event_hub.unsubscribe(subscription)
@@ -0,0 +1,44 @@
+# Конфигурация production-сервера: gunicorn -c gunicorn.conf.py wsgi:app
+# Все параметры задаются через окружение, как и DB_*.
+import os
+import shutil
+import multiprocessing
+
+bind = os.getenv('WEB_BIND', '0.0.0.0:5723')
+workers = int(os.getenv('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# gthread — потоки в каждом процессе; gevent требует пакеты gevent и psycogreen
+worker_class = os.getenv('WEB_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('WEB_THREADS', 8))
+worker_connections = int(os.getenv('WEB_WORKER_CONNECTIONS', 1000))
+keepalive = int(os.getenv('WEB_KEEPALIVE', 5))
+timeout = int(os.getenv('WEB_TIMEOUT', 60))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', 30))
+# Периодический перезапуск воркеров ограничивает рост памяти
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', 5000))
+max_requests_jitter = int(os.getenv('WEB_MAX_REQUESTS_JITTER', 500))
+preload_app = os.getenv('WEB_PRELOAD', '0') == '1'
+accesslog = os.getenv('WEB_ACCESS_LOG') or None
+errorlog = '-'
+
+# Метрики Prometheus в режиме нескольких процессов пишутся в общий каталог
+prometheus_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/food_delivery_prometheus')
+
+def on_starting(server):
+	shutil.rmtree(prometheus_dir, ignore_errors=True)
+	os.makedirs(prometheus_dir, exist_ok=True)
+
+def post_fork(server, worker):
+	if worker_class == 'gevent':
+		from psycogreen.gevent import patch_psycopg
+		patch_psycopg()
+	# Соединения и фоновые потоки мастера в дочернем процессе непригодны
+	from db import close_pool
+	close_pool()
+
+def worker_exit(server, worker):
+	from audit import audit_log
+	audit_log.close()
+
+def child_exit(server, worker):
+	from prometheus_flask_exporter.multiprocess import GunicornInternalPrometheusMetrics
+	GunicornInternalPrometheusMetrics.mark_process_dead_on_child_exit(worker.pid)
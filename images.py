@@ -0,0 +1,151 @@
+import os
+import json
+import logging
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from db import after_commit, set_image_variants, get_image_urls_without_variants, search_products
+
+try:
+	from PIL import Image, ImageOps, features
+except ImportError:
+	Image = None
+
+# Карточки товара показывают изображения шириной 100px (static/css/products.css),
+# остальные размеры — для экранов с высокой плотностью пикселей
+IMAGE_WIDTHS = tuple(int(width) for width in os.getenv('IMAGE_WIDTHS', '100,200,400').split(','))
+IMAGE_FORMATS = tuple(os.getenv('IMAGE_FORMATS', 'avif,webp').split(','))
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', 75))
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', 2))
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+def available_formats():
+	if Image is None:
+		return ()
+	return tuple(fmt for fmt in IMAGE_FORMATS if features.check(fmt))
+
+def derivative_path(source, width, fmt):
+	base, _ = os.path.splitext(source)
+	return f'{base}-{width}w.{fmt}'
+
+def _existing_width(path):
+	try:
+		with Image.open(path) as existing:
+			return existing.width
+	except (OSError, ValueError):
+		return None
+
+def _save(image, path, fmt):
+	# Запись через свой временный файл и атомарное переименование: по этому имени
+	# файл уже могут отдавать, а тот же файл может обрабатывать другой воркер
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.derivative-')
+	try:
+		with os.fdopen(fd, 'wb') as out:
+			image.save(out, fmt.upper(), quality=IMAGE_QUALITY)
+		os.chmod(tmp_path, 0o644)
+		os.replace(tmp_path, path)
+	except BaseException:
+		if os.path.exists(tmp_path):
+			os.unlink(tmp_path)
+		raise
+
+def build_derivatives(source):
+	variants = {}
+	with Image.open(source) as original:
+		image = ImageOps.exif_transpose(original)
+		if image.mode not in ('RGB', 'RGBA'):
+			image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+		# Увеличивать не имеет смысла: маленькое исходное изображение даёт один вариант
+		widths = [width for width in IMAGE_WIDTHS if width < image.width] or [image.width]
+		for fmt in available_formats():
+			for width in widths:
+				path = derivative_path(source, width, fmt)
+				# Загрузки хранятся по хэшу содержимого: готовые производные того же
+				# файла не пересобираются, нужна только их ширина
+				built = _existing_width(path)
+				if built is None:
+					resized = image.copy()
+					resized.thumbnail((width, width * 10), Image.LANCZOS)
+					_save(resized, path, fmt)
+					built = resized.width
+				variants.setdefault(fmt, []).append([built, path])
+	return variants
+
+def process_image(url):
+	try:
+		variants = build_derivatives(url)
+	except (OSError, ValueError):
+		logger.exception('cannot build derivatives for %s', url)
+		return None
+	if variants:
+		set_image_variants(url, variants)
+	return variants
+
+def _get_executor():
+	global _executor, _executor_pid
+	if _executor_pid != os.getpid():
+		with _executor_lock:
+			if _executor_pid != os.getpid():
+				_executor = ThreadPoolExecutor(IMAGE_WORKERS, thread_name_prefix='images')
+				_executor_pid = os.getpid()
+	return _executor
+
+def schedule(urls):
+	# Запускаем после фиксации транзакции, иначе воркер не увидит новую строку products
+	if not urls or not available_formats():
+		return
+	def submit():
+		executor = _get_executor()
+		for url in urls:
+			executor.submit(process_image, url)
+	after_commit(submit)
+
+def backfill():
+	urls = get_image_urls_without_variants()
+	with ThreadPoolExecutor(IMAGE_WORKERS) as executor:
+		for url, variants in zip(urls, executor.map(process_image, urls)):
+			print(f"{url}: {'ok' if variants else 'failed'}")
+
+def _file_size(path):
+	try:
+		return os.path.getsize(path)
+	except OSError:
+		return 0
+
+def page_view_report(display_width=IMAGE_WIDTHS[0] * 2):
+	# Сколько байт изображений стоит первая страница каталога до и после srcset
+	# (браузер с плотностью 2x выберет вариант не уже display_width)
+	report = {'images': 0, 'original_bytes': 0, 'derivative_bytes': 0}
+	for product in search_products('').items:
+		variants = product[7] or {}
+		for url in product[5] or []:
+			original = _file_size(url)
+			chosen = original
+			for fmt in IMAGE_FORMATS:
+				candidates = sorted(variants.get(url, {}).get(fmt, []))
+				fitting = [path for width, path in candidates if width >= display_width] or [path for _, path in candidates[-1:]]
+				if fitting:
+					chosen = _file_size(fitting[0])
+					break
+			report['images'] += 1
+			report['original_bytes'] += original
+			report['derivative_bytes'] += chosen
+	report['saved_bytes'] = report['original_bytes'] - report['derivative_bytes']
+	return report
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Производные изображения товаров')
+	parser.add_argument('command', choices=['backfill', 'report'])
+	args = parser.parse_args()
+	if Image is None:
+		raise SystemExit('Pillow is not installed')
+	if args.command == 'backfill':
+		backfill()
+	else:
+		print(json.dumps(page_view_report(), indent=2))
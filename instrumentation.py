@@ -0,0 +1,211 @@
+import os
+import re
+import time
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+import psycopg2
+import psycopg2.extensions
+from flask import request
+from prometheus_client import Counter, Gauge, Histogram
+
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 200))
+# План медленного запроса — обычный EXPLAIN без ANALYZE: запрос не выполняется
+# повторно, но план снимается в запросе пользователя, поэтому по умолчанию
+# выключено и для одного и того же запроса не чаще раза в SLOW_QUERY_EXPLAIN_INTERVAL
+# секунд. Фактическое время по узлам плана — через auto_explain на сервере
+SLOW_QUERY_EXPLAIN = os.getenv('SLOW_QUERY_EXPLAIN', '0') == '1'
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.getenv('SLOW_QUERY_EXPLAIN_INTERVAL', 300))
+SLOW_QUERY_LOG_SIZE = int(os.getenv('SLOW_QUERY_LOG_SIZE', 100))
+QUERY_STATS_SIZE = int(os.getenv('QUERY_STATS_SIZE', 500))
+# Столько запросов к базе за один HTTP-запрос почти наверняка означает N+1
+N_PLUS_ONE_THRESHOLD = int(os.getenv('N_PLUS_ONE_THRESHOLD', 20))
+
+logger = logging.getLogger(__name__)
+
+FUNCTION_SECONDS = Histogram('db_function_duration_seconds', 'Время выполнения функций db.py', ['function'])
+STATEMENT_SECONDS = Histogram('db_statement_duration_seconds', 'Время выполнения SQL-запросов', ['function'])
+STATEMENT_ROWS = Histogram('db_statement_rows', 'Строк возвращено или изменено запросом', ['function'],
+		buckets=(0, 1, 5, 10, 50, 100, 500, 1000, 5000, float('inf')))
+ACQUIRE_SECONDS = Histogram('db_pool_acquire_seconds', 'Ожидание соединения из пула')
+POOL_EVENTS = Counter('db_pool_events_total', 'События пула: exhausted, timeout, recycled, broken', ['event'])
+# livesum — сумма по живым воркерам gunicorn
+POOL_CONNECTIONS = Gauge('db_pool_connections', 'Соединения пула по состоянию', ['state'], multiprocess_mode='livesum')
+REQUEST_QUERIES = Histogram('db_queries_per_request', 'Запросов к базе за HTTP-запрос', ['endpoint'],
+		buckets=(0, 1, 2, 5, 10, 20, 50, 100, float('inf')))
+SLOW_QUERIES = Counter('db_slow_queries_total', 'Запросы дольше SLOW_QUERY_MS', ['function'])
+
+_function = contextvars.ContextVar('db_function', default=None)
+_request_stats = contextvars.ContextVar('db_request_stats', default=None)
+
+_lock = threading.Lock()
+_stats = {}
+_endpoints = {}
+_slow_log = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+_explained = {}
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_VALUE_LISTS = re.compile(r"\((?:\s*\?(?:::\w+)?\s*,?)+\)(?:\s*,\s*\((?:\s*\?(?:::\w+)?\s*,?)+\))*")
+_EXPLAINABLE = ('select', 'with', 'insert', 'update', 'delete')
+
+@lru_cache(maxsize=1024)
+def fingerprint(query):
+	# Литералы заменяются на ?, пачки VALUES от execute_values сворачиваются,
+	# чтобы один и тот же запрос с разными данными считался вместе
+	if isinstance(query, bytes):
+		query = query.decode(errors='replace')
+	query = _LITERALS.sub('?', ' '.join(query.split()))
+	return _VALUE_LISTS.sub('(...)', query)
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+	def execute(self, query, vars=None):
+		start = time.perf_counter()
+		result = super().execute(query, vars)
+		_record(self, query, time.perf_counter() - start)
+		return result
+
+	def executemany(self, query, vars_list):
+		start = time.perf_counter()
+		result = super().executemany(query, vars_list)
+		_record(self, query, time.perf_counter() - start)
+		return result
+
+@contextmanager
+def track_function(name):
+	token = _function.set(name)
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		FUNCTION_SECONDS.labels(name).observe(time.perf_counter() - start)
+		_function.reset(token)
+
+def observe_acquire(seconds):
+	ACQUIRE_SECONDS.observe(seconds)
+
+def observe_pool_event(event):
+	POOL_EVENTS.labels(event).inc()
+
+def observe_pool_size(size, idle):
+	POOL_CONNECTIONS.labels('in_use').set(size - idle)
+	POOL_CONNECTIONS.labels('idle').set(idle)
+
+def _record(cur, query, elapsed):
+	function = _function.get() or 'other'
+	rows = max(cur.rowcount, 0)
+	STATEMENT_SECONDS.labels(function).observe(elapsed)
+	STATEMENT_ROWS.labels(function).observe(rows)
+	stats = _request_stats.get()
+	key = fingerprint(query)
+	with _lock:
+		# Счётчики запроса общие с потоками gather(), обновляются под блокировкой
+		if stats is not None:
+			stats['queries'] += 1
+			stats['db_time'] += elapsed
+		stat = _stats.get((function, key))
+		if stat is None:
+			if len(_stats) >= QUERY_STATS_SIZE:
+				stat = None
+			else:
+				stat = _stats[(function, key)] = {'function': function, 'query': key, 'calls': 0, 'total': 0.0, 'max': 0.0, 'rows': 0}
+		if stat is not None:
+			stat['calls'] += 1
+			stat['total'] += elapsed
+			stat['max'] = max(stat['max'], elapsed)
+			stat['rows'] += rows
+	if elapsed * 1000 >= SLOW_QUERY_MS:
+		_slow_query(cur, function, key, elapsed)
+
+def _slow_query(cur, function, key, elapsed):
+	SLOW_QUERIES.labels(function).inc()
+	plan = None
+	if SLOW_QUERY_EXPLAIN and _explain_due(key):
+		plan = _explain(cur)
+	logger.warning('slow query in %s (%.0f ms): %s', function, elapsed * 1000, key)
+	with _lock:
+		_slow_log.appendleft({'time': time.time(), 'function': function, 'query': key, 'duration': elapsed, 'plan': plan})
+
+def _explain_due(key):
+	now = time.monotonic()
+	with _lock:
+		if now - _explained.get(key, float('-inf')) < SLOW_QUERY_EXPLAIN_INTERVAL:
+			return False
+		if len(_explained) >= QUERY_STATS_SIZE:
+			_explained.clear()
+		_explained[key] = now
+		return True
+
+def _explain(cur):
+	# Оценочный план без выполнения; точка сохранения — чтобы ошибка EXPLAIN
+	# не прервала транзакцию запроса
+	conn = cur.connection
+	statement = cur.query.decode(errors='replace') if cur.query else ''
+	if conn.autocommit or not statement.lstrip().lower().startswith(_EXPLAINABLE):
+		return None
+	if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+		return None
+	explain_cur = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+	try:
+		explain_cur.execute("SAVEPOINT slow_query_explain")
+		try:
+			explain_cur.execute("EXPLAIN " + statement)
+			return '\n'.join(row[0] for row in explain_cur.fetchall())
+		except psycopg2.Error as e:
+			return f'EXPLAIN failed: {e}'
+		finally:
+			explain_cur.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+			explain_cur.execute("RELEASE SAVEPOINT slow_query_explain")
+	except psycopg2.Error:
+		logger.exception('could not explain slow query')
+		return None
+	finally:
+		explain_cur.close()
+
+def request_stats():
+	return _request_stats.get()
+
+def init_app(app):
+	@app.before_request
+	def start_request_stats():
+		_request_stats.set({'queries': 0, 'db_time': 0.0})
+
+	@app.teardown_request
+	def finish_request_stats(error):
+		stats = _request_stats.get()
+		if stats is None:
+			return
+		_request_stats.set(None)
+		endpoint = request.endpoint or 'unknown'
+		REQUEST_QUERIES.labels(endpoint).observe(stats['queries'])
+		if stats['queries'] >= N_PLUS_ONE_THRESHOLD:
+			logger.warning('%s made %d queries, possible N+1', endpoint, stats['queries'])
+		with _lock:
+			total = _endpoints.setdefault(endpoint, {'endpoint': endpoint, 'requests': 0, 'queries': 0, 'max_queries': 0, 'db_time': 0.0})
+			total['requests'] += 1
+			total['queries'] += stats['queries']
+			total['max_queries'] = max(total['max_queries'], stats['queries'])
+			total['db_time'] += stats['db_time']
+
+def top_queries(order='total', limit=50):
+	with _lock:
+		stats = [dict(stat, mean=stat['total'] / stat['calls']) for stat in _stats.values()]
+	return sorted(stats, key=lambda stat: stat[order], reverse=True)[:limit]
+
+def endpoint_stats():
+	with _lock:
+		stats = [dict(stat, mean_queries=stat['queries'] / stat['requests']) for stat in _endpoints.values()]
+	return sorted(stats, key=lambda stat: stat['mean_queries'], reverse=True)
+
+def slow_queries():
+	with _lock:
+		return list(_slow_log)
+
+def reset_stats():
+	with _lock:
+		_stats.clear()
+		_endpoints.clear()
+		_slow_log.clear()
+		_explained.clear()
@@ -0,0 +1,97 @@
+import os
+import zlib
+import time
+import logging
+import threading
+from db import db_cursor
+
+logger = logging.getLogger(__name__)
+
+class PeriodicJob:
+	# Фоновая задача процесса. exclusive=True — среди всех процессов задачу
+	# в каждый момент выполняет только один (advisory-блокировка PostgreSQL).
+	def __init__(self, name, interval, func, exclusive=False):
+		self.name = name
+		self.interval = interval
+		self.func = func
+		self.exclusive = exclusive
+		self.lock_key = zlib.crc32(name.encode())
+		self._pid = None
+		self._lock = threading.Lock()
+		self.runs = 0
+		self.skipped = 0
+		self.failures = 0
+		self.last_run = None
+		self.last_duration = None
+		self.last_error = None
+
+	def start(self):
+		if self._pid == os.getpid():
+			return
+		with self._lock:
+			if self._pid != os.getpid():
+				threading.Thread(target=self._loop, name=f'job-{self.name}', daemon=True).start()
+				self._pid = os.getpid()
+
+	def _loop(self):
+		while True:
+			time.sleep(self.interval)
+			self.run()
+
+	def run(self):
+		if not self.exclusive:
+			return self._run()
+		try:
+			with db_cursor() as cur:
+				cur.execute("SELECT pg_try_advisory_lock(%s)", (self.lock_key,))
+				locked = cur.fetchone()[0]
+				# Блокировка сессионная, транзакцию на время задачи держать не нужно
+				cur.connection.commit()
+				if not locked:
+					self.skipped += 1
+					return None
+				try:
+					return self._run()
+				finally:
+					cur.execute("SELECT pg_advisory_unlock(%s)", (self.lock_key,))
+		except Exception:
+			logger.exception('job %s: cannot take advisory lock', self.name)
+
+	def _run(self):
+		start = time.monotonic()
+		self.last_run = time.time()
+		try:
+			result = self.func()
+			self.last_error = None
+			return result
+		except Exception as e:
+			self.failures += 1
+			self.last_error = str(e)
+			logger.exception('job %s failed', self.name)
+		finally:
+			self.runs += 1
+			self.last_duration = time.monotonic() - start
+
+	def stats(self):
+		return {
+			'interval': self.interval,
+			'runs': self.runs,
+			'skipped': self.skipped,
+			'failures': self.failures,
+			'last_run': self.last_run,
+			'last_duration': self.last_duration,
+			'last_error': self.last_error,
+		}
+
+jobs = {}
+
+def every(name, interval, func, exclusive=False):
+	job = jobs[name] = PeriodicJob(name, interval, func, exclusive)
+	return job
+
+def start_jobs():
+	for job in jobs.values():
+		job.start()
+
+def job_stats():
+	return {name: job.stats() for name, job in jobs.items()}
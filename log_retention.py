@@ -0,0 +1,72 @@
+import os
+import re
+import gzip
+import logging
+from datetime import date
+from jobs import every
+from db import (
+	create_logs_partitions, get_logs_partitions, detach_logs_partition, copy_logs_partition, drop_logs_partition
+)
+
+# Журнал секционирован по месяцам. Задача заранее создаёт секции на
+# LOG_PARTITIONS_AHEAD месяцев вперёд, а секции старше LOG_RETENTION_MONTHS
+# отсоединяет, выгружает в LOG_ARCHIVE_DIR (CSV в gzip) и удаляет. Очистка
+# и VACUUM так зависят только от свежих данных, а не от всей истории.
+LOG_RETENTION_MONTHS = int(os.getenv('LOG_RETENTION_MONTHS', 12))
+LOG_PARTITIONS_AHEAD = int(os.getenv('LOG_PARTITIONS_AHEAD', 3))
+LOG_ARCHIVE_DIR = os.getenv('LOG_ARCHIVE_DIR', 'archive/logs')
+# 0 — удалять секции без выгрузки
+LOG_ARCHIVE = os.getenv('LOG_ARCHIVE', '1') == '1'
+LOG_MAINTENANCE_INTERVAL = float(os.getenv('LOG_MAINTENANCE_INTERVAL', 3600))
+
+PARTITION_NAME = re.compile(r'^logs_(\d{4})_(\d{2})$')
+
+logger = logging.getLogger(__name__)
+
+def _add_months(month, count):
+	index = month.year * 12 + month.month - 1 + count
+	return date(index // 12, index % 12 + 1, 1)
+
+def partition_month(name):
+	match = PARTITION_NAME.match(name)
+	return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+def archive_path(name):
+	return os.path.join(LOG_ARCHIVE_DIR, f'{name}.csv.gz')
+
+def archive_partition(name):
+	# Файл пишется рядом и переименовывается: неполный архив не выдаётся за готовый
+	os.makedirs(LOG_ARCHIVE_DIR, exist_ok=True)
+	path = archive_path(name)
+	with gzip.open(path + '.tmp', 'wb') as out:
+		copy_logs_partition(name, out)
+	os.replace(path + '.tmp', path)
+	return path
+
+def expired_partitions(today=None):
+	cutoff = _add_months((today or date.today()).replace(day=1), -LOG_RETENTION_MONTHS)
+	return [(name, attached) for name, attached, rows, size in get_logs_partitions()
+			if partition_month(name) and partition_month(name) < cutoff]
+
+def maintain():
+	this_month = date.today().replace(day=1)
+	created = create_logs_partitions(this_month, LOG_PARTITIONS_AHEAD + 1)
+	if created:
+		logger.info('created log partitions: %s', ', '.join(created))
+	# Отсоединённая секция не видна в logs; если процесс упадёт до удаления,
+	# следующий запуск её допишет в архив и удалит
+	for name, attached in expired_partitions():
+		if attached:
+			detach_logs_partition(name)
+		if LOG_ARCHIVE:
+			logger.info('archived %s to %s', name, archive_partition(name))
+		drop_logs_partition(name)
+		logger.info('dropped log partition %s', name)
+
+def partitions_status():
+	return [
+		{'name': name, 'month': partition_month(name), 'attached': attached, 'rows': max(rows, 0), 'bytes': size}
+		for name, attached, rows, size in get_logs_partitions() if partition_month(name)
+	]
+
+every('log-retention', LOG_MAINTENANCE_INTERVAL, maintain, exclusive=True)
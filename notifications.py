@@ -0,0 +1,103 @@
+import os
+import time
+import select
+import logging
+import threading
+import psycopg2
+import psycopg2.extensions
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+class Listener:
+	# Одно соединение LISTEN на процесс; уведомления раздаются подписчикам
+	# из фонового потока. Пока соединения нет, connected == False и
+	# подписчики не должны доверять данным, которые сбрасываются по уведомлениям.
+	def __init__(self, connect, poll_interval=5.0, reconnect_delay=1.0):
+		self.connect = connect
+		self.poll_interval = poll_interval
+		self.reconnect_delay = reconnect_delay
+		self._handlers = defaultdict(list)
+		self._state_handlers = []
+		self._lock = threading.Lock()
+		self._pending = set()
+		self._pid = None
+		self._connected = False
+		self.received = 0
+
+	def subscribe(self, channel, handler):
+		with self._lock:
+			self._handlers[channel].append(handler)
+			self._pending.add(channel)
+
+	def on_state_change(self, handler):
+		with self._lock:
+			self._state_handlers.append(handler)
+
+	@property
+	def connected(self):
+		self._ensure_started()
+		return self._connected
+
+	def _ensure_started(self):
+		# Поток не переживает fork(), в каждом процессе запускается свой
+		if self._pid == os.getpid():
+			return
+		with self._lock:
+			if self._pid != os.getpid():
+				self._connected = False
+				self._pending = set(self._handlers)
+				threading.Thread(target=self._run, name='pg-listener', daemon=True).start()
+				self._pid = os.getpid()
+
+	def _set_connected(self, connected):
+		self._connected = connected
+		for handler in list(self._state_handlers):
+			try:
+				handler(connected)
+			except Exception:
+				logger.exception('listener state handler failed')
+
+	def _dispatch(self, notify):
+		self.received += 1
+		for handler in list(self._handlers.get(notify.channel, ())):
+			try:
+				handler(notify.payload)
+			except Exception:
+				logger.exception('handler for %s failed', notify.channel)
+
+	def _listen_pending(self, cur):
+		with self._lock:
+			channels, self._pending = self._pending, set()
+		for channel in channels:
+			cur.execute(f'LISTEN "{channel}"')
+
+	def _run(self):
+		pid = os.getpid()
+		while self._pid in (None, pid):
+			conn = None
+			try:
+				conn = self.connect()
+				conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+				cur = conn.cursor()
+				with self._lock:
+					self._pending = set(self._handlers)
+				self._listen_pending(cur)
+				self._set_connected(True)
+				while True:
+					if self._pending:
+						self._listen_pending(cur)
+					if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+						# Проверка, что соединение живо
+						cur.execute('SELECT 1')
+					conn.poll()
+					while conn.notifies:
+						self._dispatch(conn.notifies.pop(0))
+			except (psycopg2.Error, OSError):
+				logger.warning('LISTEN connection lost, reconnecting', exc_info=True)
+			finally:
+				if self._connected:
+					self._set_connected(False)
+				if conn is not None and not conn.closed:
+					conn.close()
+			time.sleep(self.reconnect_delay)
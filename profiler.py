@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import threading
+from collections import Counter
+from flask import g, request, session, before_render_template, template_rendered
+from instrumentation import request_stats
+from jobs import every
+
+# Доля запросов, которые профилируются сэмплером (0.01 — каждый сотый).
+# Администратор может профилировать любой запрос параметром ?profile=1
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_ROUTES = {route for route in os.getenv('PROFILE_ROUTES', '').split(',') if route}
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.005))
+PROFILE_FLUSH_INTERVAL = float(os.getenv('PROFILE_FLUSH_INTERVAL', 60))
+
+logger = logging.getLogger(__name__)
+
+class Sampler:
+	# Один поток на процесс раз в PROFILE_INTERVAL снимает стеки только тех
+	# потоков, чьи запросы сейчас профилируются; остальные запросы ничего не платят
+	def __init__(self, interval):
+		self.interval = interval
+		self._active = {}
+		self._lock = threading.Lock()
+		self._wakeup = threading.Event()
+		self._pid = None
+
+	def start(self, thread_id):
+		self._ensure_started()
+		with self._lock:
+			self._active[thread_id] = Counter()
+		self._wakeup.set()
+
+	def stop(self, thread_id):
+		with self._lock:
+			return self._active.pop(thread_id, Counter())
+
+	def _ensure_started(self):
+		if self._pid == os.getpid():
+			return
+		with self._lock:
+			if self._pid != os.getpid():
+				threading.Thread(target=self._loop, name='profiler-sampler', daemon=True).start()
+				self._pid = os.getpid()
+
+	def _loop(self):
+		while True:
+			if not self._active:
+				self._wakeup.wait()
+				self._wakeup.clear()
+				continue
+			frames = sys._current_frames()
+			with self._lock:
+				for thread_id, stacks in self._active.items():
+					frame = frames.get(thread_id)
+					if frame is not None:
+						stacks[_fold(frame)] += 1
+			del frames
+			time.sleep(self.interval)
+
+def _fold(frame):
+	names = []
+	while frame is not None:
+		code = frame.f_code
+		names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+		frame = frame.f_back
+	return ';'.join(reversed(names))
+
+sampler = Sampler(PROFILE_INTERVAL)
+
+_timings = {}
+_timings_lock = threading.Lock()
+
+def _render_started(sender, template, context, **extra):
+	g._render_started = time.perf_counter()
+
+def _render_finished(sender, template, context, **extra):
+	started = g.pop('_render_started', None)
+	if started is not None:
+		g._render_time = g.get('_render_time', 0.0) + time.perf_counter() - started
+
+def _should_profile():
+	if PROFILE_ROUTES and request.endpoint not in PROFILE_ROUTES:
+		return False
+	if request.args.get('profile') == '1' and session.get('role') == 'admin':
+		return True
+	return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def write_stacks(endpoint, stacks):
+	# Формат collapsed stacks: flamegraph.pl, speedscope, inferno
+	directory = os.path.join(PROFILE_DIR, endpoint)
+	os.makedirs(directory, exist_ok=True)
+	path = os.path.join(directory, f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{threading.get_ident()}.folded')
+	with open(path, 'w') as f:
+		for stack, count in stacks.most_common():
+			f.write(f'{stack} {count}\n')
+	return path
+
+def route_timings():
+	with _timings_lock:
+		return {endpoint: dict(timing) for endpoint, timing in _timings.items()}
+
+def write_route_timings():
+	timings = route_timings()
+	if not timings:
+		return
+	os.makedirs(PROFILE_DIR, exist_ok=True)
+	path = os.path.join(PROFILE_DIR, f'timings-{os.getpid()}.json')
+	with open(path + '.tmp', 'w') as f:
+		json.dump(timings, f, indent=2, sort_keys=True)
+	os.replace(path + '.tmp', path)
+
+def init_app(app):
+	# Регистрируется после instrumentation.init_app: teardown-функции вызываются
+	# в обратном порядке, и счётчики запросов к базе ещё не сброшены
+	before_render_template.connect(_render_started, app)
+	template_rendered.connect(_render_finished, app)
+	if PROFILE_SAMPLE_RATE > 0:
+		every('profile-timings', PROFILE_FLUSH_INTERVAL, write_route_timings)
+
+	@app.before_request
+	def start_profile():
+		g._request_started = time.perf_counter()
+		if _should_profile():
+			g._profiled = True
+			sampler.start(threading.get_ident())
+
+	@app.after_request
+	def report_profile(response):
+		if g.get('_profiled'):
+			response.headers['X-Profile'] = 'sampled'
+		return response
+
+	@app.teardown_request
+	def finish_profile(error):
+		started = g.pop('_request_started', None)
+		if started is None:
+			return
+		total = time.perf_counter() - started
+		stats = request_stats()
+		db_time = stats['db_time'] if stats else 0.0
+		render_time = g.pop('_render_time', 0.0)
+		endpoint = request.endpoint or 'unknown'
+		with _timings_lock:
+			timing = _timings.setdefault(endpoint, {'requests': 0, 'total': 0.0, 'db': 0.0, 'render': 0.0, 'python': 0.0, 'max': 0.0})
+			timing['requests'] += 1
+			timing['total'] += total
+			timing['db'] += db_time
+			timing['render'] += render_time
+			timing['python'] += max(total - db_time - render_time, 0.0)
+			timing['max'] = max(timing['max'], total)
+		if g.pop('_profiled', False):
+			stacks = sampler.stop(threading.get_ident())
+			try:
+				write_stacks(endpoint, stacks)
+				write_route_timings()
+			except OSError:
+				logger.exception('cannot write profile for %s', endpoint)
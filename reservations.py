@@ -0,0 +1,29 @@
+import os
+import logging
+from jobs import every
+from db import add_to_cart, release_expired_holds
+
+# Сколько товар в корзине удерживается за покупателем; повторное добавление
+# продлевает удержание. Просроченные снимает сборщик, позиция остаётся в корзине
+CART_HOLD_TTL = float(os.getenv('CART_HOLD_TTL', 30 * 60))
+RESERVATION_SWEEP_INTERVAL = float(os.getenv('RESERVATION_SWEEP_INTERVAL', 30))
+RESERVATION_SWEEP_BATCH = int(os.getenv('RESERVATION_SWEEP_BATCH', 500))
+
+logger = logging.getLogger(__name__)
+
+def hold(user_id, product_id, quantity):
+	return add_to_cart(user_id, product_id, quantity, CART_HOLD_TTL)
+
+def sweep_expired():
+	# Короткие транзакции пачками: оформление заказов не ждёт весь проход
+	released = 0
+	while True:
+		count = release_expired_holds(RESERVATION_SWEEP_BATCH)
+		released += count
+		if count < RESERVATION_SWEEP_BATCH:
+			break
+	if released:
+		logger.info('released %d expired cart holds', released)
+	return released
+
+every('reservation-sweep', RESERVATION_SWEEP_INTERVAL, sweep_expired, exclusive=True)
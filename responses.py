@@ -0,0 +1,181 @@
+import os
+import sys
+import gzip
+import hashlib
+import logging
+import argparse
+import mimetypes
+import threading
+from flask import request, session, make_response, send_from_directory
+from db import listener, get_data_version
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+# Сжатие ответов: HTML и прочий текст сжимаются на лету по Accept-Encoding,
+# CSS/JS из static отдаются заранее сжатыми файлами (.br, .gz рядом с исходным),
+# которые строятся при старте приложения или командой
+#   python responses.py static
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 6))
+# Для ответов на лету — быстрый уровень brotli, для статики — максимальный
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', 4))
+PRECOMPRESS_STATIC = os.getenv('PRECOMPRESS_STATIC', '1') == '1'
+
+COMPRESSIBLE = {'text/html', 'text/css', 'text/plain', 'text/csv', 'application/javascript', 'text/javascript',
+	'application/json', 'image/svg+xml'}
+STATIC_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt')
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+
+logger = logging.getLogger(__name__)
+
+def available_encodings():
+	return [encoding for encoding in ENCODINGS if encoding != 'br' or brotli is not None]
+
+def negotiate():
+	# Предпочтение клиента по q, при равенстве — brotli
+	accepted = request.accept_encodings
+	best = max(available_encodings(), key=lambda encoding: accepted[encoding], default=None)
+	return best if best and accepted[best] > 0 else None
+
+def compress(data, encoding, static=False):
+	if encoding == 'br':
+		return brotli.compress(data, quality=11 if static else BROTLI_QUALITY)
+	return gzip.compress(data, 9 if static else COMPRESS_LEVEL, mtime=0)
+
+def compress_response(response):
+	if response.mimetype not in COMPRESSIBLE or response.direct_passthrough or response.is_streamed:
+		return response
+	response.vary.add('Accept-Encoding')
+	if response.status_code != 200 or 'Content-Encoding' in response.headers \
+			or response.content_length is not None and response.content_length < COMPRESS_MIN_SIZE:
+		return response
+	encoding = negotiate()
+	if encoding is None:
+		return response
+	response.set_data(compress(response.get_data(), encoding))
+	response.headers['Content-Encoding'] = encoding
+	return response
+
+def precompress_static(folder):
+	# .gz/.br пересобираются, только если исходный файл новее
+	built = 0
+	for root, dirs, files in os.walk(folder):
+		dirs[:] = [name for name in dirs if name != 'uploads']
+		for name in files:
+			if not name.endswith(STATIC_EXTENSIONS):
+				continue
+			source = os.path.join(root, name)
+			for encoding in available_encodings():
+				target = source + ENCODINGS[encoding]
+				if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source):
+					continue
+				with open(source, 'rb') as f:
+					data = compress(f.read(), encoding, static=True)
+				with open(target + '.tmp', 'wb') as f:
+					f.write(data)
+				os.replace(target + '.tmp', target)
+				built += 1
+	return built
+
+def _static_view(app, view):
+	def serve_static(filename):
+		encoding = negotiate() if filename.endswith(STATIC_EXTENSIONS) else None
+		if encoding and os.path.isfile(os.path.join(app.static_folder, filename + ENCODINGS[encoding])):
+			# ETag и Last-Modified — по сжатому файлу, у каждого варианта свои
+			response = send_from_directory(app.static_folder, filename + ENCODINGS[encoding],
+					mimetype=mimetypes.guess_type(filename)[0], max_age=app.get_send_file_max_age(filename))
+			response.headers['Content-Encoding'] = encoding
+		else:
+			response = view(filename=filename)
+		if filename.endswith(STATIC_EXTENSIONS):
+			response.vary.add('Accept-Encoding')
+		return response
+	return serve_static
+
+# Версии данных для ETag. Каждый процесс узнаёт их из уведомлений data_version;
+# для тем без уведомлений с момента подключения LISTEN берётся текущее значение
+# последовательности (b...), поэтому любое изменение после подключения меняет ETag.
+# Пока LISTEN не работает, об изменениях не узнать — ETag не выдаются.
+_versions = {}
+_baseline = None
+_versions_lock = threading.Lock()
+
+def _on_data_version(payload):
+	topic, _, version = payload.rpartition(':')
+	with _versions_lock:
+		_versions[topic] = version
+
+def _on_listener_state(connected):
+	global _baseline
+	with _versions_lock:
+		_versions.clear()
+		_baseline = None
+
+listener.subscribe('data_version', _on_data_version)
+listener.on_state_change(_on_listener_state)
+
+def data_versions(topics):
+	global _baseline
+	if not listener.connected:
+		return None
+	if _baseline is None:
+		baseline = f'b{get_data_version()}'
+		with _versions_lock:
+			_baseline = _baseline or baseline
+	with _versions_lock:
+		return [_versions.get(topic, _baseline) for topic in topics]
+
+def listing_etag(topics):
+	# Страница зависит от версий данных, пользователя и параметров запроса;
+	# страницы с flash-сообщениями одноразовые и не кэшируются
+	if request.method != 'GET' or session.get('_flashes'):
+		return None
+	versions = data_versions(topics)
+	if versions is None:
+		return None
+	key = repr((versions, session.get('user_id'), session.get('role'), request.full_path))
+	return hashlib.sha1(key.encode()).hexdigest()[:24]
+
+def conditional(*topics):
+	# ETag списка считается до обращения к базе за самими данными: при
+	# совпадении с If-None-Match страница не читается и не рендерится
+	def decorator(f):
+		def wrapper(*args, **kwargs):
+			etag = listing_etag(topics)
+			if etag and request.if_none_match.contains_weak(etag):
+				response = make_response('', 304)
+			else:
+				response = make_response(f(*args, **kwargs))
+			if etag and response.status_code in (200, 304):
+				response.set_etag(etag, weak=True)
+				# Только браузер пользователя и только с проверкой версии
+				response.cache_control.private = True
+				response.cache_control.no_cache = True
+			return response
+		wrapper.__name__ = f.__name__
+		return wrapper
+	return decorator
+
+def init_app(app):
+	if PRECOMPRESS_STATIC:
+		try:
+			built = precompress_static(app.static_folder)
+			if built:
+				logger.info('precompressed %d static files', built)
+		except OSError:
+			logger.exception('cannot precompress static files')
+	app.view_functions['static'] = _static_view(app, app.view_functions['static'])
+	app.after_request(compress_response)
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('command', choices=['static'])
+	parser.add_argument('--folder', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+	args = parser.parse_args()
+	print(f'{precompress_static(args.folder)} files compressed', file=sys.stderr)
+
+if __name__ == '__main__':
+	main()
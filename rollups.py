@@ -0,0 +1,18 @@
+import json
+import argparse
+from db import verify_seller_rollups, rebuild_seller_rollups
+
+# Проверка и пересборка сводки заказов продавцов (seller_orders, seller_order_stats):
+#   python rollups.py verify   — код возврата 1 при расхождениях
+#   python rollups.py rebuild
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Сводка заказов продавцов')
+	parser.add_argument('command', choices=['verify', 'rebuild'])
+	args = parser.parse_args()
+	if args.command == 'rebuild':
+		print(json.dumps({'rows': rebuild_seller_rollups()}))
+	else:
+		report = verify_seller_rollups()
+		print(json.dumps(report, indent=2))
+		if report['rows'] or report['stats']:
+			raise SystemExit(1)
@@ -105,6 +105,11 @@ BEGIN
         INSERT INTO logs (user_id, action)
         VALUES (NEW.seller_id, 'Added product: ' || NEW.name);
     ELSIF TG_OP = 'UPDATE' THEN
+        -- Служебные столбцы (производные изображения) в журнал не попадают
+        IF (NEW.name, NEW.description, NEW.price, NEW.quantity, NEW.image_urls, NEW.seller_id)
+            IS NOT DISTINCT FROM (OLD.name, OLD.description, OLD.price, OLD.quantity, OLD.image_urls, OLD.seller_id) THEN
+            RETURN NULL;
+        END IF;
         INSERT INTO logs (user_id, action)
         VALUES (NEW.seller_id, 'Updated product: ' || NEW.name);
     ELSIF TG_OP = 'DELETE' THEN
@@ -121,81 +126,83 @@ AFTER INSERT OR UPDATE OR DELETE ON products
 FOR EACH ROW
 EXECUTE FUNCTION log_product_action();
 
--- Функция: обновление количества товара после создания заказа
-CREATE OR REPLACE FUNCTION update_product_quantity_on_order()
-RETURNS TRIGGER AS $$
-BEGIN
-    UPDATE products
-    SET quantity = quantity - NEW.quantity
-    WHERE id = NEW.product_id;
-    RETURN NEW;
-END;
-$$ LANGUAGE plpgsql;
-
--- Триггер: обновление количества после добавления в order_items
-CREATE TRIGGER trg_update_product_quantity
-AFTER INSERT ON order_items
-FOR EACH ROW
-EXECUTE FUNCTION update_product_quantity_on_order();
-
--- Хранимая процедура: создание заказа с транзакцией
+-- Хранимая процедура: оформление корзины в заказ.
+-- Позиции берутся из корзины покупателя: удержанные (reserved_until) уже учтены
+-- в products.reserved и списываются вместе с резервом без проверки, для
+-- просроченных остаток проверяется условием того же UPDATE. Строки товаров
+-- блокируются в порядке id (параллельные заказы не взаимоблокируются), остаток
+-- списывается одним UPDATE, а позиции заказа вставляются из его RETURNING.
+-- Транзакцией управляет вызывающая сторона.
 CREATE OR REPLACE PROCEDURE create_order_with_items(
     p_user_id INTEGER,
-    p_delivery_address TEXT,
-    p_cart_items INTEGER[][] -- Массив пар {product_id, quantity}
+    p_delivery_address TEXT
 )
 LANGUAGE plpgsql AS $$
 DECLARE
     v_order_id INTEGER;
-    v_total_price DECIMAL := 0;
-    v_product_id INTEGER;
-    v_quantity INTEGER;
-    v_price DECIMAL;
-BEGIN
-    -- Начало транзакции
-    BEGIN
-        -- Создание заказа
-        INSERT INTO orders (user_id, total_price, delivery_address, status)
-        VALUES (p_user_id, 0, p_delivery_address, 'pending')
-        RETURNING id INTO v_order_id;
-
-        -- Обработка элементов корзины
-        FOR i IN 1..array_length(p_cart_items, 1) LOOP
-            v_product_id := p_cart_items[i][1];
-            v_quantity := p_cart_items[i][2];
-            
-            -- Проверка количества
-            IF v_quantity > (SELECT quantity FROM products WHERE id = v_product_id) THEN
-                RAISE EXCEPTION 'Not enough stock for product %', v_product_id;
-            END IF;
-
-            -- Получение цены
-            SELECT price INTO v_price FROM products WHERE id = v_product_id;
-            v_total_price := v_total_price + (v_price * v_quantity);
-
-            -- Добавление в order_items
-            INSERT INTO order_items (order_id, product_id, quantity, price)
-            VALUES (v_order_id, v_product_id, v_quantity, v_price);
-        END LOOP;
-
-        -- Обновление общей суммы заказа
-        UPDATE orders
-        SET total_price = v_total_price
-        WHERE id = v_order_id;
-
-        -- Очистка корзины
-        DELETE FROM cart WHERE user_id = p_user_id;
-
-        -- Логирование
-        INSERT INTO logs (user_id, action)
-        VALUES (p_user_id, 'Created order ' || v_order_id);
+    v_product_ids INTEGER[];
+    v_quantities INTEGER[];
+    v_held INTEGER[];
+    v_converted INTEGER;
+    v_missing INTEGER;
+    v_total_price DECIMAL;
+BEGIN
+    -- Строки корзины блокируются: сборщик просроченных резервов их пропустит
+    SELECT array_agg(product_id ORDER BY product_id), array_agg(quantity ORDER BY product_id),
+           array_agg(CASE WHEN reserved_until IS NULL THEN 0 ELSE quantity END ORDER BY product_id)
+    INTO v_product_ids, v_quantities, v_held
+    FROM (SELECT * FROM cart WHERE user_id = p_user_id AND quantity > 0 FOR UPDATE) c;
+
+    IF v_product_ids IS NULL THEN
+        RAISE EXCEPTION 'Cart is empty';
+    END IF;
+
+    -- Блокировка строк товаров в детерминированном порядке
+    PERFORM 1 FROM products WHERE id = ANY(v_product_ids) ORDER BY id FOR UPDATE;
+
+    -- Создание заказа
+    INSERT INTO orders (user_id, total_price, delivery_address, status)
+    VALUES (p_user_id, 0, p_delivery_address, 'pending')
+    RETURNING id INTO v_order_id;
+
+    -- Списание остатков вместе с резервом и добавление в order_items.
+    -- После списания остатка должно хватать на чужие резервы
+    WITH items AS (
+        SELECT * FROM unnest(v_product_ids, v_quantities, v_held) AS i(product_id, quantity, held)
+    ), updated AS (
+        UPDATE products p
+        SET quantity = p.quantity - i.quantity,
+            reserved = p.reserved - i.held
+        FROM items i
+        WHERE p.id = i.product_id AND p.quantity - i.quantity >= p.reserved - i.held
+        RETURNING p.id, p.price, i.quantity
+    ), inserted AS (
+        INSERT INTO order_items (order_id, product_id, quantity, price)
+        SELECT v_order_id, id, quantity, price FROM updated
+        RETURNING quantity, price
+    )
+    SELECT count(*), COALESCE(SUM(quantity * price), 0) INTO v_converted, v_total_price FROM inserted;
+
+    IF v_converted < array_length(v_product_ids, 1) THEN
+        SELECT i.product_id INTO v_missing
+        FROM unnest(v_product_ids) AS i(product_id)
+        WHERE NOT EXISTS (SELECT 1 FROM order_items WHERE order_id = v_order_id AND product_id = i.product_id)
+        ORDER BY i.product_id
+        LIMIT 1;
+        RAISE EXCEPTION 'Not enough stock for product %', v_missing;
+    END IF;
+
+    -- Обновление общей суммы заказа
+    UPDATE orders
+    SET total_price = v_total_price
+    WHERE id = v_order_id;
+
+    -- Очистка корзины: резервы уже превращены в позиции заказа
+    DELETE FROM cart WHERE user_id = p_user_id;
 
-        COMMIT;
-    EXCEPTION WHEN OTHERS THEN
-        ROLLBACK;
-        RAISE NOTICE 'Order creation failed: %', SQLERRM;
-        RAISE;
-    END;
+    -- Логирование
+    INSERT INTO logs (user_id, action)
+    VALUES (p_user_id, 'Created order ' || v_order_id);
 END;
 $$;
 
@@ -218,6 +225,10 @@ BEGIN
         IF NEW.status = 'delivered' THEN
             INSERT INTO logs (user_id, action)
             VALUES (NEW.courier_id, 'Delivered order ' || NEW.order_id);
+        ELSIF NEW.status = 'assigned' AND OLD.status = 'cancelled' THEN
+            -- Отменённый заказ взят из очереди повторно
+            INSERT INTO logs (user_id, action)
+            VALUES (NEW.courier_id, 'Assigned delivery for order ' || NEW.order_id);
         ELSIF NEW.status = 'cancelled' THEN
             INSERT INTO logs (user_id, action)
             VALUES (NEW.courier_id, 'Cancelled delivery for order ' || NEW.order_id || ' - Reason: ' || NEW.cancel_reason);
@@ -234,3 +245,553 @@ CREATE TRIGGER trg_log_delivery_action
 AFTER INSERT OR UPDATE ON delivery
 FOR EACH ROW
 EXECUTE FUNCTION log_delivery_action();
+
+-- Миграция: полнотекстовый и триграммный поиск товаров
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE products ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(description, '')), 'B')
+    ) STORED;
+
+-- Префиксный поиск по словам и поиск с опечатками по названию
+CREATE INDEX IF NOT EXISTS idx_products_search ON products USING GIN (search_vector);
+CREATE INDEX IF NOT EXISTS idx_products_name_trgm ON products USING GIN (name gin_trgm_ops);
+
+-- Миграция: индексы под keyset-пагинацию (сортировка по времени и id)
+CREATE INDEX IF NOT EXISTS idx_orders_created_at_id ON orders(created_at, id);
+CREATE INDEX IF NOT EXISTS idx_orders_status_created_at_id ON orders(status, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_logs_timestamp_id ON logs(timestamp, id);
+DROP INDEX IF EXISTS idx_logs_timestamp;
+
+-- Миграция: остаток списывается в create_order_with_items, триггер на order_items не нужен
+DROP TRIGGER IF EXISTS trg_update_product_quantity ON order_items;
+DROP FUNCTION IF EXISTS update_product_quantity_on_order();
+
+-- Миграция: уведомление воркеров об изменении каталога (сброс кэша).
+-- Триггер уровня оператора: один NOTIFY на оператор, а одинаковые
+-- уведомления внутри транзакции PostgreSQL объединяет в одно.
+CREATE OR REPLACE FUNCTION notify_catalogue_changed()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('catalogue_changed', TG_OP);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_notify_catalogue_changed ON products;
+CREATE TRIGGER trg_notify_catalogue_changed
+AFTER INSERT OR UPDATE OR DELETE ON products
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_catalogue_changed();
+
+-- Миграция: производные изображения (миниатюры, WebP/AVIF) для srcset.
+-- {"static/uploads/a.jpg": {"webp": [[100, "static/uploads/a-100w.webp"], ...], ...}, ...}
+ALTER TABLE products ADD COLUMN IF NOT EXISTS image_variants JSONB NOT NULL DEFAULT '{}';
+CREATE INDEX IF NOT EXISTS idx_products_image_urls ON products USING GIN (image_urls);
+
+-- Миграция: серверные сессии Flask в таблице sessions
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS data JSONB NOT NULL DEFAULT '{}';
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS last_seen TIMESTAMP;
+UPDATE sessions SET last_seen = created_at WHERE last_seen IS NULL;
+ALTER TABLE sessions ALTER COLUMN last_seen SET DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE sessions ALTER COLUMN last_seen SET NOT NULL;
+ALTER TABLE sessions ALTER COLUMN created_at SET DEFAULT CURRENT_TIMESTAMP;
+-- Для фоновой очистки просроченных сессий
+CREATE INDEX IF NOT EXISTS idx_sessions_created_at ON sessions(created_at);
+CREATE INDEX IF NOT EXISTS idx_sessions_last_seen ON sessions(last_seen);
+
+-- Миграция: очередь диспетчеризации курьеров.
+-- Заказ в очереди ровно тогда, когда status = 'paid': взятие переводит его
+-- в in_delivery, отмена доставки возвращает в paid
+CREATE INDEX IF NOT EXISTS idx_orders_dispatch ON orders(created_at, id) WHERE status = 'paid';
+CREATE INDEX IF NOT EXISTS idx_delivery_courier_active ON delivery(courier_id)
+    WHERE status NOT IN ('delivered', 'cancelled');
+
+-- Миграция: события заказов для страниц покупателя, продавца и курьера.
+-- Каждое изменение статуса заказа или доставки уходит в канал order_events;
+-- воркеры раздают его подписчикам /events
+CREATE OR REPLACE FUNCTION notify_order_event()
+RETURNS TRIGGER AS $$
+DECLARE
+    v_order orders%ROWTYPE;
+    v_delivery delivery%ROWTYPE;
+    v_previous_status TEXT;
+    v_payload TEXT;
+BEGIN
+    IF TG_TABLE_NAME = 'orders' THEN
+        v_order := NEW;
+        v_previous_status := OLD.status;
+        SELECT * INTO v_delivery FROM delivery WHERE order_id = NEW.id;
+    ELSE
+        SELECT * INTO v_order FROM orders WHERE id = NEW.order_id;
+        v_delivery := NEW;
+    END IF;
+    -- Только поля фиксированной длины: NOTIFY отвергает сообщения от 8000 байт,
+    -- и ошибка откатила бы само изменение заказа. Адрес страницы не обновляют
+    v_payload := json_build_object(
+        'id', txid_current() || ':' || v_order.id || ':' || TG_TABLE_NAME || ':' || coalesce(v_delivery.status, v_order.status),
+        'order_id', v_order.id,
+        'user_id', v_order.user_id,
+        'status', v_order.status,
+        'previous_status', v_previous_status,
+        'total_price', v_order.total_price,
+        'courier_id', v_delivery.courier_id,
+        'delivery_status', v_delivery.status,
+        'estimated_delivery', v_delivery.estimated_delivery,
+        'seller_ids', (SELECT array_agg(DISTINCT p.seller_id) FROM order_items oi
+                       JOIN products p ON p.id = oi.product_id WHERE oi.order_id = v_order.id)
+    )::text;
+    -- Список продавцов заказа не ограничен: при переполнении продавцы
+    -- событие не получат и увидят статус при обновлении страницы
+    IF octet_length(v_payload) >= 8000 THEN
+        v_payload := (v_payload::jsonb || '{"seller_ids": null}')::text;
+    END IF;
+    PERFORM pg_notify('order_events', v_payload);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_notify_order_event ON orders;
+CREATE TRIGGER trg_notify_order_event
+AFTER UPDATE OF status ON orders
+FOR EACH ROW
+WHEN (OLD.status IS DISTINCT FROM NEW.status)
+EXECUTE FUNCTION notify_order_event();
+
+DROP TRIGGER IF EXISTS trg_notify_delivery_event ON delivery;
+CREATE TRIGGER trg_notify_delivery_event
+AFTER INSERT OR UPDATE OF status, courier_id, estimated_delivery ON delivery
+FOR EACH ROW
+EXECUTE FUNCTION notify_order_event();
+
+-- Миграция: сводка заказов продавцов.
+-- seller_orders — строка на пару (продавец, заказ) с его товарами и выручкой,
+-- seller_order_stats — число заказов и выручка продавца по статусам.
+-- Обе таблицы поддерживаются триггерами; python rollups.py verify|rebuild
+-- сверяет их с исходными таблицами и пересобирает
+CREATE INDEX IF NOT EXISTS idx_order_items_product_id ON order_items(product_id);
+CREATE INDEX IF NOT EXISTS idx_products_seller_id ON products(seller_id);
+
+CREATE TABLE IF NOT EXISTS seller_orders (
+    seller_id INTEGER NOT NULL,
+    order_id INTEGER NOT NULL,
+    user_id INTEGER,
+    status TEXT NOT NULL,
+    total_price DECIMAL NOT NULL,
+    delivery_address TEXT NOT NULL,
+    created_at TIMESTAMP,
+    customer TEXT,
+    products TEXT[] NOT NULL,
+    seller_revenue DECIMAL NOT NULL,
+    PRIMARY KEY (seller_id, order_id)
+);
+CREATE INDEX IF NOT EXISTS idx_seller_orders_created_at ON seller_orders(seller_id, created_at, order_id);
+CREATE INDEX IF NOT EXISTS idx_seller_orders_status ON seller_orders(seller_id, status, created_at, order_id);
+CREATE INDEX IF NOT EXISTS idx_seller_orders_order_id ON seller_orders(order_id);
+CREATE INDEX IF NOT EXISTS idx_seller_orders_user_id ON seller_orders(user_id);
+
+CREATE TABLE IF NOT EXISTS seller_order_stats (
+    seller_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    orders INTEGER NOT NULL DEFAULT 0,
+    revenue DECIMAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (seller_id, status)
+);
+
+-- Эталон: то же самое, посчитанное по исходным таблицам
+CREATE OR REPLACE VIEW seller_orders_source AS
+    SELECT p.seller_id, o.id AS order_id, o.user_id, o.status, o.total_price, o.delivery_address,
+           o.created_at, u.name AS customer, array_agg(p.name ORDER BY p.name) AS products,
+           sum(oi.quantity * oi.price) AS seller_revenue
+    FROM orders o
+    JOIN order_items oi ON oi.order_id = o.id
+    JOIN products p ON p.id = oi.product_id
+    LEFT JOIN users u ON u.id = o.user_id
+    WHERE p.seller_id IS NOT NULL
+    GROUP BY p.seller_id, o.id, u.name;
+
+-- Пересчёт строк сводки для заказов p_order_ids и сдвиг счётчиков на разницу.
+-- Счётчики обновляются одним оператором в порядке ключа, чтобы параллельные
+-- транзакции блокировали строки seller_order_stats в одном порядке
+CREATE OR REPLACE FUNCTION refresh_seller_orders(p_order_ids INTEGER[])
+RETURNS void AS $$
+DECLARE
+    v_old seller_orders[];
+BEGIN
+    -- Пересчёты одного заказа идут строго по очереди: иначе параллельный DELETE
+    -- не видит ещё не зафиксированных строк другого пересчёта и INSERT падает
+    -- на seller_orders_pkey. Блокировка в порядке id — без взаимоблокировок
+    PERFORM 1 FROM orders WHERE id = ANY(p_order_ids) ORDER BY id FOR UPDATE;
+
+    WITH removed AS (
+        DELETE FROM seller_orders WHERE order_id = ANY(p_order_ids)
+        RETURNING seller_orders AS r
+    )
+    SELECT array_agg(r) INTO v_old FROM removed;
+
+    WITH fresh AS (
+        INSERT INTO seller_orders
+        SELECT * FROM seller_orders_source WHERE order_id = ANY(p_order_ids)
+        RETURNING seller_id, status, seller_revenue
+    ), delta AS (
+        SELECT seller_id, status, -1 AS orders, -seller_revenue AS revenue FROM unnest(v_old)
+        UNION ALL
+        SELECT seller_id, status, 1, seller_revenue FROM fresh
+    )
+    INSERT INTO seller_order_stats AS s (seller_id, status, orders, revenue)
+    SELECT seller_id, status, sum(orders), sum(revenue) FROM delta
+    GROUP BY seller_id, status
+    ORDER BY seller_id, status
+    ON CONFLICT (seller_id, status) DO UPDATE
+        SET orders = s.orders + EXCLUDED.orders, revenue = s.revenue + EXCLUDED.revenue;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Позиции заказа: триггеры уровня оператора, весь заказ за один вызов
+CREATE OR REPLACE FUNCTION seller_orders_items_changed()
+RETURNS TRIGGER AS $$
+DECLARE
+    v_order_ids INTEGER[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(DISTINCT order_id) INTO v_order_ids FROM new_items;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(DISTINCT order_id) INTO v_order_ids FROM old_items;
+    ELSE
+        SELECT array_agg(order_id) INTO v_order_ids
+        FROM (SELECT order_id FROM old_items UNION SELECT order_id FROM new_items) AS changed;
+    END IF;
+    IF v_order_ids IS NOT NULL THEN
+        PERFORM refresh_seller_orders(v_order_ids);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_seller_orders_items_insert ON order_items;
+CREATE TRIGGER trg_seller_orders_items_insert
+AFTER INSERT ON order_items
+REFERENCING NEW TABLE AS new_items
+FOR EACH STATEMENT
+EXECUTE FUNCTION seller_orders_items_changed();
+
+DROP TRIGGER IF EXISTS trg_seller_orders_items_update ON order_items;
+CREATE TRIGGER trg_seller_orders_items_update
+AFTER UPDATE ON order_items
+REFERENCING OLD TABLE AS old_items NEW TABLE AS new_items
+FOR EACH STATEMENT
+EXECUTE FUNCTION seller_orders_items_changed();
+
+DROP TRIGGER IF EXISTS trg_seller_orders_items_delete ON order_items;
+CREATE TRIGGER trg_seller_orders_items_delete
+AFTER DELETE ON order_items
+REFERENCING OLD TABLE AS old_items
+FOR EACH STATEMENT
+EXECUTE FUNCTION seller_orders_items_changed();
+
+-- Статус, сумма и адрес заказа
+CREATE OR REPLACE FUNCTION seller_orders_order_changed()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM refresh_seller_orders(ARRAY[NEW.id]);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_seller_orders_order ON orders;
+CREATE TRIGGER trg_seller_orders_order
+AFTER UPDATE OF status, total_price, delivery_address, user_id ON orders
+FOR EACH ROW
+WHEN ((OLD.status, OLD.total_price, OLD.delivery_address, OLD.user_id)
+      IS DISTINCT FROM (NEW.status, NEW.total_price, NEW.delivery_address, NEW.user_id))
+EXECUTE FUNCTION seller_orders_order_changed();
+
+-- Переименование товара или смена продавца затрагивает все заказы с этим товаром
+CREATE OR REPLACE FUNCTION seller_orders_product_changed()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM refresh_seller_orders(ARRAY(SELECT DISTINCT order_id FROM order_items WHERE product_id = NEW.id));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_seller_orders_product ON products;
+CREATE TRIGGER trg_seller_orders_product
+AFTER UPDATE OF name, seller_id ON products
+FOR EACH ROW
+WHEN ((OLD.name IS DISTINCT FROM NEW.name OR OLD.seller_id IS DISTINCT FROM NEW.seller_id)
+      AND current_setting('app.bulk_import', true) IS DISTINCT FROM 'on')
+EXECUTE FUNCTION seller_orders_product_changed();
+
+-- Имя покупателя
+CREATE OR REPLACE FUNCTION seller_orders_customer_changed()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE seller_orders SET customer = NEW.name WHERE user_id = NEW.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_seller_orders_customer ON users;
+CREATE TRIGGER trg_seller_orders_customer
+AFTER UPDATE OF name ON users
+FOR EACH ROW
+WHEN (OLD.name IS DISTINCT FROM NEW.name)
+EXECUTE FUNCTION seller_orders_customer_changed();
+
+-- Первичное заполнение
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM seller_orders) THEN
+        INSERT INTO seller_orders SELECT * FROM seller_orders_source;
+        INSERT INTO seller_order_stats (seller_id, status, orders, revenue)
+        SELECT seller_id, status, count(*), sum(seller_revenue) FROM seller_orders GROUP BY seller_id, status;
+    END IF;
+END $$;
+
+-- Миграция: агрегаты для аналитики администратора.
+-- Материализованные представления по дням (часам для журнала) хранят суммы,
+-- а не средние, поэтому их можно укрупнять до недель и месяцев.
+-- Обновляются фоновой задачей (analytics.py) через REFRESH ... CONCURRENTLY,
+-- для которого нужен уникальный индекс
+CREATE MATERIALIZED VIEW IF NOT EXISTS analytics_daily_orders AS
+    SELECT created_at::date AS day, status, count(*) AS orders, sum(total_price) AS revenue
+    FROM order_summary
+    WHERE created_at IS NOT NULL
+    GROUP BY 1, 2;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_analytics_daily_orders ON analytics_daily_orders(day, status);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS analytics_courier_daily AS
+    SELECT d.delivered_at::date AS day, d.courier_id, count(*) AS deliveries,
+           sum(extract(epoch FROM d.delivered_at - o.created_at)) AS delivery_seconds,
+           count(*) FILTER (WHERE d.delivered_at > d.estimated_delivery) AS late,
+           sum(greatest(extract(epoch FROM d.delivered_at - d.estimated_delivery), 0)) AS late_seconds
+    FROM delivery d
+    JOIN orders o ON o.id = d.order_id
+    WHERE d.status = 'delivered' AND d.delivered_at IS NOT NULL AND d.courier_id IS NOT NULL
+    GROUP BY 1, 2;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_analytics_courier_daily ON analytics_courier_daily(day, courier_id);
+
+-- analytics_hourly_activity строится по logs и создаётся после её секционирования (ниже)
+
+CREATE TABLE IF NOT EXISTS analytics_refreshes (
+    view_name TEXT PRIMARY KEY,
+    refreshed_at TIMESTAMP NOT NULL,
+    duration DOUBLE PRECISION NOT NULL
+);
+
+-- Миграция: резервирование остатков корзинами.
+-- products.reserved — сумма удержаний, доступно quantity - reserved. Удержание
+-- создаётся при добавлении в корзину и живёт до cart.reserved_until; просроченные
+-- снимает фоновый сборщик (reservations.py), строка корзины при этом остаётся
+-- без удержания (reserved_until = NULL) и проверяется уже при оформлении.
+ALTER TABLE products ADD COLUMN IF NOT EXISTS reserved INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE products DROP CONSTRAINT IF EXISTS products_reserved_check;
+ALTER TABLE products ADD CONSTRAINT products_reserved_check CHECK (reserved >= 0);
+ALTER TABLE cart ADD COLUMN IF NOT EXISTS reserved_until TIMESTAMP;
+CREATE INDEX IF NOT EXISTS idx_cart_reserved_until ON cart(reserved_until) WHERE reserved_until IS NOT NULL;
+
+-- Остаток проверяется при резервировании, построчная проверка не нужна
+DROP TRIGGER IF EXISTS trg_check_cart_quantity ON cart;
+DROP FUNCTION IF EXISTS check_product_quantity();
+DROP PROCEDURE IF EXISTS create_order_with_items(INTEGER, TEXT, INTEGER[]);
+
+-- Изменение резерва не меняет витрину и не сбрасывает кэш каталога
+DROP TRIGGER IF EXISTS trg_notify_catalogue_changed ON products;
+CREATE TRIGGER trg_notify_catalogue_changed
+AFTER INSERT OR UPDATE OF name, description, price, quantity, image_urls, image_variants, seller_id OR DELETE ON products
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_catalogue_changed();
+
+-- Добавление в корзину: резервирует недостающее количество (вся строка, если
+-- прежнее удержание истекло) одним условным UPDATE и продлевает удержание.
+-- Возвращает, удалось ли, и сколько товара осталось доступно.
+CREATE OR REPLACE FUNCTION reserve_cart_item(
+    p_user_id INTEGER,
+    p_product_id INTEGER,
+    p_quantity INTEGER,
+    p_hold INTERVAL,
+    OUT reserved BOOLEAN,
+    OUT available INTEGER
+)
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_held INTEGER;
+    v_total INTEGER;
+BEGIN
+    -- Пустая строка блокирует пару (покупатель, товар): параллельные добавления идут по очереди
+    INSERT INTO cart (user_id, product_id, quantity) VALUES (p_user_id, p_product_id, 0)
+    ON CONFLICT (user_id, product_id) DO NOTHING;
+    SELECT CASE WHEN c.reserved_until IS NULL THEN 0 ELSE c.quantity END, c.quantity + p_quantity
+    INTO v_held, v_total
+    FROM cart c WHERE c.user_id = p_user_id AND c.product_id = p_product_id
+    FOR UPDATE;
+
+    UPDATE products p SET reserved = p.reserved + v_total - v_held
+    WHERE p.id = p_product_id AND p.quantity - p.reserved >= v_total - v_held
+    RETURNING p.quantity - p.reserved INTO available;
+    reserved := FOUND;
+
+    IF reserved THEN
+        UPDATE cart SET quantity = v_total, reserved_until = now() + p_hold
+        WHERE user_id = p_user_id AND product_id = p_product_id;
+    ELSE
+        DELETE FROM cart WHERE user_id = p_user_id AND product_id = p_product_id AND quantity = 0;
+        SELECT greatest(p.quantity - p.reserved, 0) INTO available FROM products p WHERE p.id = p_product_id;
+    END IF;
+END;
+$$;
+
+-- Сборщик: снимает до p_batch_size просроченных удержаний, пропуская строки
+-- корзин, которые сейчас оформляются. Возвращает число снятых удержаний.
+CREATE OR REPLACE FUNCTION release_expired_holds(p_batch_size INTEGER)
+RETURNS INTEGER
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_product_ids INTEGER[];
+    v_quantities INTEGER[];
+    v_released INTEGER;
+BEGIN
+    WITH expired AS (
+        SELECT user_id, product_id FROM cart
+        WHERE reserved_until < now()
+        ORDER BY reserved_until
+        LIMIT p_batch_size
+        FOR UPDATE SKIP LOCKED
+    ), released AS (
+        UPDATE cart c SET reserved_until = NULL
+        FROM expired e
+        WHERE c.user_id = e.user_id AND c.product_id = e.product_id
+        RETURNING c.product_id, c.quantity
+    )
+    SELECT count(*), array_agg(product_id ORDER BY product_id), array_agg(quantity ORDER BY product_id)
+    INTO v_released, v_product_ids, v_quantities
+    FROM released;
+
+    -- Товары блокируются в порядке id, как при оформлении заказа
+    PERFORM 1 FROM products WHERE id = ANY(v_product_ids) ORDER BY id FOR UPDATE;
+    UPDATE products p SET reserved = p.reserved - r.quantity
+    FROM (
+        SELECT product_id, sum(quantity) AS quantity
+        FROM unnest(v_product_ids, v_quantities) AS i(product_id, quantity)
+        GROUP BY product_id
+    ) r
+    WHERE p.id = r.product_id;
+    RETURN v_released;
+END;
+$$;
+
+-- Миграция: массовый импорт каталога (catalogue.py).
+-- На время слияния импорт выставляет app.bulk_import = 'on': построчный журнал
+-- не пишется (вместо него одна сводная запись), сводки продавцов обновляются
+-- одним вызовом refresh_seller_orders после слияния.
+DROP TRIGGER IF EXISTS trg_log_product_action ON products;
+CREATE TRIGGER trg_log_product_action
+AFTER INSERT OR UPDATE OR DELETE ON products
+FOR EACH ROW
+WHEN (current_setting('app.bulk_import', true) IS DISTINCT FROM 'on')
+EXECUTE FUNCTION log_product_action();
+
+-- Миграция: журнал logs секционирован по месяцам (timestamp).
+-- Секции logs_ГГГГ_ММ создаются заранее фоновой задачей (log_retention.py),
+-- она же выгружает в архив и удаляет секции старше срока хранения. В logs_default
+-- попадает только то, для чего секции ещё нет; create_logs_partition переносит
+-- такие строки в новую секцию. Первичный ключ включает ключ секционирования.
+CREATE OR REPLACE FUNCTION create_logs_partition(p_month DATE)
+RETURNS TEXT
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_from DATE := date_trunc('month', p_month);
+    v_to DATE := date_trunc('month', p_month) + interval '1 month';
+    v_name TEXT := 'logs_' || to_char(p_month, 'YYYY_MM');
+BEGIN
+    IF to_regclass(v_name) IS NOT NULL THEN
+        RETURN NULL;
+    END IF;
+    EXECUTE format('CREATE TABLE %I (LIKE logs INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', v_name);
+    EXECUTE format('WITH moved AS (DELETE FROM logs_default WHERE timestamp >= %L AND timestamp < %L RETURNING *)
+                    INSERT INTO %I SELECT * FROM moved', v_from, v_to, v_name);
+    EXECUTE format('ALTER TABLE logs ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', v_name, v_from, v_to);
+    RETURN v_name;
+END;
+$$;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'logs'::regclass) THEN
+        -- Пересоздаётся ниже уже по секционированной таблице
+        DROP MATERIALIZED VIEW IF EXISTS analytics_hourly_activity;
+        ALTER TABLE logs RENAME TO logs_legacy;
+        ALTER TABLE logs_legacy RENAME CONSTRAINT logs_pkey TO logs_legacy_pkey;
+        CREATE TABLE logs (
+            id INTEGER NOT NULL DEFAULT nextval('logs_id_seq'),
+            user_id INTEGER REFERENCES users(id),
+            action TEXT NOT NULL,
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp);
+        ALTER SEQUENCE logs_id_seq OWNED BY logs.id;
+        CREATE TABLE logs_default PARTITION OF logs DEFAULT;
+        PERFORM create_logs_partition(month::date)
+        FROM generate_series(
+            date_trunc('month', LEAST((SELECT min(timestamp) FROM logs_legacy), now())),
+            date_trunc('month', now()) + interval '3 months',
+            interval '1 month'
+        ) AS month;
+        INSERT INTO logs (id, user_id, action, timestamp)
+        SELECT id, user_id, action, COALESCE(timestamp, CURRENT_TIMESTAMP) FROM logs_legacy;
+        DROP TABLE logs_legacy;
+    END IF;
+END $$;
+
+-- Индексы на секционированной таблице создаются и в каждой секции
+CREATE INDEX IF NOT EXISTS idx_logs_timestamp_id ON logs(timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_logs_user_id ON logs(user_id);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS analytics_hourly_activity AS
+    SELECT date_trunc('hour', timestamp) AS hour, count(*) AS actions
+    FROM logs
+    WHERE timestamp > now() - interval '90 days'
+    GROUP BY 1;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_analytics_hourly_activity ON analytics_hourly_activity(hour);
+
+-- Миграция: версии данных для ETag страниц-списков (responses.py).
+-- Триггеры уровня оператора берут следующее значение общей последовательности
+-- и рассылают его в data_version как 'тема:версия'; воркеры помнят последнюю
+-- версию каждой темы и отвечают 304, не читая и не рендеря страницу.
+CREATE SEQUENCE IF NOT EXISTS data_version_seq;
+
+CREATE OR REPLACE FUNCTION notify_data_version()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('data_version', TG_ARGV[0] || ':' || nextval('data_version_seq'));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Резерв (products.reserved) на страницах не показывается
+DROP TRIGGER IF EXISTS trg_data_version_products ON products;
+CREATE TRIGGER trg_data_version_products
+AFTER INSERT OR UPDATE OF name, description, price, quantity, image_urls, image_variants, seller_id OR DELETE ON products
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_data_version('catalogue');
+
+DROP TRIGGER IF EXISTS trg_data_version_orders ON orders;
+CREATE TRIGGER trg_data_version_orders
+AFTER INSERT OR UPDATE OR DELETE ON orders
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_data_version('orders');
+
+DROP TRIGGER IF EXISTS trg_data_version_seller_orders ON seller_orders;
+CREATE TRIGGER trg_data_version_seller_orders
+AFTER INSERT OR UPDATE OR DELETE ON seller_orders
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_data_version('seller_orders');
+
+DROP TRIGGER IF EXISTS trg_data_version_users ON users;
+CREATE TRIGGER trg_data_version_users
+AFTER INSERT OR UPDATE OF name, role OR DELETE ON users
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_data_version('users');
@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import secrets
+import threading
+from datetime import datetime
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+from cache import make_cache, TTLCache
+from jobs import every
+from db import (
+	after_commit, listener, create_session, get_session_by_code, update_session, delete_session,
+	touch_sessions, delete_expired_sessions
+)
+
+SESSION_IDLE_TIMEOUT = float(os.getenv('SESSION_IDLE_TIMEOUT', 7 * 24 * 3600))
+SESSION_MAX_AGE = float(os.getenv('SESSION_MAX_AGE', 30 * 24 * 3600))
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', 10000))
+SESSION_CACHE_TTL = float(os.getenv('SESSION_CACHE_TTL', 300))
+# last_seen обновляется не чаще раза в SESSION_TOUCH_INTERVAL и пачками
+SESSION_TOUCH_INTERVAL = float(os.getenv('SESSION_TOUCH_INTERVAL', 60))
+SESSION_TOUCH_FLUSH = float(os.getenv('SESSION_TOUCH_FLUSH', 10))
+SESSION_SWEEP_INTERVAL = float(os.getenv('SESSION_SWEEP_INTERVAL', 600))
+SESSION_SWEEP_BATCH = int(os.getenv('SESSION_SWEEP_BATCH', 1000))
+
+session_cache = make_cache('sessions', SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+# Общий кэш сбрасывает сам процесс, изменивший сессию,
+# локальный — каждый процесс по NOTIFY session_changed
+_local_cache = isinstance(session_cache, TTLCache)
+if _local_cache:
+	listener.subscribe('session_changed', session_cache.delete)
+	listener.on_state_change(lambda connected: session_cache.clear())
+
+_touched = {}
+_touched_lock = threading.Lock()
+
+class ServerSideSession(CallbackDict, SessionMixin):
+	def __init__(self, initial=None, sid=None, user_id=None, created=None):
+		def on_update(self):
+			self.modified = True
+		CallbackDict.__init__(self, initial, on_update)
+		self.sid = sid
+		self.user_id = user_id
+		self.created = created
+		self.new = sid is None
+		self.modified = False
+
+def _load(sid):
+	# С локальным кэшем без LISTEN не узнать об изменениях в других процессах
+	use_cache = not _local_cache or listener.connected
+	record = session_cache.get(sid) if use_cache else None
+	if record is None:
+		# Уведомление о выходе или смене сессии, пришедшее во время чтения,
+		# сбрасывает поколение, и прочитанная запись в кэш не попадёт
+		generation = session_cache.generation
+		row = get_session_by_code(sid)
+		if row is None:
+			return None
+		user_id, data, created_at, last_seen = row
+		record = {'user_id': user_id, 'data': data, 'created': created_at.timestamp(), 'last_seen': last_seen.timestamp()}
+		if use_cache:
+			session_cache.set(sid, record, generation=generation)
+	return record
+
+def forget(session_codes):
+	# Сессии, удалённые не через save_session (каскадом вместе с пользователем)
+	after_commit(lambda: [session_cache.delete(code) for code in session_codes])
+
+def _touch(sid, record):
+	now = time.time()
+	if now - record['last_seen'] < SESSION_TOUCH_INTERVAL:
+		return
+	record['last_seen'] = now
+	session_cache.set(sid, record)
+	with _touched_lock:
+		_touched[sid] = datetime.fromtimestamp(now)
+
+def flush_touched():
+	global _touched
+	with _touched_lock:
+		touched, _touched = _touched, {}
+	if touched:
+		touch_sessions(touched)
+
+def sweep_expired():
+	deleted = 0
+	while True:
+		count = delete_expired_sessions(SESSION_IDLE_TIMEOUT, SESSION_MAX_AGE, SESSION_SWEEP_BATCH)
+		deleted += count
+		if count < SESSION_SWEEP_BATCH:
+			return deleted
+
+every('session-touch', SESSION_TOUCH_FLUSH, flush_touched)
+every('session-sweep', SESSION_SWEEP_INTERVAL, sweep_expired, exclusive=True)
+
+class DatabaseSessionInterface(SessionInterface):
+	# В cookie только случайный идентификатор, данные — в таблице sessions,
+	# поэтому сессии переживают перезапуск и общие для всех воркеров
+	def open_session(self, app, request):
+		sid = request.cookies.get(self.get_cookie_name(app))
+		if sid:
+			record = _load(sid)
+			now = time.time()
+			if record and now - record['last_seen'] < SESSION_IDLE_TIMEOUT and now - record['created'] < SESSION_MAX_AGE:
+				_touch(sid, record)
+				# Глубокая копия: flash() дописывает во вложенный список, и запрос,
+				# упавший до сохранения, не должен менять запись в кэше
+				return ServerSideSession(json.loads(json.dumps(record['data'])), sid, record['user_id'], record['created'])
+		return ServerSideSession()
+
+	def save_session(self, app, session, response):
+		name = self.get_cookie_name(app)
+		domain = self.get_cookie_domain(app)
+		path = self.get_cookie_path(app)
+		if not session:
+			if session.sid is not None and session.modified:
+				# session.clear() при выходе
+				delete_session(session.sid)
+				session_cache.delete(session.sid)
+				response.delete_cookie(name, domain=domain, path=path)
+			return
+		if not session.modified:
+			return
+		data = dict(session)
+		user_id = data.get('user_id')
+		if session.sid is None or user_id != session.user_id:
+			# Новый идентификатор при входе защищает от фиксации сессии
+			if session.sid is not None:
+				delete_session(session.sid)
+				session_cache.delete(session.sid)
+			session.sid = secrets.token_urlsafe(48)
+			session.created = time.time()
+			create_session(user_id, session.sid, data)
+		else:
+			update_session(session.sid, user_id, data)
+		session_cache.set(session.sid, {'user_id': user_id, 'data': data, 'created': session.created, 'last_seen': time.time()})
+		response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+				httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+				secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
@@ -1 +1 @@
-python3 main.py
+exec gunicorn -c gunicorn.conf.py wsgi:app
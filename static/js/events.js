@@ -0,0 +1,37 @@
+// Обновление статусов заказов по событиям /events без перезагрузки страницы.
+// Строки заказов помечены data-order-id, ячейки — data-field с именем поля события;
+// строки очереди курьера (data-queue) убираются, когда заказ взят.
+(function () {
+	if (!window.EventSource) return;
+
+	function showNotice() {
+		let notice = document.getElementById("events-notice");
+		if (notice) notice.hidden = false;
+	}
+
+	let source = new EventSource("/events");
+
+	source.addEventListener("order", function (e) {
+		let order = JSON.parse(e.data);
+		let rows = document.querySelectorAll('[data-order-id="' + order.order_id + '"]');
+		if (!rows.length) {
+			showNotice();
+			return;
+		}
+		rows.forEach(function (row) {
+			if (row.hasAttribute("data-queue") && order.status !== "paid") {
+				row.remove();
+				return;
+			}
+			row.querySelectorAll("[data-field]").forEach(function (cell) {
+				let value = order[cell.dataset.field];
+				if (value !== null && value !== undefined) cell.textContent = value;
+			});
+		});
+	});
+
+	source.addEventListener("resync", function () {
+		source.close();
+		showNotice();
+	});
+})();
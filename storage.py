@@ -0,0 +1,82 @@
+import os
+import re
+import glob
+import time
+import hashlib
+import logging
+import tempfile
+from db import after_commit, get_unreferenced_images
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Свежие файлы не удаляются: их мог только что получить параллельный запрос
+BLOB_GC_GRACE = float(os.getenv('BLOB_GC_GRACE', 300))
+BLOB_MAX_AGE = 365 * 24 * 3600
+
+# <sha256>.<ext> и производные <sha256>-<width>w.<ext>
+BLOB_NAME = re.compile(r'^([0-9a-f]{64})(-\d+w)?\.[a-z0-9]+$')
+
+logger = logging.getLogger(__name__)
+
+def store_upload(file_storage, folder, extension):
+	# Хэш считается на лету, пока файл пишется во временный, затем атомарное
+	# переименование в имя по содержимому. Одинаковые файлы хранятся один раз.
+	digest = hashlib.sha256()
+	fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.upload-')
+	try:
+		with os.fdopen(fd, 'wb') as out:
+			for chunk in iter(lambda: file_storage.stream.read(UPLOAD_CHUNK_SIZE), b''):
+				digest.update(chunk)
+				out.write(chunk)
+		path = os.path.join(folder, f'{digest.hexdigest()}.{extension}')
+		if os.path.exists(path):
+			os.unlink(tmp_path)
+			os.utime(path)
+		else:
+			os.chmod(tmp_path, 0o644)
+			os.replace(tmp_path, path)
+		return path
+	except BaseException:
+		if os.path.exists(tmp_path):
+			os.unlink(tmp_path)
+		raise
+
+def blob_name(path):
+	name = os.path.basename(path)
+	return name if BLOB_NAME.match(name) else None
+
+def _collect(urls):
+	for url in get_unreferenced_images(urls):
+		name = blob_name(url)
+		if name is None:
+			continue
+		digest = BLOB_NAME.match(name).group(1)
+		folder = os.path.dirname(url)
+		paths = [url]
+		# Те же байты под другим расширением (a.jpg и a.jpeg) — другой blob, но
+		# производные <digest>-<w>w.<fmt> у них общие: удаляются с последним из них
+		siblings = [path for path in glob.glob(os.path.join(folder, f'{digest}.*')) if path != url]
+		if not siblings or len(get_unreferenced_images(siblings)) == len(siblings):
+			paths += glob.glob(os.path.join(folder, f'{digest}-*w.*'))
+		for path in paths:
+			try:
+				if time.time() - os.path.getmtime(path) > BLOB_GC_GRACE:
+					os.unlink(path)
+			except OSError:
+				logger.warning('cannot remove blob %s', path, exc_info=True)
+
+def release(urls):
+	# Файлы, на которые после фиксации не ссылается ни один products.image_urls, удаляются
+	if urls:
+		after_commit(lambda: _collect(urls))
+
+def cache_forever(response, request):
+	# Содержимое по имени файла никогда не меняется — кэшируем навсегда
+	name = blob_name(request.path)
+	if name and response.status_code == 200:
+		response.set_etag(name)
+		response.cache_control.no_cache = None
+		response.cache_control.public = True
+		response.cache_control.max_age = BLOB_MAX_AGE
+		response.cache_control.immutable = True
+		response.make_conditional(request)
+	return response
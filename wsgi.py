@@ -0,0 +1,5 @@
+from app import app
+from prometheus_flask_exporter.multiprocess import GunicornInternalPrometheusMetrics
+
+# /metrics собирает данные всех воркеров из PROMETHEUS_MULTIPROC_DIR
+metrics = GunicornInternalPrometheusMetrics(app)